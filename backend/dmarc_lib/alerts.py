@@ -1,11 +1,13 @@
 import httpx
+import asyncio
 import logging
 from .db import get_setting
 
 logger = logging.getLogger(__name__)
 
 async def send_slack_notification(message: str):
-    webhook_url = get_setting("slack_webhook_url")
+    loop = asyncio.get_running_loop()
+    webhook_url = await loop.run_in_executor(None, get_setting, "slack_webhook_url")
     if not webhook_url:
         return
     
@@ -22,19 +24,15 @@ async def check_for_spikes(report_id_db: int):
     Check if a newly imported report represents a spike in failures.
     Called after save_report.
     """
-    from .db import get_report_detail
-    report = get_report_detail(report_id_db)
+    from .db import get_report_summary
+    loop = asyncio.get_running_loop()
+    report = await loop.run_in_executor(None, get_report_summary, report_id_db)
     if not report:
         return
 
     # Algorithm: If total failures > 10 and failure rate > 25%
-    total = 0
-    fail = 0
-    for rec in report['records']:
-        count = rec['count']
-        total += count
-        if rec['disposition'] and rec['disposition'] != 'none':
-            fail += count
+    total = report['total_count']
+    fail = report['fail_count']
     
     if total > 10 and (fail / total) > 0.25:
         msg = (
@@ -0,0 +1,187 @@
+"""
+Bulk import of archived DMARC reports straight into the database.
+
+Walks files/directories, parses reports in a process pool and saves them in
+batches with save_reports(), bypassing the rate-limited upload API. Every
+file is checkpointed in `import_checkpoints` (keyed by path, size and
+mtime), so re-running the same command after an interruption skips what
+was already imported. File hashes go into `raw_files` like uploads, so a
+file whose exact bytes were ingested before (by any path) is not saved
+again, and later uploads or fetches of it are recognised.
+
+Usage: python -m backend.dmarc_lib.bulk_import [options] <path> [more paths...]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from .db import find_raw_files, init_db, record_raw_files, save_reports, sha256_file
+from .import_state import DEFAULT_BATCH_SIZE, ImportProgress, load_checkpoints, save_checkpoints
+from .jobs import process_pool
+from .parser import parse_report
+
+logger = logging.getLogger(__name__)
+
+REPORT_SUFFIXES = (".xml", ".gz", ".zip", ".xz")
+
+
+def iter_report_files(paths, recursive: bool = True):
+    """Yield report files under the given files/directories in a stable order."""
+    for path in map(Path, paths):
+        if path.is_file():
+            yield path.resolve()
+        elif path.is_dir():
+            if recursive:
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if name.lower().endswith(REPORT_SUFFIXES):
+                            yield Path(root, name).resolve()
+            else:
+                for child in sorted(path.iterdir()):
+                    if child.is_file() and child.name.lower().endswith(REPORT_SUFFIXES):
+                        yield child.resolve()
+        else:
+            logger.warning(f"Skipping '{path}': not a file or directory")
+
+
+def _parse_file(path: str):
+    """Worker entry point: returns (path, sha256, size, parsed, error)."""
+    try:
+        sha256, size = sha256_file(path)
+        return path, sha256, size, parse_report(path), None
+    except Exception as e:
+        return path, None, None, None, f"{type(e).__name__}: {e}"
+
+
+def bulk_import(paths, workers: int | None = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                recursive: bool = True, resume: bool = True, retry_failed: bool = False,
+                use_processes: bool = True, progress=print, progress_every: float = 5.0) -> dict:
+    """
+    Import every report under `paths`. Returns a summary dict with the
+    number of files seen, skipped (already checkpointed), saved and failed.
+    """
+    init_db()
+    workers = workers or os.cpu_count() or 2
+    done = load_checkpoints(retry_failed) if resume else {}
+
+    pending = []
+    skipped = 0
+    for path in iter_report_files(paths, recursive):
+        st = path.stat()
+        if done.get(str(path)) == (st.st_size, st.st_mtime_ns):
+            skipped += 1
+            continue
+        pending.append((str(path), st.st_size, st.st_mtime_ns))
+
+    stats = ImportProgress(len(pending), progress_every, progress)
+    if progress:
+        progress(f"{len(pending)} files to import ({skipped} already imported), {workers} workers")
+
+    batch = []  # (path, size, mtime_ns, sha256, parsed)
+
+    def flush():
+        if not batch:
+            return
+        # Byte-identical files already ingested resolve to their report without a save
+        known = find_raw_files(entry[3] for entry in batch)
+        saved_ids = iter(save_reports(entry[4] for entry in batch if entry[3] not in known))
+        checkpoints = []
+        raw_files = []
+        for path, size, mtime_ns, sha256, parsed in batch:
+            report_db_id = known.get(sha256)
+            if report_db_id is None:
+                report_db_id = next(saved_ids)
+                if report_db_id is not None:
+                    raw_files.append((sha256, size, report_db_id))
+            if report_db_id is None:
+                stats.failed += 1
+                checkpoints.append((path, size, mtime_ns, 'failed', None, "save failed"))
+            else:
+                stats.reports += 1
+                stats.records += len(parsed['records'])
+                checkpoints.append((path, size, mtime_ns, 'imported', report_db_id, None))
+        # Written after the reports commit: a crash in between only means
+        # these files are parsed again and resolve to the existing reports.
+        record_raw_files(raw_files)
+        save_checkpoints(checkpoints)
+        batch.clear()
+
+    executor = process_pool(workers) if use_processes else ThreadPoolExecutor(max_workers=workers)
+    meta = {path: (size, mtime_ns) for path, size, mtime_ns in pending}
+    queue = iter(pending)
+    in_flight = set()
+    try:
+        # Keep a bounded number of parsed reports in flight so memory stays flat
+        while True:
+            while len(in_flight) < workers * 4:
+                item = next(queue, None)
+                if item is None:
+                    break
+                in_flight.add(executor.submit(_parse_file, item[0]))
+            if not in_flight:
+                break
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            failures = []
+            for future in finished:
+                path, sha256, _, parsed, error = future.result()
+                size, mtime_ns = meta.pop(path)
+                stats.files += 1
+                if error:
+                    stats.failed += 1
+                    logger.error(f"Failed to parse {path}: {error}")
+                    failures.append((path, size, mtime_ns, 'failed', None, error))
+                else:
+                    batch.append((path, size, mtime_ns, sha256, parsed))
+            if failures:
+                save_checkpoints(failures)
+            if len(batch) >= batch_size:
+                flush()
+            stats.report()
+        flush()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        stats.report(force=True)
+
+    return {
+        "files": len(pending) + skipped,
+        "skipped": skipped,
+        "saved": stats.reports,
+        "failed": stats.failed,
+        "records": stats.records,
+        "seconds": round(time.monotonic() - stats.started, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Import DMARC report files directly into the database (resumable).")
+    parser.add_argument("paths", nargs="+", help="Report files or directories")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Parser processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Reports per database commit")
+    parser.add_argument("--no-recursive", action="store_true", help="Only scan the top level of directories")
+    parser.add_argument("--no-resume", action="store_true", help="Ignore checkpoints and re-import every file")
+    parser.add_argument("--retry-failed", action="store_true", help="Retry files that failed in an earlier run")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
+    try:
+        summary = bulk_import(
+            args.paths, workers=args.workers, batch_size=args.batch_size,
+            recursive=not args.no_recursive, resume=not args.no_resume,
+            retry_failed=args.retry_failed,
+        )
+    except KeyboardInterrupt:
+        print("Interrupted - run the same command again to resume.", file=sys.stderr)
+        return 130
+    print(f"Done: {summary['saved']} reports saved ({summary['records']} records), "
+          f"{summary['failed']} failed, {summary['skipped']} skipped in {summary['seconds']}s")
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,21 +5,97 @@ import secrets
 import hashlib
 from pathlib import Path
 import datetime
+import logging
+import threading
+import time
 from typing import Any
 
 DB_PATH = os.environ.get('DB_PATH', 'dmarc_reports.db')
 
+logger = logging.getLogger(__name__)
+
 
 def _hash_api_key(raw_key: str) -> str:
     """Hash an API key using SHA-256 for storage."""
     return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+# SQLite tuning, applied to every connection (SQLITE_* in .env, see .env.example)
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', '-65536'))  # negative = KiB, i.e. 64 MiB
+SQLITE_TEMP_STORE = os.environ.get('SQLITE_TEMP_STORE', 'MEMORY')
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+# Resolved API-key/JWT principals are cached for this long (seconds). Revocations
+# and user changes clear this process's cache at once; other worker
+# processes pick them up when their entry expires.
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', '30'))
+
+_local = threading.local()
+_forked_connections = []
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    Per-thread connection returned by get_db().
+    close() hands the connection back for reuse instead of closing it:
+    any uncommitted work is rolled back so the next caller on this thread
+    starts clean. Use close_db() to really close it.
+    """
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+
+def _connect(check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_PATH,
+        factory=PooledConnection,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=check_same_thread,
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    conn.execute(f"PRAGMA temp_store={SQLITE_TEMP_STORE}")
     conn.execute("PRAGMA foreign_keys=ON")
     return conn
 
+
+def get_db():
+    """
+    Return this thread's reusable connection, opening it on first use.
+    Connections are never shared between threads, and a forked child
+    process opens its own instead of reusing the parent's.
+    """
+    key = (DB_PATH, os.getpid())
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.key != key:
+        if _local.key[1] != key[1]:
+            # Inherited across fork: never touch the parent's handle, just keep it alive
+            _forked_connections.append(conn)
+        else:
+            sqlite3.Connection.close(conn)
+        conn = None
+    if conn is None:
+        conn = _connect()
+        _local.conn = conn
+        _local.key = key
+    return conn
+
+
+def close_db():
+    """Really close the calling thread's connection (shutdown, tests)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        if _local.key[1] == os.getpid():
+            sqlite3.Connection.close(conn)
+
 def init_db():
     conn = get_db()
     c = conn.cursor()
@@ -103,9 +179,230 @@ def init_db():
     c.execute('CREATE INDEX IF NOT EXISTS idx_ip_enrichment_updated ON ip_enrichment(last_updated)')
     
     conn.commit()
+    migrate(conn)
     _seed_default_user(conn)
     conn.close()
 
+
+# ============================================================================
+# Schema Migrations
+# ============================================================================
+# init_db() creates the base schema (version 0). Every later schema change is
+# a function appended to MIGRATIONS; migrate() applies the ones newer than
+# the database's PRAGMA user_version, each in its own transaction. Never edit
+# or reorder a migration that has shipped - add a new one instead.
+
+def _migration_hot_path_indexes(c):
+    """Indexes for the report list/stats/detail/delete access paths."""
+    # Covering index: per-report sums never have to touch the records table itself
+    c.execute('CREATE INDEX IF NOT EXISTS idx_records_report ON records(report_id, disposition, count)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reports_date_end ON reports(date_end)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reports_domain ON reports(domain, date_end)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reports_org_name ON reports(org_name, date_end)')
+
+
+def _migration_daily_rollup(c):
+    """Pre-aggregated per-day volumes for the dashboard and domain list."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_rollup (
+            domain TEXT NOT NULL,       -- '' when the report had no domain
+            day TEXT NOT NULL,          -- DATE(reports.date_end, 'unixepoch')
+            disposition TEXT NOT NULL,  -- NULL dispositions are stored as 'none'
+            dkim TEXT NOT NULL,
+            spf TEXT NOT NULL,
+            volume INTEGER NOT NULL DEFAULT 0,
+            report_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (domain, day, disposition, dkim, spf)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_daily_rollup_day ON daily_rollup(day)')
+    _update_rollup(c, "1=1", (), 1)
+
+
+def _migration_ingest_jobs(c):
+    """Durable queue for uploaded/fetched report files (see jobs.py)."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_path TEXT NOT NULL,
+            source TEXT,                -- 'upload', 'email', ...
+            status TEXT NOT NULL,       -- queued, running, done, failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after REAL NOT NULL,    -- unix time; retries are pushed back with backoff
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            parse_ms REAL,
+            save_ms REAL,
+            report_id INTEGER,
+            error TEXT
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs(status, run_after)')
+
+
+def _migration_import_checkpoints(c):
+    """Per-file progress of bulk imports, so an interrupted import can resume."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS import_checkpoints (
+            path TEXT PRIMARY KEY,      -- absolute path of the imported file (mail imports: see mail_import)
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,  -- a changed file is imported again
+            status TEXT NOT NULL,       -- imported, failed, empty (message without reports)
+            report_db_id INTEGER,
+            error TEXT,
+            imported_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _migration_raw_files(c):
+    """Content hashes of ingested report files, checked before parsing."""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS raw_files (
+            sha256 TEXT PRIMARY KEY,    -- hex digest of the file as received (compressed)
+            size INTEGER NOT NULL,
+            report_db_id INTEGER NOT NULL,
+            first_seen DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_raw_files_report ON raw_files(report_db_id)')
+
+
+def _add_column(c, table: str, column: str, decl: str):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists."""
+    columns = {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _migration_report_totals(c):
+    """Per-report message totals stored at ingest, and a change counter for caches."""
+    _add_column(c, "reports", "total_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(c, "reports", "pass_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(c, "reports", "fail_count", "INTEGER NOT NULL DEFAULT 0")
+    c.execute('''
+        UPDATE reports SET
+            total_count = COALESCE((SELECT SUM(count) FROM records WHERE report_id = reports.id), 0),
+            pass_count = COALESCE((SELECT SUM(count) FROM records
+                                   WHERE report_id = reports.id AND COALESCE(disposition, 'none') = 'none'), 0),
+            fail_count = COALESCE((SELECT SUM(count) FROM records
+                                   WHERE report_id = reports.id AND COALESCE(disposition, 'none') != 'none'), 0)
+    ''')
+    # Bumped by every report insert/delete (from any process), so per-process
+    # caches can tell whether their cached results are still current.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS data_generation (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )
+    ''')
+    c.execute("INSERT OR IGNORE INTO data_generation (id, value) VALUES (1, 0)")
+    for event in ("INSERT", "DELETE"):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS reports_generation_{event.lower()} AFTER {event} ON reports
+            BEGIN
+                UPDATE data_generation SET value = value + 1 WHERE id = 1;
+            END
+        ''')
+
+
+def _migration_reports_fts(c):
+    """FTS5 index over report names/ids/domains and source IPs for list search."""
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS reports_fts USING fts5(
+            org_name, report_id, domain, source_ips,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    # rowid = reports.id. Triggers follow the reports table; source_ips is
+    # filled by _insert_report once the report's records are written.
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS reports_fts_insert AFTER INSERT ON reports
+        BEGIN
+            INSERT INTO reports_fts (rowid, org_name, report_id, domain, source_ips)
+            VALUES (new.id, new.org_name, new.report_id, new.domain, '');
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS reports_fts_delete AFTER DELETE ON reports
+        BEGIN
+            DELETE FROM reports_fts WHERE rowid = old.id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS reports_fts_update AFTER UPDATE OF org_name, report_id, domain ON reports
+        BEGIN
+            UPDATE reports_fts SET org_name = new.org_name, report_id = new.report_id, domain = new.domain
+            WHERE rowid = new.id;
+        END
+    ''')
+    c.execute("DELETE FROM reports_fts")
+    c.execute('''
+        INSERT INTO reports_fts (rowid, org_name, report_id, domain, source_ips)
+        SELECT r.id, r.org_name, r.report_id, r.domain,
+               COALESCE((SELECT group_concat(ip, ' ') FROM (
+                   SELECT DISTINCT source_ip AS ip FROM records WHERE report_id = r.id
+               )), '')
+        FROM reports r
+    ''')
+
+
+def _migration_report_disposition_totals(c):
+    """Quarantine/reject volumes and record count per report, alongside the totals."""
+    _add_column(c, "reports", "quarantine_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(c, "reports", "reject_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(c, "reports", "record_count", "INTEGER NOT NULL DEFAULT 0")
+    c.execute('''
+        UPDATE reports SET
+            quarantine_count = COALESCE((SELECT SUM(count) FROM records
+                                         WHERE report_id = reports.id AND disposition = 'quarantine'), 0),
+            reject_count = COALESCE((SELECT SUM(count) FROM records
+                                     WHERE report_id = reports.id AND disposition = 'reject'), 0),
+            record_count = (SELECT COUNT(*) FROM records WHERE report_id = reports.id)
+    ''')
+
+
+def _migration_import_checkpoints_report(c):
+    """Look up import checkpoints by report, so deleting reports can clear them."""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_import_checkpoints_report ON import_checkpoints(report_db_id)')
+
+
+MIGRATIONS = [
+    _migration_hot_path_indexes,
+    _migration_daily_rollup,
+    _migration_ingest_jobs,
+    _migration_import_checkpoints,
+    _migration_raw_files,
+    _migration_report_totals,
+    _migration_reports_fts,
+    _migration_report_disposition_totals,
+    _migration_import_checkpoints_report,
+]
+
+
+def migrate(conn):
+    """Bring the schema up to len(MIGRATIONS). Safe to call from several processes at once."""
+    c = conn.cursor()
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if c.execute("PRAGMA user_version").fetchone()[0] >= version:
+            continue
+        # IMMEDIATE takes the write lock before re-checking, so concurrent
+        # starters apply each migration exactly once.
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            if c.execute("PRAGMA user_version").fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            migration(c)
+            c.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Applied schema migration {version}: {migration.__name__}")
+
 def _seed_default_user(conn):
     import bcrypt
     import secrets
@@ -131,10 +428,67 @@ def _seed_default_user(conn):
 
 
 
-def save_report(parsed_data):
-    conn = get_db()
-    c = conn.cursor()
-    
+SAVE_REPORTS_COMMIT_EVERY = int(os.environ.get('SAVE_REPORTS_COMMIT_EVERY', '500'))
+
+
+def _update_rollup(c, report_filter: str, params, sign: int):
+    """
+    Add (sign=1) or subtract (sign=-1) the reports matching report_filter
+    (a WHERE clause over `reports`) to/from daily_rollup.
+    Each report adds 1 to report_count of exactly one bucket - its first in
+    sort order - so SUM(report_count) over any set of rows counts every
+    report once. Must run while the reports' records still exist.
+    """
+    read = c.connection.cursor()
+    read.execute(f"""
+        SELECT
+            r.id,
+            COALESCE(r.domain, '') as domain,
+            COALESCE(DATE(r.date_end, 'unixepoch'), '') as day,
+            COALESCE(rec.disposition, 'none') as disposition,
+            COALESCE(rec.dkim, '') as dkim,
+            COALESCE(rec.spf, '') as spf,
+            COALESCE(SUM(rec.count), 0) as volume
+        FROM reports r
+        LEFT JOIN records rec ON rec.report_id = r.id
+        WHERE r.id IN (SELECT id FROM reports WHERE {report_filter})
+        GROUP BY r.id, 2, 3, 4, 5, 6
+        ORDER BY r.id, 2, 3, 4, 5, 6
+    """, params)
+
+    touched = []
+
+    def deltas():
+        last_id = None
+        for row in read:
+            first = row[0] != last_id
+            last_id = row[0]
+            key = tuple(row[1:6])
+            if sign < 0:
+                touched.append(key)
+            yield key + (sign * row[6], sign if first else 0)
+
+    c.executemany('''
+        INSERT INTO daily_rollup (domain, day, disposition, dkim, spf, volume, report_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (domain, day, disposition, dkim, spf) DO UPDATE SET
+            volume = volume + excluded.volume,
+            report_count = report_count + excluded.report_count
+    ''', deltas())
+    if touched:
+        c.executemany('''
+            DELETE FROM daily_rollup
+            WHERE domain = ? AND day = ? AND disposition = ? AND dkim = ? AND spf = ?
+              AND volume = 0 AND report_count = 0
+        ''', touched)
+
+
+def _insert_report(c, parsed_data):
+    """
+    Insert one parsed report inside the caller's transaction.
+    Returns (report_db_id, inserted); inserted is False when the report_id
+    was already stored and nothing was written.
+    """
     meta = parsed_data['metadata']
     policy = parsed_data['policy']
     
@@ -142,8 +496,7 @@ def save_report(parsed_data):
     c.execute("SELECT id FROM reports WHERE report_id = ?", (meta['report_id'],))
     existing = c.fetchone()
     if existing:
-        conn.close()
-        return existing['id'] # Already saved
+        return existing['id'], False # Already saved
     
     c.execute('''
         INSERT INTO reports (report_id, org_name, date_begin, date_end, domain, policy_published)
@@ -159,28 +512,223 @@ def save_report(parsed_data):
     
     report_db_id = c.lastrowid
     
-    for rec in parsed_data['records']:
-        c.execute('''
-            INSERT INTO records (report_id, source_ip, count, disposition, dkim, spf)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            report_db_id,
-            rec['source_ip'],
-            rec['count'],
-            rec['disposition'],
-            rec['dkim'],
-            rec['spf']
-        ))
+    # 'records' may be a list or a generator from parse_report_stream, so feed
+    # executemany lazily instead of building a list of rows first, adding up
+    # the per-report totals on the way through.
+    totals = {'total': 0, 'pass': 0, 'fail': 0, 'quarantine': 0, 'reject': 0, 'records': 0}
+    source_ips = {}
+
+    def rows():
+        for rec in parsed_data['records']:
+            source_ips[rec['source_ip']] = None
+            count = rec['count'] or 0
+            disposition = rec['disposition'] or 'none'
+            totals['records'] += 1
+            totals['total'] += count
+            totals['pass' if disposition == 'none' else 'fail'] += count
+            if disposition in ('quarantine', 'reject'):
+                totals[disposition] += count
+            yield (report_db_id, rec['source_ip'], rec['count'], rec['disposition'], rec['dkim'], rec['spf'])
+
+    c.executemany('''
+        INSERT INTO records (report_id, source_ip, count, disposition, dkim, spf)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', rows())
+    c.execute('''
+        UPDATE reports SET total_count = ?, pass_count = ?, fail_count = ?,
+            quarantine_count = ?, reject_count = ?, record_count = ?
+        WHERE id = ?
+    ''', (
+        totals['total'], totals['pass'], totals['fail'],
+        totals['quarantine'], totals['reject'], totals['records'], report_db_id,
+    ))
+    c.execute(
+        "UPDATE reports_fts SET source_ips = ? WHERE rowid = ?",
+        (" ".join(ip for ip in source_ips if ip), report_db_id),
+    )
+    _update_rollup(c, "id = ?", (report_db_id,), 1)
+    return report_db_id, True
+
+
+def save_report(parsed_data):
+    conn = get_db()
+    c = conn.cursor()
+    # A parse error part-way through a streamed report must not leave a
+    # half-written report behind.
+    try:
+        report_db_id, _ = _insert_report(c, parsed_data)
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
         
     conn.commit()
     conn.close()
     return report_db_id
 
+
+def save_reports(parsed_reports, commit_every: int = SAVE_REPORTS_COMMIT_EVERY) -> list:
+    """
+    Bulk ingest: save many parsed reports over one connection, committing
+    once every `commit_every` reports instead of once per report.
+    Duplicates (by report_id, including repeats inside the batch) are
+    skipped and resolve to the existing id. A report that fails to save is
+    rolled back on its own and logged; its slot in the result is None.
+    Returns the report DB ids in input order.
+    """
+    conn = get_db()
+    c = conn.cursor()
+    report_ids = []
+    pending = 0
+    try:
+        for parsed_data in parsed_reports:
+            # Open the batch transaction explicitly; releasing a savepoint
+            # outside of one would commit every report individually.
+            if not conn.in_transaction:
+                c.execute("BEGIN")
+            c.execute("SAVEPOINT save_report")
+            try:
+                report_db_id, _ = _insert_report(c, parsed_data)
+            except Exception as e:
+                c.execute("ROLLBACK TO SAVEPOINT save_report")
+                c.execute("RELEASE SAVEPOINT save_report")
+                logger.error(f"Failed to save report {parsed_data.get('metadata', {}).get('report_id')}: {e}")
+                report_ids.append(None)
+                continue
+            c.execute("RELEASE SAVEPOINT save_report")
+            report_ids.append(report_db_id)
+            pending += 1
+            if pending >= commit_every:
+                conn.commit()
+                pending = 0
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return report_ids
+
+def sha256_bytes(data: bytes) -> tuple[str, int]:
+    return hashlib.sha256(data).hexdigest(), len(data)
+
+
+def sha256_file(file_path) -> tuple[str, int]:
+    """Hash a raw report file without reading it into memory. Returns (hex digest, size)."""
+    with open(file_path, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256")
+        return digest.hexdigest(), f.tell()
+
+
+def find_raw_file(sha256: str) -> int | None:
+    """Return the report id a file with this content was already ingested as, or None."""
+    conn = get_db()
+    row = conn.execute("SELECT report_db_id FROM raw_files WHERE sha256 = ?", (sha256,)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def record_raw_file(sha256: str, size: int, report_db_id: int):
+    conn = get_db()
+    conn.execute(
+        "INSERT OR IGNORE INTO raw_files (sha256, size, report_db_id) VALUES (?, ?, ?)",
+        (sha256, size, report_db_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def find_raw_files(sha256s) -> dict[str, int]:
+    """find_raw_file for many hashes at once: {sha256: report id} for the known ones."""
+    sha256s = list(set(sha256s))
+    found = {}
+    conn = get_db()
+    for i in range(0, len(sha256s), 500):
+        chunk = sha256s[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        found.update(conn.execute(
+            f"SELECT sha256, report_db_id FROM raw_files WHERE sha256 IN ({placeholders})", chunk))
+    conn.close()
+    return found
+
+
+def record_raw_files(rows):
+    """record_raw_file for many (sha256, size, report_db_id) rows in one transaction."""
+    conn = get_db()
+    try:
+        conn.executemany("INSERT OR IGNORE INTO raw_files (sha256, size, report_db_id) VALUES (?, ?, ?)", rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _rollup_source(start_date=None, end_date=None) -> tuple[str, list]:
+    """
+    FROM source with daily_rollup's columns covering exactly the reports with
+    start_date <= date_end <= end_date. UTC days lying entirely inside the
+    range are read from daily_rollup; a partially covered first or last day is
+    aggregated from reports + records (a date_end index range of at most two
+    days), so the result matches filtering the reports themselves.
+    Returns (sql, params).
+    """
+    if start_date is None and end_date is None:
+        return "daily_rollup", []
+    start = None if start_date is None else int(start_date)
+    end = None if end_date is None else int(end_date)
+    # Midnight of the first and of the last day that the range covers completely
+    first_day = None if start is None else -(-start // 86400) * 86400
+    last_day = None if end is None else (end + 1) // 86400 * 86400 - 86400
+
+    parts, params, edges = [], [], []
+    if first_day is not None and last_day is not None and first_day > last_day:
+        edges.append((start, end))  # no whole day inside the range
+    else:
+        clauses = ["day <> ''"]
+        if first_day is not None:
+            clauses.append("day >= DATE(?, 'unixepoch')")
+            params.append(first_day)
+            if start < first_day:
+                edges.append((start, first_day - 1))
+        if last_day is not None:
+            clauses.append("day <= DATE(?, 'unixepoch')")
+            params.append(last_day)
+            if last_day + 86400 <= end:
+                edges.append((last_day + 86400, end))
+        parts.append(f"""
+            SELECT domain, day, disposition, dkim, spf, volume, report_count
+            FROM daily_rollup WHERE {' AND '.join(clauses)}
+        """)
+    for lo, hi in edges:
+        # Same buckets as _update_rollup, each report counted once in its first bucket
+        parts.append("""
+            SELECT COALESCE(r.domain, '') AS domain, DATE(r.date_end, 'unixepoch') AS day,
+                   COALESCE(rec.disposition, 'none') AS disposition,
+                   COALESCE(rec.dkim, '') AS dkim, COALESCE(rec.spf, '') AS spf,
+                   COALESCE(SUM(rec.count), 0) AS volume,
+                   ROW_NUMBER() OVER (PARTITION BY r.id ORDER BY COALESCE(rec.disposition, 'none'),
+                                      COALESCE(rec.dkim, ''), COALESCE(rec.spf, '')) = 1 AS report_count
+            FROM reports r
+            LEFT JOIN records rec ON rec.report_id = r.id
+            WHERE r.date_end BETWEEN ? AND ?
+            GROUP BY r.id, 3, 4, 5
+        """)
+        params.extend((lo, hi))
+    return "(" + " UNION ALL ".join(parts) + ")", params
+
+
 def get_stats(start_date=None, end_date=None):
+    """
+    Dashboard stats. Totals, the disposition split and the time series come
+    from daily_rollup for whole days; partial days at either end of the
+    range are read from reports, so the date filter is exact on date_end.
+    """
     conn = get_db()
     c = conn.cursor()
     
-    # Build Date Filter Clause
+    # Build Date Filter Clauses
     date_clause = ""
     params = []
     
@@ -194,68 +742,25 @@ def get_stats(start_date=None, end_date=None):
         date_clause = "WHERE date_end <= ?"
         params = [end_date]
             
-    # Total Reports
-    c.execute(f"SELECT COUNT(*) FROM reports {date_clause}", params)
-    total_reports = c.fetchone()[0]
-    
-    # Calculate volume and compliance
-    # We need to join with reports to filter by date
-    c.execute(f"""
-        SELECT SUM(rec.count) 
-        FROM records rec
-        JOIN reports r ON rec.report_id = r.id
-        {date_clause}
-    """, params)
-    total_volume = c.fetchone()[0] or 0
-    
-    c.execute(f"""
-        SELECT COALESCE(rec.disposition, 'none') as disposition, SUM(rec.count) 
-        FROM records rec
-        JOIN reports r ON rec.report_id = r.id
-        {date_clause}
-        GROUP BY disposition
-    """, params)
-    disposition_stats = {row[0]: row[1] for row in c.fetchall()}
-    
-    # Recent activity - Apply date filter here too if desired, or keep as "most recent regardless of filter"
-    # Typically "Recent Activity" respects the filter in dashboards.
-    # Recent activity - Reports with stats
-    c.execute(f"""
-        SELECT 
-            r.id, r.org_name, r.domain, r.created_at, r.date_end,
-            SUM(rec.count) as total_count,
-            SUM(CASE WHEN COALESCE(rec.disposition, 'none') = 'none' THEN rec.count ELSE 0 END) as pass_count,
-            SUM(CASE WHEN COALESCE(rec.disposition, 'none') != 'none' THEN rec.count ELSE 0 END) as fail_count
-        FROM reports r
-        JOIN records rec ON r.id = rec.report_id
-        {date_clause}
-        GROUP BY r.id
-        ORDER BY r.date_end DESC
-        LIMIT 10
-    """, params)
-    recent = [dict(row) for row in c.fetchall()]
-    
-    # Time Series Data for Graph
+    # Totals, disposition split and time series in one pass over the rollup
+    source, source_params = _rollup_source(start_date or None, end_date or None)
     c.execute(f"""
-        SELECT 
-            DATE(r.date_end, 'unixepoch') as day,
-            COALESCE(rec.disposition, 'none'),
-            SUM(rec.count)
-        FROM records rec
-        JOIN reports r ON rec.report_id = r.id
-        {date_clause}
-        GROUP BY day, rec.disposition
+        SELECT day, disposition, SUM(volume), SUM(report_count)
+        FROM {source}
+        GROUP BY day, disposition
         ORDER BY day ASC
-    """, params)
+    """, source_params)
     
     # Process into suitable format: [{"name": "YYYY-MM-DD", "pass": 123, "quarantine": 10, "reject": 5}, ...]
-    rows = c.fetchall()
+    total_reports = 0
+    total_volume = 0
+    disposition_stats = {}
     daily_data = {}
     
-    for row in rows:
-        day = row[0]
-        disposition = row[1]
-        count = row[2]
+    for day, disposition, count, report_count in c.fetchall():
+        total_reports += report_count
+        total_volume += count
+        disposition_stats[disposition] = disposition_stats.get(disposition, 0) + count
         
         if day not in daily_data:
             daily_data[day] = {"name": day, "pass": 0, "quarantine": 0, "reject": 0}
@@ -269,6 +774,19 @@ def get_stats(start_date=None, end_date=None):
             daily_data[day]["reject"] += count
             
     volume_series = list(daily_data.values())
+    
+    # Recent activity - Reports with stats (respects the date filter),
+    # using the per-report totals stored at ingest
+    c.execute(f"""
+        SELECT 
+            id, org_name, domain, created_at, date_end,
+            total_count, pass_count, fail_count
+        FROM reports
+        {date_clause}
+        ORDER BY date_end DESC
+        LIMIT 10
+    """, params)
+    recent = [dict(row) for row in c.fetchall()]
 
     conn.close()
     
@@ -280,67 +798,292 @@ def get_stats(start_date=None, end_date=None):
         'volume_series': volume_series
     }
 
-def get_reports_list(page=1, page_size=50, search=None, domain=None):
+# group_by value -> key expression over daily_rollup. Record-level groupings
+# (disposition/alignment) split a report across buckets, so they have no
+# per-group report count.
+SUMMARY_GROUPS = {
+    'day': "day",
+    'week': "DATE(day, '-6 days', 'weekday 1')",   # Monday of the ISO week
+    'month': "SUBSTR(day, 1, 7)",
+    'domain': "NULLIF(domain, '')",
+    'disposition': "disposition",
+    'dkim': "dkim",
+    'spf': "spf",
+    'alignment': "dkim || '/' || spf",
+    'org': None,  # not in the rollup; aggregated from reports + records
+}
+_RECORD_LEVEL_GROUPS = ('disposition', 'dkim', 'spf', 'alignment')
+
+
+def get_stats_summary(start_date=None, end_date=None, domain=None, group_by=None) -> dict:
+    """
+    Totals (and optionally one row per group) for a domain/date range in a
+    single aggregate query. Everything except org grouping reads
+    daily_rollup (see _rollup_source), so like get_stats the date filter is
+    exact on date_end.
+    Raises ValueError for an unknown group_by.
+    """
+    if group_by is not None and group_by not in SUMMARY_GROUPS:
+        raise ValueError(f"group_by must be one of: {', '.join(SUMMARY_GROUPS)}")
+
+    conn = get_db()
+    c = conn.cursor()
+    if group_by == 'org':
+        clauses, params = [], []
+        if start_date is not None:
+            clauses.append("r.date_end >= ?")
+            params.append(start_date)
+        if end_date is not None:
+            clauses.append("r.date_end <= ?")
+            params.append(end_date)
+        if domain:
+            clauses.append("r.domain = ?")
+            params.append(domain)
+        source = "reports r JOIN records rec ON rec.report_id = r.id"
+        key_expr = "r.org_name"
+        volume, disposition, dkim, spf = "rec.count", "COALESCE(rec.disposition, 'none')", "rec.dkim", "rec.spf"
+        reports_expr = "COUNT(DISTINCT r.id)"
+    else:
+        source, params = _rollup_source(start_date, end_date)
+        clauses = []
+        if domain:
+            clauses.append("domain = ?")
+            params.append(domain)
+        key_expr = SUMMARY_GROUPS[group_by] if group_by else "NULL"
+        volume, disposition, dkim, spf = "volume", "disposition", "dkim", "spf"
+        reports_expr = "SUM(report_count)"
+
+    where_clause = " AND ".join(clauses) if clauses else "1=1"
+    c.execute(f"""
+        SELECT {key_expr} AS grp,
+               {reports_expr} AS reports,
+               COALESCE(SUM({volume}), 0) AS volume,
+               COALESCE(SUM(CASE WHEN {disposition} = 'none' THEN {volume} END), 0) AS pass,
+               COALESCE(SUM(CASE WHEN {disposition} = 'quarantine' THEN {volume} END), 0) AS quarantine,
+               COALESCE(SUM(CASE WHEN {disposition} = 'reject' THEN {volume} END), 0) AS reject,
+               COALESCE(SUM(CASE WHEN {dkim} = 'pass' THEN {volume} END), 0) AS dkim_pass,
+               COALESCE(SUM(CASE WHEN {spf} = 'pass' THEN {volume} END), 0) AS spf_pass
+        FROM {source}
+        WHERE {where_clause}
+        GROUP BY grp
+        ORDER BY grp
+    """, params)
+    rows = c.fetchall()
+    conn.close()
+
+    metrics = ('reports', 'volume', 'pass', 'quarantine', 'reject', 'dkim_pass', 'spf_pass')
+    totals = {m: 0 for m in metrics}
+    groups = []
+    for row in rows:
+        entry = {m: row[m] or 0 for m in metrics}
+        entry['fail'] = entry['volume'] - entry['pass']
+        for m in metrics:
+            totals[m] += entry[m]
+        if group_by in _RECORD_LEVEL_GROUPS:
+            entry['reports'] = None
+        if group_by:
+            groups.append({'key': row['grp'], **entry})
+    totals['fail'] = totals['volume'] - totals['pass']
+    return {
+        'start': start_date,
+        'end': end_date,
+        'domain': domain,
+        'group_by': group_by,
+        'totals': totals,
+        'groups': groups,
+    }
+
+
+# Filtered report counts per process, keyed by filter and tagged with the
+# data_generation value they were computed at.
+_count_cache: dict[tuple, tuple[int, int]] = {}
+_COUNT_CACHE_MAX = 256
+_MAX_ROWID = 2 ** 63 - 1
+
+
+def get_data_generation(conn=None) -> int:
+    """
+    Current value of the report change counter (bumped on every ingest/delete).
+    It lives in the database, so caches in separate worker processes all see
+    the same value.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db()
+    row = conn.execute("SELECT value FROM data_generation WHERE id = 1").fetchone()
+    if own_conn:
+        conn.close()
+    return row[0] if row else 0
+
+
+def encode_report_cursor(date_end, report_db_id: int) -> str:
+    return f"{'' if date_end is None else date_end}:{report_db_id}"
+
+
+def decode_report_cursor(cursor: str) -> tuple[int | None, int]:
+    """Parse a cursor from encode_report_cursor; raises ValueError if malformed."""
+    date_end, sep, report_db_id = cursor.partition(":")
+    if not sep:
+        raise ValueError("Invalid cursor")
+    return (int(date_end) if date_end else None), int(report_db_id)
+
+
+def _fts_query(search: str) -> str | None:
+    """
+    Turn free text into an FTS5 query: every whitespace-separated term must
+    match as a prefix ("goog exam" finds google.com reports for example.com).
+    Terms are quoted, so FTS5 operators in user input are treated as text.
+    """
+    terms = [t for t in search.split() if any(ch.isalnum() for ch in t)]
+    if not terms:
+        return None
+    return " ".join('"' + t.replace('"', '""') + '"*' for t in terms)
+
+
+def get_reports_list(page=1, page_size=50, search=None, domain=None, cursor=None):
+    """
+    One page of reports, newest first, ordered by (date_end, id).
+    Pass the previous response's `next_cursor` as `cursor` to page by keyset
+    (constant cost at any depth); `page` alone falls back to OFFSET paging.
+    Totals come from the per-report columns filled at ingest.
+    """
     conn = get_db()
     c = conn.cursor()
-    
-    query = "SELECT r.id, r.report_id, r.org_name, r.domain, r.date_end, r.created_at FROM reports r"
-    count_query = "SELECT COUNT(*) FROM reports r"
 
     conditions = []
     params = []
     
-    if search:
-        conditions.append("(r.org_name LIKE ? OR r.report_id LIKE ? OR r.domain LIKE ?)")
-        params.extend([f"%{search}%", f"%{search}%", f"%{search}%"])
+    match = _fts_query(search) if search else None
+    if match:
+        conditions.append("r.id IN (SELECT rowid FROM reports_fts WHERE reports_fts MATCH ?)")
+        params.append(match)
         
     if domain:
         conditions.append("r.domain = ?")
         params.append(domain)
 
-        
-    if conditions:
-        clause = " WHERE " + " AND ".join(conditions)
-        query += clause
-        count_query += clause
-        
-    # Get total count
-    c.execute(count_query, params)
-    total = c.fetchone()[0]
-    
-    # Get paginated data
-    # Get paginated data with stats
-    # We need to reconstruct the query to include aggregation
-    full_query = f"""
-        SELECT 
-            r.id, r.report_id, r.org_name, r.domain, r.date_end, r.created_at,
-            SUM(rec.count) as total_count,
-            SUM(CASE WHEN COALESCE(rec.disposition, 'none') = 'none' THEN rec.count ELSE 0 END) as pass_count,
-            SUM(CASE WHEN COALESCE(rec.disposition, 'none') != 'none' THEN rec.count ELSE 0 END) as fail_count
-        FROM reports r
-        JOIN records rec ON r.id = rec.report_id
-    """
-    
-    if conditions:
-        full_query += " WHERE " + " AND ".join(conditions)
-        
-    # Add pagination (limit and offset) to the query
-    full_query += " GROUP BY r.id ORDER BY r.date_end DESC LIMIT ? OFFSET ?"
-    # Append pagination parameters to the existing params list
-    params.extend([page_size, (page - 1) * page_size])
-    c.execute(full_query, params)
-    rows = [dict(row) for row in c.fetchall()]
-    
+    # Get total count, cached until the next ingest/delete
+    cache_key = (search, domain)
+    generation = get_data_generation(conn)
+    cached = _count_cache.get(cache_key)
+    if cached and cached[0] == generation:
+        total = cached[1]
+    else:
+        count_query = "SELECT COUNT(*) FROM reports r"
+        if conditions:
+            count_query += " WHERE " + " AND ".join(conditions)
+        c.execute(count_query, params)
+        total = c.fetchone()[0]
+        if len(_count_cache) >= _COUNT_CACHE_MAX:
+            _count_cache.clear()
+        _count_cache[cache_key] = (generation, total)
+
+    columns = (
+        "r.id, r.report_id, r.org_name, r.domain, r.date_end, r.created_at, "
+        "r.total_count, r.pass_count, r.fail_count, r.quarantine_count, r.reject_count, r.record_count"
+    )
+
+    # Same order in every branch so the (date_end, rowid) indexes serve it
+    order = "r.date_end DESC, r.id DESC"
+
+    def fetch(extra_conditions, extra_params, order, limit, offset=0):
+        where = conditions + extra_conditions
+        query = f"SELECT {columns} FROM reports r"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += f" ORDER BY {order} LIMIT ? OFFSET ?"
+        c.execute(query, params + extra_params + [limit, offset])
+        return [dict(row) for row in c.fetchall()]
+
+    if cursor:
+        after_date, after_id = decode_report_cursor(cursor)
+        rows = []
+        if after_date is not None:
+            rows = fetch(["(r.date_end, r.id) < (?, ?)"], [after_date, after_id], order, page_size)
+            # Reports without a date sort last; continue into them once the dated ones run out
+            after_id = _MAX_ROWID
+        if len(rows) < page_size:
+            rows += fetch(["r.date_end IS NULL", "r.id < ?"], [after_id], order, page_size - len(rows))
+    else:
+        rows = fetch([], [], order, page_size, (page - 1) * page_size)
+
     conn.close()
+
+    next_cursor = None
+    if len(rows) == page_size:
+        next_cursor = encode_report_cursor(rows[-1]['date_end'], rows[-1]['id'])
     
     return {
         "items": rows,
         "total": total,
         "page": page,
         "page_size": page_size,
-        "pages": (total + page_size - 1) // page_size
+        "pages": (total + page_size - 1) // page_size,
+        "next_cursor": next_cursor,
     }
 
+EXPORT_COLUMNS = (
+    'report_id', 'org_name', 'domain', 'date_begin', 'date_end',
+    'source_ip', 'count', 'disposition', 'dkim', 'spf',
+)
+
+
+def iter_export_records(start_date=None, end_date=None, domain=None, disposition=None,
+                        batch_size: int = 1000):
+    """
+    Stream record-level rows (EXPORT_COLUMNS tuples) in batches of up to
+    `batch_size`, ordered by report date. Uses its own connection and a
+    server-side cursor, so memory stays bounded however many rows match.
+    The connection may be driven from different threads (one batch at a
+    time); close the generator to release it early.
+    """
+    clauses = []
+    params = []
+    if start_date is not None:
+        clauses.append('r.date_end >= ?')
+        params.append(start_date)
+    if end_date is not None:
+        clauses.append('r.date_end <= ?')
+        params.append(end_date)
+    if domain:
+        clauses.append('r.domain = ?')
+        params.append(domain)
+    if disposition:
+        clauses.append("COALESCE(rec.disposition, 'none') = ?")
+        params.append(disposition)
+    where_clause = ' AND '.join(clauses) if clauses else '1=1'
+
+    conn = _connect(check_same_thread=False)
+    try:
+        c = conn.execute(f"""
+            SELECT r.report_id, r.org_name, r.domain, r.date_begin, r.date_end,
+                   rec.source_ip, rec.count, rec.disposition, rec.dkim, rec.spf
+            FROM reports r
+            JOIN records rec ON rec.report_id = r.id
+            WHERE {where_clause}
+            ORDER BY r.date_end, r.id
+        """, params)
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [tuple(row) for row in rows]
+    finally:
+        sqlite3.Connection.close(conn)
+
+
+def get_report_summary(report_db_id: int) -> dict | None:
+    """A report's row with its stored totals, without loading its records."""
+    conn = get_db()
+    row = conn.execute('''
+        SELECT id, report_id, org_name, domain, date_end, total_count, pass_count, fail_count,
+               quarantine_count, reject_count, record_count
+        FROM reports WHERE id = ?
+    ''', (report_db_id,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
 def get_report_detail(report_identifier):
     conn = get_db()
     c = conn.cursor()
@@ -410,10 +1153,20 @@ def delete_reports(start_date=None, end_date=None, domain=None, org_name=None, d
         return 0
 
     placeholders = ",".join(["?"] * len(report_ids))
-    c.execute(f"DELETE FROM records WHERE report_id IN ({placeholders})", report_ids)
-    c.execute(f"DELETE FROM reports WHERE id IN ({placeholders})", report_ids)
+    try:
+        _update_rollup(c, f"id IN ({placeholders})", report_ids, -1)
+        c.execute(f"DELETE FROM records WHERE report_id IN ({placeholders})", report_ids)
+        # Forget the file hashes and import checkpoints too, so the same
+        # files (or mail messages) can be imported again
+        c.execute(f"DELETE FROM raw_files WHERE report_db_id IN ({placeholders})", report_ids)
+        c.execute(f"DELETE FROM import_checkpoints WHERE report_db_id IN ({placeholders})", report_ids)
+        c.execute(f"DELETE FROM reports WHERE id IN ({placeholders})", report_ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
     deleted = len(report_ids)
-    conn.commit()
     conn.close()
     return deleted
 def get_domain_stats():
@@ -421,19 +1174,29 @@ def get_domain_stats():
     conn = get_db()
     c = conn.cursor()
     
+    # Totals from daily_rollup; last_seen is the exact MAX(date_end), one
+    # seek per domain on idx_reports_domain (domain, date_end)
     c.execute("""
-        SELECT 
-            r.domain,
-            COUNT(DISTINCT r.id) as report_count,
-            MAX(r.date_end) as last_seen,
-            SUM(rec.count) as total_volume,
-            SUM(CASE WHEN COALESCE(rec.disposition, 'none') = 'none' THEN rec.count ELSE 0 END) as pass_count,
-            SUM(CASE WHEN COALESCE(rec.disposition, 'none') = 'quarantine' THEN rec.count ELSE 0 END) as quarantine_count,
-            SUM(CASE WHEN COALESCE(rec.disposition, 'none') = 'reject' THEN rec.count ELSE 0 END) as reject_count
-        FROM reports r
-        JOIN records rec ON r.id = rec.report_id
-        GROUP BY r.domain
-        ORDER BY report_count DESC
+        SELECT
+            NULLIF(g.domain, '') as domain,
+            g.report_count,
+            CASE WHEN g.domain = ''
+                THEN (SELECT MAX(date_end) FROM reports WHERE domain IS NULL OR domain = '')
+                ELSE (SELECT MAX(date_end) FROM reports WHERE domain = g.domain)
+            END as last_seen,
+            g.total_volume, g.pass_count, g.quarantine_count, g.reject_count
+        FROM (
+            SELECT
+                domain,
+                SUM(report_count) as report_count,
+                SUM(volume) as total_volume,
+                SUM(CASE WHEN disposition = 'none' THEN volume ELSE 0 END) as pass_count,
+                SUM(CASE WHEN disposition = 'quarantine' THEN volume ELSE 0 END) as quarantine_count,
+                SUM(CASE WHEN disposition = 'reject' THEN volume ELSE 0 END) as reject_count
+            FROM daily_rollup
+            GROUP BY domain
+        ) g
+        ORDER BY g.report_count DESC
     """)
     
     rows = [dict(row) for row in c.fetchall()]
@@ -449,6 +1212,59 @@ def get_user_profile(user_id=1):
     return dict(user) if user else None
 
 
+# ============================================================================
+# Credential cache
+# ============================================================================
+
+# ('key', key_hash) / ('user', username) -> (expires_at, api key id or None, user dict)
+_auth_cache: dict[tuple[str, str], tuple[float, int | None, dict]] = {}
+_auth_cache_lock = threading.Lock()
+_AUTH_CACHE_MAX = 1024
+
+
+def _auth_cache_get(cache_key) -> tuple[int | None, dict] | None:
+    with _auth_cache_lock:
+        entry = _auth_cache.get(cache_key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del _auth_cache[cache_key]
+            return None
+        return entry[1], dict(entry[2])
+
+
+def _auth_cache_put(cache_key, key_id: int | None, user: dict):
+    if AUTH_CACHE_TTL <= 0:
+        return
+    with _auth_cache_lock:
+        if len(_auth_cache) >= _AUTH_CACHE_MAX:
+            _auth_cache.clear()
+        _auth_cache[cache_key] = (time.monotonic() + AUTH_CACHE_TTL, key_id, dict(user))
+
+
+def invalidate_auth_cache(user_id: int | None = None, key_id: int | None = None):
+    """Drop cached principals for a user and/or API key (everything when both are None)."""
+    with _auth_cache_lock:
+        if user_id is None and key_id is None:
+            _auth_cache.clear()
+            return
+        for cache_key, (_, cached_key_id, user) in list(_auth_cache.items()):
+            if (user_id is not None and user.get('id') == user_id) or \
+                    (key_id is not None and cached_key_id == key_id):
+                del _auth_cache[cache_key]
+
+
+def get_user_by_username_cached(username):
+    """get_user_by_username for per-request auth, served from the credential cache."""
+    cached = _auth_cache_get(('user', username))
+    if cached is not None:
+        return cached[1]
+    user = get_user_by_username(username)
+    if user:
+        _auth_cache_put(('user', username), None, user)
+    return user
+
+
 def get_user_by_username(username):
     """Fetch user by username for login."""
     conn = get_db()
@@ -496,6 +1312,7 @@ def delete_user(user_id):
     c.execute("DELETE FROM users WHERE id = ?", (user_id,))
     conn.commit()
     conn.close()
+    invalidate_auth_cache(user_id=user_id)
     return True
 
 def update_user_profile(user_id, data):
@@ -534,6 +1351,7 @@ def update_user_profile(user_id, data):
     conn.commit()
 
     conn.close()
+    invalidate_auth_cache(user_id=user_id)
     return True
 
 
@@ -574,6 +1392,11 @@ def get_api_keys_for_user(user_id: int) -> list[dict]:
     ''', (user_id,))
     keys = [dict(row) for row in c.fetchall()]
     conn.close()
+    # Show usage that has not been flushed to the table yet
+    with _last_used_lock:
+        for key in keys:
+            if key['id'] in _pending_last_used:
+                key['last_used_at'] = _pending_last_used[key['id']]
     return keys
 
 
@@ -594,16 +1417,64 @@ def delete_api_key(key_id: int, user_id: int = None) -> bool:
     deleted = c.rowcount > 0
     conn.commit()
     conn.close()
+    if deleted:
+        invalidate_auth_cache(key_id=key_id)
+        with _last_used_lock:
+            _pending_last_used.pop(key_id, None)
     return deleted
 
 
+# api key id -> last use time ('YYYY-MM-DD HH:MM:SS' UTC, like CURRENT_TIMESTAMP),
+# written to api_keys in one batch by flush_api_key_usage()
+_pending_last_used: dict[int, str] = {}
+_last_used_lock = threading.Lock()
+
+
+def _note_api_key_use(key_id: int):
+    now = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    with _last_used_lock:
+        _pending_last_used[key_id] = now
+
+
+def flush_api_key_usage() -> int:
+    """Write the buffered last_used_at times in one transaction. Returns keys updated."""
+    with _last_used_lock:
+        pending = list(_pending_last_used.items())
+        _pending_last_used.clear()
+    if not pending:
+        return 0
+    conn = get_db()
+    try:
+        conn.executemany(
+            "UPDATE api_keys SET last_used_at = ? WHERE id = ?",
+            [(used_at, key_id) for key_id, used_at in pending],
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # Keep the timestamps for the next attempt unless newer ones arrived
+        with _last_used_lock:
+            for key_id, used_at in pending:
+                _pending_last_used.setdefault(key_id, used_at)
+        raise
+    finally:
+        conn.close()
+    return len(pending)
+
+
 def get_user_by_api_key(raw_key: str) -> dict | None:
     """
     Look up a user by their API key.
-    Updates the last_used_at timestamp if found.
+    Records the use for last_used_at (buffered, see flush_api_key_usage).
     Returns the user dict or None.
     """
     key_hash = _hash_api_key(raw_key)
+
+    cached = _auth_cache_get(('key', key_hash))
+    if cached is not None:
+        key_id, user = cached
+        _note_api_key_use(key_id)
+        return user
     
     conn = get_db()
     c = conn.cursor()
@@ -617,23 +1488,15 @@ def get_user_by_api_key(raw_key: str) -> dict | None:
     ''', (key_hash,))
     
     row = c.fetchone()
+    conn.close()
     if not row:
-        conn.close()
         return None
     
-    key_id = row['key_id']
-    
-    # Update last_used_at
-    c.execute('''
-        UPDATE api_keys SET last_used_at = CURRENT_TIMESTAMP WHERE id = ?
-    ''', (key_id,))
-    conn.commit()
-    
     # Return user data (exclude key_id from user dict)
     user = dict(row)
-    del user['key_id']
-    conn.close()
-    
+    key_id = user.pop('key_id')
+    _auth_cache_put(('key', key_hash), key_id, user)
+    _note_api_key_use(key_id)
     return user
 
 
@@ -1,75 +1,367 @@
-import imaplib
+import base64
+import binascii
 import email
+import email.header
+import email.policy
+import email.utils
+import imaplib
 import logging
 import os
-from pathlib import Path
-from typing import List
-from .db import get_setting
+import quopri
+import re
+import urllib.parse
+from typing import Iterator, List
+from .db import find_raw_file, get_setting, set_setting, sha256_bytes
 
 logger = logging.getLogger(__name__)
 
-# Re-use UPLOAD_DIR logic from api if possible, or just define here
-UPLOAD_DIR = Path("backend/uploads")
+REPORT_EXTENSIONS = ('.xml', '.zip', '.gz', '.xz')
+# Messages per UID FETCH command (one round trip for the whole batch)
+IMAP_FETCH_BATCH = int(os.environ.get("IMAP_FETCH_BATCH", "200"))
+IMAP_TIMEOUT = float(os.environ.get("IMAP_TIMEOUT", "60"))
+
+
+def is_report_filename(filename: str | None) -> bool:
+    """The attachment filter shared by IMAP sync and local mail imports."""
+    return bool(filename) and filename.lower().endswith(REPORT_EXTENSIONS)
+
+
+def extract_report_attachments(message: bytes) -> List[tuple[str, bytes]]:
+    """
+    Decode a raw RFC 822 message and return its report attachments as
+    (filename, payload) pairs. Forwarded (message/rfc822) parts are searched too.
+    """
+    msg = email.message_from_bytes(message, policy=email.policy.compat32)
+    attachments = []
+    for part in msg.walk():
+        if part.is_multipart():
+            continue
+        filename = _decode_filename(part.get_filename())
+        if not is_report_filename(filename):
+            continue
+        payload = part.get_payload(decode=True)
+        if payload:
+            attachments.append((filename, payload))
+    return attachments
+
+
+# --- IMAP response parsing ---
+
+_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))', re.S)
+
+
+def _parse_sexp(data) -> list:
+    """
+    Parse imaplib FETCH data into nested lists. `data` mixes plain response
+    lines with (head, literal) tuples for {n} literals; literals are kept as
+    bytes, quoted strings and atoms become str, NIL becomes None.
+    """
+    stack = [[]]
+
+    def feed(buf: bytes):
+        pos = 0
+        while True:
+            m = _TOKEN_RE.match(buf, pos)
+            if not m:
+                return
+            pos = m.end()
+            if m.group(1):
+                stack.append([])
+            elif m.group(2):
+                if len(stack) > 1:
+                    done = stack.pop()
+                    stack[-1].append(done)
+            elif m.group(3) is not None:
+                stack[-1].append(re.sub(rb'\\(.)', rb'\1', m.group(3)).decode('utf-8', 'replace'))
+            else:
+                atom = m.group(4).decode('utf-8', 'replace')
+                stack[-1].append(None if atom.upper() == 'NIL' else atom)
+
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            feed(re.sub(rb'\{\d+\}$', b'', head))
+            stack[-1].append(literal)
+        elif item:
+            feed(item)
+    while len(stack) > 1:  # tolerate a truncated response
+        done = stack.pop()
+        stack[-1].append(done)
+    return stack[0]
+
+
+def _str(value) -> str | None:
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+
 
-def fetch_dmarc_reports() -> List[str]:
+def _fetch_items(data) -> list[dict]:
+    """Turn a UID FETCH response into one {ITEM: value} dict per message."""
+    messages = []
+    for token in _parse_sexp(data):
+        if isinstance(token, list):
+            # Alternating item names and values, e.g. UID 7 BODY[2] <literal>
+            items = {}
+            for name, value in zip(token[::2], token[1::2]):
+                if isinstance(name, str):
+                    items[name.upper()] = value
+            messages.append(items)
+    return messages
+
+
+def _decode_filename(value) -> str | None:
+    value = _str(value)
+    if not value:
+        return None
+    try:
+        return str(email.header.make_header(email.header.decode_header(value)))
+    except Exception:
+        return value
+
+
+def _params(plist) -> dict[str, str]:
+    """Body parameter list ("NAME" "value" ...) as a lowercase-key dict, RFC 2231 aware."""
+    params = {}
+    if isinstance(plist, list):
+        for key, value in zip(plist[::2], plist[1::2]):
+            key, value = _str(key), _str(value)
+            if key and value is not None:
+                params[key.lower()] = value
+    for key in [k for k in params if k.endswith('*')]:
+        # filename*=utf-8''report.xml.gz
+        charset, _, encoded = email.utils.decode_rfc2231(params[key])
+        params[key[:-1]] = urllib.parse.unquote(encoded, encoding=charset or 'utf-8', errors='replace')
+    return params
+
+
+def _part_filename(part: list) -> str | None:
+    # Disposition sits at a type-dependent offset in the extension data, so look for it
+    for field in part[7:]:
+        if (isinstance(field, list) and len(field) == 2 and isinstance(_str(field[0]), str)
+                and _str(field[0]).lower() in ('attachment', 'inline')):
+            name = _params(field[1]).get('filename')
+            if name:
+                return _decode_filename(name)
+    return _decode_filename(_params(part[2]).get('name'))
+
+
+def _report_sections(structure, section: str = "") -> list[tuple[str, str, str]]:
     """
-    Connect to IMAP and download DMARC attachments.
-    Returns a list of saved file names.
+    Walk a BODYSTRUCTURE and return (section, filename, transfer encoding) for
+    every part that looks like a DMARC report attachment. Encapsulated
+    messages (forwarded reports) are descended into.
+    """
+    if not isinstance(structure, list) or not structure:
+        return []
+    if isinstance(structure[0], list):
+        # multipart: child parts first, then the subtype
+        found = []
+        n = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            n += 1
+            found += _report_sections(child, f"{section}.{n}" if section else str(n))
+        return found
+
+    section = section or "1"
+    if len(structure) < 7:
+        return []
+    main_type = (_str(structure[0]) or "").lower()
+    sub_type = (_str(structure[1]) or "").lower()
+    if main_type == 'message' and sub_type == 'rfc822' and len(structure) > 8:
+        inner = structure[8]
+        if isinstance(inner, list) and inner and isinstance(inner[0], list):
+            return _report_sections(inner, section)
+        return _report_sections(inner, f"{section}.1")
+
+    filename = _part_filename(structure)
+    if is_report_filename(filename):
+        return [(section, filename, (_str(structure[5]) or '7bit').lower())]
+    return []
+
+
+def _decode_payload(payload: str | bytes, encoding: str) -> bytes:
+    raw = payload.encode('utf-8') if isinstance(payload, str) else payload
+    if encoding == 'base64':
+        return base64.b64decode(raw)
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(raw)
+    return raw
+
+
+def _uid_set(uids: list[int]) -> str:
+    """Compact IMAP sequence set: [1, 2, 3, 7] -> '1:3,7'."""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+def _quote_mailbox(name: str) -> str:
+    if re.fullmatch(r'[\w./-]+', name):
+        return name
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _check(status, data, what: str):
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"{what} failed: {data}")
+
+
+# --- Sync ---
+
+def sync_state_key(host: str, user: str, mailbox: str) -> str:
+    return f"imap_sync:{user}@{host}/{mailbox}"
+
+
+def _is_new(filename: str, payload: bytes, seen_hashes: set) -> bool:
+    # Skip attachments already ingested (re-fetches, forwarded copies)
+    sha256, _ = sha256_bytes(payload)
+    if sha256 in seen_hashes or find_raw_file(sha256) is not None:
+        logger.info(f"Skipping duplicate DMARC attachment: {filename}")
+        return False
+    seen_hashes.add(sha256)
+    return True
+
+
+def sync_mailbox(mail, state_key: str, mailbox: str = "INBOX", batch_size: int = IMAP_FETCH_BATCH,
+                 stats: dict | None = None) -> Iterator[tuple[List[tuple[str, bytes]], dict]]:
+    """
+    Download report attachments from messages that arrived since the last
+    sync of `mailbox` on a logged-in IMAP connection. Yields (attachments,
+    checkpoint) per batch of `batch_size` UIDs: the batch's decoded
+    (filename, payload) pairs and the position to resume from after it. If
+    `stats` is given, 'messages', 'attachments' and 'bytes' are added to it
+    as batches are fetched.
+
+    Progress is tracked by UID in settings[state_key] as {uidvalidity,
+    last_uid}, so read/unread flags are irrelevant and nothing is marked
+    seen. Nothing is written here: pass each checkpoint to
+    commit_checkpoint() once that batch's attachments are queued or saved.
+    A sync that fails part way keeps the batches committed before it and
+    fetches the rest again next time.
+
+    Each batch costs two round trips: BODYSTRUCTURE for the whole batch,
+    then BODY.PEEK[section] for just the report attachments. A changed
+    UIDVALIDITY restarts from the beginning; content hashes keep
+    already-ingested attachments from being saved again.
+    """
+    status, data = mail.select(_quote_mailbox(mailbox), readonly=True)
+    _check(status, data, f"SELECT {mailbox}")
+    uidvalidity = int(mail.response('UIDVALIDITY')[1][0])
+
+    state = get_setting(state_key) or {}
+    last_uid = state.get('last_uid', 0) if state.get('uidvalidity') == uidvalidity else 0
+    if state and state.get('uidvalidity') != uidvalidity:
+        logger.warning(f"UIDVALIDITY of {mailbox} changed; resyncing the whole mailbox")
+
+    status, data = mail.uid('SEARCH', 'UID', f'{last_uid + 1}:*')
+    _check(status, data, "UID SEARCH")
+    # "n:*" always matches the newest message, even when its UID is below n
+    uids = sorted(uid for uid in map(int, (data[0] or b'').split()) if uid > last_uid)
+    if not uids and state.get('uidvalidity') != uidvalidity:
+        # Nothing to fetch, but the new UIDVALIDITY is still worth recording
+        yield [], {'key': state_key, 'uidvalidity': uidvalidity, 'last_uid': 0}
+        return
+
+    seen_hashes = set()
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        attachments = []
+        status, data = mail.uid('FETCH', _uid_set(batch), '(UID BODYSTRUCTURE)')
+        _check(status, data, "UID FETCH BODYSTRUCTURE")
+
+        # Messages with the same attachment layout (usually all of them) share one FETCH
+        wanted: dict[tuple, list[int]] = {}
+        parts: dict[int, list[tuple[str, str, str]]] = {}
+        for item in _fetch_items(data):
+            if 'UID' not in item:
+                continue
+            sections = _report_sections(item.get('BODYSTRUCTURE'))
+            if sections:
+                uid = int(item['UID'])
+                parts[uid] = sections
+                wanted.setdefault(tuple(s for s, _, _ in sections), []).append(uid)
+
+        for sections, group in wanted.items():
+            query = "(UID " + " ".join(f"BODY.PEEK[{s}]" for s in sections) + ")"
+            status, data = mail.uid('FETCH', _uid_set(group), query)
+            _check(status, data, "UID FETCH BODY.PEEK")
+            for item in _fetch_items(data):
+                if 'UID' not in item or int(item['UID']) not in parts:
+                    continue
+                uid = int(item['UID'])
+                for section, filename, encoding in parts[uid]:
+                    payload = item.get(f'BODY[{section}]')
+                    if payload is None:
+                        logger.warning(f"Message UID {uid} returned no data for part {section}")
+                        continue
+                    try:
+                        content = _decode_payload(payload, encoding)
+                    except (binascii.Error, ValueError) as e:
+                        logger.warning(f"Could not decode {filename} in message UID {uid}: {e}")
+                        continue
+                    if stats is not None:
+                        stats['bytes'] = stats.get('bytes', 0) + len(content)
+                    if _is_new(filename, content, seen_hashes):
+                        logger.info(f"Downloaded DMARC report from email: {filename}")
+                        attachments.append((filename, content))
+
+        if stats is not None:
+            stats['messages'] = stats.get('messages', 0) + len(batch)
+            stats['attachments'] = stats.get('attachments', 0) + len(attachments)
+        yield attachments, {'key': state_key, 'uidvalidity': uidvalidity, 'last_uid': batch[-1]}
+
+
+def commit_checkpoint(checkpoint: dict | None):
+    """Record a sync_mailbox checkpoint: the next sync starts after its last UID."""
+    if checkpoint:
+        set_setting(checkpoint['key'], {'uidvalidity': checkpoint['uidvalidity'], 'last_uid': checkpoint['last_uid']})
+
+
+def connect(host: str, port: int, user: str, password: str, use_ssl: bool = True,
+            timeout: float | None = IMAP_TIMEOUT):
+    """Open and log in to an IMAP server."""
+    if use_ssl:
+        mail = imaplib.IMAP4_SSL(host, port, timeout=timeout)
+    else:
+        mail = imaplib.IMAP4(host, port, timeout=timeout)
+    try:
+        mail.login(user, password)
+    except Exception:
+        mail.shutdown()
+        raise
+    return mail
+
+
+def fetch_dmarc_reports() -> Iterator[tuple[List[tuple[str, bytes]], dict]]:
+    """
+    Connect to the IMAP account in settings (imap_host/imap_user/...) and
+    download DMARC attachments received since the last fetch.
+    Yields (filename, payload bytes) pairs and the sync checkpoint per batch
+    (see sync_mailbox); call commit_checkpoint() with each checkpoint once
+    its attachments are queued. Errors are logged and end the fetch.
     """
     host = get_setting("imap_host")
     user = get_setting("imap_user")
     pwd = get_setting("imap_pass")
     port = get_setting("imap_port", 993)
     use_ssl = get_setting("imap_use_ssl", True)
+    mailbox = get_setting("imap_mailbox", "INBOX")
 
     if not all([host, user, pwd]):
         logger.warning("IMAP settings incomplete.")
-        return []
+        return
 
-    saved_files = []
     try:
-        if use_ssl:
-            mail = imaplib.IMAP4_SSL(host, port)
-        else:
-            mail = imaplib.IMAP4(host, port)
-        
-        mail.login(user, pwd)
-        mail.select("inbox")
-
-        # Search for unread emails with "dmarc" in subject or attachments
-        # We'll search for all and filter in python for better reliability
-        status, messages = mail.search(None, 'UNSEEN')
-        if status != "OK":
-            return []
-
-        for num in messages[0].split():
-            status, data = mail.fetch(num, '(RFC822)')
-            if status != "OK":
-                continue
-            
-            raw_email = data[0][1]
-            msg = email.message_from_bytes(raw_email)
-            
-            for part in msg.walk():
-                if part.get_content_maintype() == 'multipart':
-                    continue
-                if part.get('Content-Disposition') is None:
-                    continue
-                
-                filename = part.get_filename()
-                if filename:
-                    lower_fn = filename.lower()
-                    if lower_fn.endswith(('.xml', '.zip', '.gz', '.xz')):
-                        # Save the attachment
-                        UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-                        filepath = UPLOAD_DIR / filename
-                        with open(filepath, 'wb') as f:
-                            f.write(part.get_payload(decode=True))
-                        saved_files.append(filename)
-                        logger.info(f"Downloaded DMARC report from email: {filename}")
-
-        mail.logout()
+        mail = connect(host, port, user, pwd, use_ssl)
+        try:
+            yield from sync_mailbox(mail, sync_state_key(host, user, mailbox), mailbox)
+        finally:
+            mail.logout()
     except Exception as e:
+        # Batches after the last committed checkpoint are fetched again next time
         logger.error(f"Failed to fetch DMARC reports via IMAP: {e}")
-
-    return saved_files
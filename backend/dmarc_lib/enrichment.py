@@ -1,42 +1,70 @@
-import socket
+import os
+import time
 import httpx
 import asyncio
 import logging
 from .db import get_db
+from .geoip import get_geoip_db
+from .rdns import get_reverse_resolver
 
 logger = logging.getLogger(__name__)
 
+# Query ip-api.com for IPs the local range DB (GEOIP_DB_PATH) does not cover.
+# Set to false on hosts without outbound network access.
+GEOIP_HTTP_FALLBACK = os.environ.get("GEOIP_HTTP_FALLBACK", "true").lower() in ("1", "true", "yes")
+
+# ip-api.com endpoint and its free-tier limits (45 single / 15 batch requests per minute)
+IP_API_URL = os.environ.get("IP_API_URL", "http://ip-api.com")
+IP_API_RATE_PER_MINUTE = int(os.environ.get("IP_API_RATE_PER_MINUTE", "45"))
+IP_API_BATCH_RATE_PER_MINUTE = int(os.environ.get("IP_API_BATCH_RATE_PER_MINUTE", "15"))
+IP_API_BATCH_SIZE = 100  # provider maximum per POST /batch
+IP_API_FIELDS = "status,country,countryCode,city,as,query"
+
 async def get_rdns(ip: str) -> str | None:
     """Perform a reverse DNS lookup asynchronously."""
-    try:
-        loop = asyncio.get_event_loop()
-        # run_in_executor with None uses the default ThreadPoolExecutor
-        result = await loop.run_in_executor(None, socket.gethostbyaddr, ip)
-        return result[0]
-    except (socket.herror, socket.gaierror, socket.timeout, IndexError):
-        return None
+    return await get_reverse_resolver().resolve(ip)
 
-async def enrich_ip(ip: str, force_refresh: bool = False) -> dict:
-    """
-    Returns enriched data for an IP address.
-    Checks cache first unless force_refresh is True.
-    """
-    # Quick validation
-    if not ip or ":" in ip and not "." in ip: # Basic IPv6 check
-        # For now, we mainly support IPv4 or combined. ip-api supports both.
-        pass
+# SQLite caps bound parameters per statement; stay well below it
+CACHE_LOOKUP_CHUNK = 500
 
+def _load_cached(ips: list[str]) -> dict[str, dict]:
+    """Fetch cached enrichment rows for many IPs with chunked IN (...) queries."""
     conn = get_db()
     c = conn.cursor()
-    
-    if not force_refresh:
-        c.execute("SELECT * FROM ip_enrichment WHERE ip = ?", (ip,))
-        cached = c.fetchone()
-        if cached:
-            conn.close()
-            return dict(cached)
+    cached = {}
+    for i in range(0, len(ips), CACHE_LOOKUP_CHUNK):
+        chunk = ips[i:i + CACHE_LOOKUP_CHUNK]
+        placeholders = ",".join(["?"] * len(chunk))
+        c.execute(f"SELECT * FROM ip_enrichment WHERE ip IN ({placeholders})", chunk)
+        for row in c.fetchall():
+            cached[row['ip']] = dict(row)
+    conn.close()
+    return cached
 
-    # Perform enrichment
+def _save_enrichment(rows: list[dict]):
+    """Write freshly enriched rows to the cache in a single transaction."""
+    conn = get_db()
+    try:
+        conn.executemany('''
+            INSERT OR REPLACE INTO ip_enrichment 
+            (ip, rdns, country_code, country_name, city, asn, asn_name, last_updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', [(
+            data["ip"], data["rdns"], data["country_code"], data["country_name"],
+            data["city"], data["asn"], data["asn_name"]
+        ) for data in rows])
+        conn.commit()
+    finally:
+        conn.close()
+
+async def _store(rows: list[dict]):
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, _save_enrichment, rows)
+    except Exception as e:
+        logger.error(f"Failed to update IP cache for {len(rows)} IPs: {e}")
+
+def _build(ip: str, rdns: str | None, geo: dict | None) -> dict:
     data = {
         "ip": ip,
         "rdns": None,
@@ -46,78 +74,268 @@ async def enrich_ip(ip: str, force_refresh: bool = False) -> dict:
         "asn": None,
         "asn_name": None
     }
-    
+    data["rdns"] = rdns
+    if geo:
+        data.update(geo)
+    return data
+
+async def _lookup(ip: str) -> dict:
+    """Enrich one IP from the network/local sources, without touching the cache."""
     # RDNS and GeoIP in parallel
     results = await asyncio.gather(
         get_rdns(ip),
-        fetch_geoip(ip)
+        lookup_geoip(ip)
     )
-    
-    data["rdns"] = results[0]
-    geo = results[1]
-    
-    if geo:
-        data.update(geo)
+    return _build(ip, results[0], results[1])
 
-    # Update cache
-    try:
-        c.execute('''
-            INSERT OR REPLACE INTO ip_enrichment 
-            (ip, rdns, country_code, country_name, city, asn, asn_name, last_updated)
-            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (
-            data["ip"], data["rdns"], data["country_code"], data["country_name"],
-            data["city"], data["asn"], data["asn_name"]
-        ))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Failed to update IP cache for {ip}: {e}")
-    finally:
-        conn.close()
-    
+async def enrich_ip(ip: str, force_refresh: bool = False) -> dict:
+    """
+    Returns enriched data for an IP address.
+    Checks cache first unless force_refresh is True.
+    """
+    loop = asyncio.get_running_loop()
+    if not force_refresh:
+        cached = await loop.run_in_executor(None, _load_cached, [ip])
+        if ip in cached:
+            return cached[ip]
+
+    data = await _lookup(ip)
+    await _store([data])
     return data
 
+async def lookup_geoip(ip: str) -> dict | None:
+    """GeoIP/ASN data from the local range DB, falling back to HTTP if enabled."""
+    local_db = get_geoip_db()
+    if local_db is not None:
+        geo = local_db.lookup(ip)
+        if geo:
+            return geo
+    if GEOIP_HTTP_FALLBACK:
+        return await fetch_geoip(ip)
+    return None
+
+def _parse_geo(geo: dict) -> dict | None:
+    """Map an ip-api.com response object to our enrichment fields."""
+    if geo.get("status") != "success":
+        return None
+    result = {
+        "country_name": geo.get("country"),
+        "country_code": geo.get("countryCode"),
+        "city": geo.get("city")
+    }
+    as_info = geo.get("as", "")
+    if as_info:
+        parts = as_info.split(" ", 1)
+        if parts[0].startswith("AS"):
+            try:
+                result["asn"] = int(parts[0][2:])
+            except ValueError:
+                pass
+        if len(parts) > 1:
+            result["asn_name"] = parts[1]
+    return result
+
+class TokenBucket:
+    """Async token bucket: `rate_per_minute` steady rate with bursts up to `capacity`."""
+
+    def __init__(self, rate_per_minute: float, capacity: int | None = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1, int(rate_per_minute) // 3)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (provider says we are out of quota)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class GeoIPClient:
+    """
+    Long-lived ip-api.com client shared by all requests (created in the API lifespan).
+    Keeps HTTP connections alive, rate-limits with token buckets, coalesces
+    concurrent lookups of the same IP into one request, and resolves many
+    IPs at once through the provider's batch endpoint.
+    """
+
+    def __init__(self, base_url: str = IP_API_URL,
+                 rate_per_minute: float = IP_API_RATE_PER_MINUTE,
+                 batch_rate_per_minute: float = IP_API_BATCH_RATE_PER_MINUTE,
+                 timeout: float = 3.0, max_connections: int = 10):
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self._single_bucket = TokenBucket(rate_per_minute)
+        self._batch_bucket = TokenBucket(batch_rate_per_minute)
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def _respect_quota(self, resp: httpx.Response, bucket: TokenBucket):
+        # ip-api reports remaining requests (X-Rl) and seconds until reset (X-Ttl)
+        remaining, ttl = resp.headers.get("X-Rl"), resp.headers.get("X-Ttl")
+        if resp.status_code == 429 or remaining == "0":
+            bucket.pause(float(ttl) if ttl and ttl.isdigit() else 60.0)
+
+    def _claim(self, ips: list[str]) -> tuple[dict[str, asyncio.Future], dict[str, asyncio.Future]]:
+        """
+        Split ips into ones we must fetch (registering futures we now own) and
+        ones another caller already has in flight, each as {ip: future}.
+        """
+        loop = asyncio.get_running_loop()
+        owned, waiting = {}, {}
+        for ip in ips:
+            fut = self._inflight.get(ip)
+            if fut is None:
+                fut = self._inflight[ip] = owned[ip] = loop.create_future()
+            else:
+                waiting[ip] = fut
+        return owned, waiting
+
+    def _resolve(self, ip: str, fut: asyncio.Future, result: dict | None):
+        # Only drop our own future: the IP may have been claimed again since
+        if self._inflight.get(ip) is fut:
+            del self._inflight[ip]
+        if not fut.done():
+            fut.set_result(result)
+
+    async def lookup(self, ip: str) -> dict | None:
+        owned, waiting = self._claim([ip])
+        if waiting:
+            return await asyncio.shield(waiting[ip])
+        result = None
+        try:
+            await self._single_bucket.acquire()
+            resp = await self._client.get(f"/json/{ip}", params={"fields": IP_API_FIELDS})
+            self._respect_quota(resp, self._single_bucket)
+            if resp.status_code == 200:
+                result = _parse_geo(resp.json())
+        except Exception as e:
+            logger.error(f"GeoIP error for {ip}: {e}")
+        finally:
+            self._resolve(ip, owned[ip], result)
+        return result
+
+    async def lookup_many(self, ips: list[str]) -> dict[str, dict | None]:
+        """Resolve many IPs using POST /batch (up to IP_API_BATCH_SIZE per request)."""
+        unique_ips = list(dict.fromkeys(ips))
+        if len(unique_ips) == 1:
+            return {unique_ips[0]: await self.lookup(unique_ips[0])}
+        owned, waiting = self._claim(unique_ips)
+        to_fetch = list(owned)
+        results = {}
+        try:
+            for i in range(0, len(to_fetch), IP_API_BATCH_SIZE):
+                chunk = to_fetch[i:i + IP_API_BATCH_SIZE]
+                chunk_results = {}
+                try:
+                    await self._batch_bucket.acquire()
+                    resp = await self._client.post("/batch", params={"fields": IP_API_FIELDS}, json=chunk)
+                    self._respect_quota(resp, self._batch_bucket)
+                    if resp.status_code == 200:
+                        for ip, geo in zip(chunk, resp.json()):
+                            chunk_results[geo.get("query", ip)] = _parse_geo(geo)
+                except Exception as e:
+                    logger.error(f"GeoIP batch error for {len(chunk)} IPs: {e}")
+                finally:
+                    for ip in chunk:
+                        self._resolve(ip, owned[ip], chunk_results.get(ip))
+                results.update(chunk_results)
+        finally:
+            # Cancelled or failed before reaching every chunk: release the
+            # remaining claims so other callers do not wait on them forever
+            for ip, fut in owned.items():
+                if not fut.done():
+                    self._resolve(ip, fut, None)
+        for ip in to_fetch:
+            results.setdefault(ip, None)
+        # IPs another caller was already fetching
+        for ip, fut in waiting.items():
+            results[ip] = await asyncio.shield(fut)
+        return results
+
+_geoip_client: GeoIPClient | None = None
+
+def set_geoip_client(client: GeoIPClient | None):
+    """Install (or clear) the shared client used by fetch_geoip/batch_enrich_ips."""
+    global _geoip_client
+    _geoip_client = client
+
 async def fetch_geoip(ip: str) -> dict | None:
     """Fetch GeoIP data from ip-api.com."""
+    if _geoip_client is not None:
+        return await _geoip_client.lookup(ip)
+    # No shared client (CLI use, tests): one-off request
     try:
-        async with httpx.AsyncClient(timeout=3.0) as client:
-            resp = await client.get(f"http://ip-api.com/json/{ip}?fields=status,country,countryCode,city,as")
+        async with httpx.AsyncClient(base_url=IP_API_URL, timeout=3.0) as client:
+            resp = await client.get(f"/json/{ip}", params={"fields": IP_API_FIELDS})
             if resp.status_code == 200:
-                geo = resp.json()
-                if geo.get("status") == "success":
-                    result = {
-                        "country_name": geo.get("country"),
-                        "country_code": geo.get("countryCode"),
-                        "city": geo.get("city")
-                    }
-                    as_info = geo.get("as", "")
-                    if as_info:
-                        parts = as_info.split(" ", 1)
-                        if parts[0].startswith("AS"):
-                            try:
-                                result["asn"] = int(parts[0][2:])
-                            except ValueError:
-                                pass
-                        if len(parts) > 1:
-                            result["asn_name"] = parts[1]
-                    return result
+                return _parse_geo(resp.json())
     except Exception as e:
         logger.error(f"GeoIP error for {ip}: {e}")
     return None
 
-async def batch_enrich_ips(ips: list[str]) -> dict[str, dict]:
-    """Enrich a list of IPs, respecting cache and rate limits."""
-    unique_ips = list(set(ips))
+async def lookup_geoip_many(ips: list[str]) -> dict[str, dict | None]:
+    """lookup_geoip for many IPs; HTTP misses go through the batch endpoint when possible."""
     results = {}
+    local_db = get_geoip_db()
+    remaining = []
+    for ip in ips:
+        geo = local_db.lookup(ip) if local_db is not None else None
+        if geo:
+            results[ip] = geo
+        else:
+            remaining.append(ip)
+    if remaining and GEOIP_HTTP_FALLBACK:
+        if _geoip_client is not None:
+            results.update(await _geoip_client.lookup_many(remaining))
+        else:
+            fetched = await asyncio.gather(*(fetch_geoip(ip) for ip in remaining))
+            results.update(zip(remaining, fetched))
+    return results
+
+async def batch_enrich_ips(ips: list[str]) -> dict[str, dict]:
+    """
+    Enrich a list of IPs, respecting cache and rate limits.
+    All cached IPs are read in one round trip; only the misses are looked
+    up, and their results are written back in one transaction.
+    """
+    unique_ips = list(dict.fromkeys(ips))
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(None, _load_cached, unique_ips)
     
-    # We could do this in parallel, but ip-api.com has a 45 req/min limit.
-    # For a few IPs in a report detail, it's fine.
-    # If there are many, we should be careful.
+    misses = [ip for ip in unique_ips if ip not in results]
+    if not misses:
+        return results
     
-    tasks = [enrich_ip(ip) for ip in unique_ips]
-    enriched_list = await asyncio.gather(*tasks)
+    # GeoIP goes through the local DB and then ip-api's rate-limited batch
+    # endpoint; reverse DNS runs alongside it.
+    rdns_list, geo_by_ip = await asyncio.gather(
+        asyncio.gather(*(get_rdns(ip) for ip in misses)),
+        lookup_geoip_many(misses),
+    )
+    enriched_list = [_build(ip, rdns, geo_by_ip.get(ip)) for ip, rdns in zip(misses, rdns_list)]
+    await _store(enriched_list)
     
-    for i, ip in enumerate(unique_ips):
-        results[ip] = enriched_list[i]
+    for data in enriched_list:
+        results[data["ip"]] = data
         
     return results
@@ -0,0 +1,294 @@
+import csv
+import ipaddress
+import logging
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_right
+
+logger = logging.getLogger(__name__)
+
+# One or more comma-separated range files (e.g. the IPv4 and IPv6 blocks of a GeoLite2 edition)
+GEOIP_DB_PATH = os.environ.get("GEOIP_DB_PATH", "")
+# GeoLite2 Country/City locations file; by default the *-Locations-en.csv next to the blocks file
+GEOIP_LOCATIONS_PATH = os.environ.get("GEOIP_LOCATIONS_PATH", "")
+
+# Accepted header names for each field, so common exports (ip2asn/ip2location
+# style start/end ranges, MaxMind GeoLite2 ASN blocks, or a hand-made file)
+# load without conversion. GeoLite2 Country/City blocks only carry a
+# geoname_id; it is resolved through the edition's locations file.
+_COLUMN_ALIASES = {
+    "network": ("network", "cidr", "prefix"),
+    "start": ("start_ip", "ip_start", "range_start", "ip_from", "start"),
+    "end": ("end_ip", "ip_end", "range_end", "ip_to", "end"),
+    "country_code": ("country_code", "country_iso_code", "country"),
+    "country_name": ("country_name",),
+    "city": ("city", "city_name"),
+    "asn": ("asn", "as_number", "autonomous_system_number"),
+    "asn_name": ("asn_name", "as_description", "as_org", "autonomous_system_organization"),
+    "geoname_id": ("geoname_id",),
+    "registered_geoname_id": ("registered_country_geoname_id",),
+}
+_FIELDS = ("country_code", "country_name", "city", "asn", "asn_name")
+
+
+def _parse_ip(value: str) -> int:
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    return int(ipaddress.ip_address(value))
+
+
+class _RangeTable:
+    """
+    Sorted, non-overlapping [start, end] ranges answered by binary search.
+    finalize() drops any range that overlaps an earlier one.
+    """
+
+    def __init__(self, typecode: str | None):
+        self._typecode = typecode
+        self._rows = []
+        self.starts = []
+        self.ends = []
+        self.values = array("I")
+
+    def add(self, start: int, end: int, value_index: int):
+        self._rows.append((start, end, value_index))
+
+    def finalize(self) -> int:
+        """Sort the ranges and build the lookup arrays. Returns how many overlapping ranges were dropped."""
+        self._rows.sort(key=lambda r: (r[0], -r[1]))
+        # Binary search needs disjoint ranges: keep the first of any overlapping
+        # ones (the wider range when two share a start)
+        rows = []
+        for row in self._rows:
+            if rows and row[0] <= rows[-1][1]:
+                continue
+            rows.append(row)
+        dropped = len(self._rows) - len(rows)
+        self._rows = rows
+        # IPv4 fits in unsigned 32-bit arrays; IPv6 needs Python ints
+        if self._typecode:
+            self.starts = array(self._typecode, (r[0] for r in self._rows))
+            self.ends = array(self._typecode, (r[1] for r in self._rows))
+        else:
+            self.starts = [r[0] for r in self._rows]
+            self.ends = [r[1] for r in self._rows]
+        self.values = array("I", (r[2] for r in self._rows))
+        self._rows = []
+        return dropped
+
+    def find(self, ip: int) -> int | None:
+        i = bisect_right(self.starts, ip) - 1
+        if i >= 0 and ip <= self.ends[i]:
+            return self.values[i]
+        return None
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class IPRangeDB:
+    """
+    In-memory IPv4/IPv6 range database for offline GeoIP/ASN enrichment.
+    Load it with load_ip_ranges(); lookup() returns the same keys as
+    enrichment.fetch_geoip, or None when the IP is not covered.
+    """
+
+    def __init__(self):
+        self._v4 = _RangeTable("I")
+        self._v6 = _RangeTable(None)
+        # Many ranges share the same country/ASN, so values are interned
+        self._values = []
+        self._value_ids = {}
+
+    def add_range(self, start: int, end: int, version: int, info: tuple):
+        value_index = self._value_ids.get(info)
+        if value_index is None:
+            value_index = self._value_ids[info] = len(self._values)
+            self._values.append(info)
+        (self._v4 if version == 4 else self._v6).add(start, end, value_index)
+
+    def finalize(self) -> int:
+        """Prepare for lookups; returns the number of overlapping ranges dropped."""
+        dropped = self._v4.finalize() + self._v6.finalize()
+        self._value_ids = {}
+        return dropped
+
+    def lookup(self, ip: str) -> dict | None:
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if addr.version == 6 and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+        table = self._v4 if addr.version == 4 else self._v6
+        value_index = table.find(int(addr))
+        if value_index is None:
+            return None
+        return {k: v for k, v in zip(_FIELDS, self._values[value_index]) if v is not None}
+
+    def __len__(self):
+        return len(self._v4) + len(self._v6)
+
+
+def _resolve_columns(header: list[str]) -> dict[str, int]:
+    normalized = [h.strip().lower() for h in header]
+    columns = {}
+    for field, aliases in _COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in normalized:
+                columns[field] = normalized.index(alias)
+                break
+    if "network" not in columns and not ("start" in columns and "end" in columns):
+        raise ValueError("IP range file needs a 'network' column or 'start_ip'/'end_ip' columns")
+    return columns
+
+
+def _open_csv(path):
+    """Open a CSV or TSV file; returns (file, reader)."""
+    f = open(path, newline="", encoding="utf-8")
+    sample = f.read(4096)
+    f.seek(0)
+    delimiter = "\t" if sample.count("\t") > sample.count(",") else ","
+    return f, csv.reader(f, delimiter=delimiter)
+
+
+def load_locations(path) -> dict[str, tuple]:
+    """
+    Load a GeoLite2 Country/City locations CSV into
+    {geoname_id: (country_code, country_name, city)}.
+    """
+    f, reader = _open_csv(path)
+    with f:
+        header = [h.strip().lower() for h in next(reader)]
+        if "geoname_id" not in header:
+            raise ValueError(f"{path} is not a GeoLite2 locations file (no geoname_id column)")
+        idx = {name: header.index(name) for name in ("country_iso_code", "country_name", "city_name")
+               if name in header}
+        gid = header.index("geoname_id")
+        locations = {}
+        for row in reader:
+            if len(row) <= gid or not row[gid]:
+                continue
+            locations[row[gid]] = tuple(
+                (row[idx[name]].strip() or None) if name in idx and idx[name] < len(row) else None
+                for name in ("country_iso_code", "country_name", "city_name")
+            )
+    return locations
+
+
+def _default_locations_path(blocks_path) -> str | None:
+    """GeoLite2-City-Blocks-IPv4.csv -> GeoLite2-City-Locations-en.csv in the same directory, if present."""
+    name = os.path.basename(blocks_path)
+    candidate = re.sub(r"-Blocks-IPv[46]", "-Locations-en", name)
+    if candidate == name:
+        return None
+    candidate = os.path.join(os.path.dirname(blocks_path), candidate)
+    return candidate if os.path.exists(candidate) else None
+
+
+def _load_file(db: IPRangeDB, path, locations_path=None, locations_cache=None) -> int:
+    """Add the ranges of one file to `db`; returns the number of unparseable rows."""
+    f, reader = _open_csv(path)
+    with f:
+        columns = _resolve_columns(next(reader))
+
+        locations = None
+        if "geoname_id" in columns and "country_code" not in columns:
+            locations_path = locations_path or _default_locations_path(str(path))
+            if not locations_path:
+                raise ValueError(f"{path} has geoname_id but no country columns; set GEOIP_LOCATIONS_PATH "
+                                 "to the matching GeoLite2 *-Locations-en.csv")
+            cache = {} if locations_cache is None else locations_cache
+            if locations_path not in cache:
+                cache[locations_path] = load_locations(locations_path)
+            locations = cache[locations_path]
+
+        def cell(row, field):
+            idx = columns.get(field)
+            if idx is None or idx >= len(row):
+                return None
+            value = row[idx].strip()
+            return value or None
+
+        skipped = 0
+        for row in reader:
+            if not row:
+                continue
+            try:
+                if "network" in columns and cell(row, "network"):
+                    net = ipaddress.ip_network(cell(row, "network"), strict=False)
+                    start, end, version = int(net.network_address), int(net.broadcast_address), net.version
+                else:
+                    start, end = _parse_ip(cell(row, "start")), _parse_ip(cell(row, "end"))
+                    version = 4 if end <= 0xFFFFFFFF and ":" not in cell(row, "end") else 6
+                asn = cell(row, "asn")
+                if asn and asn.upper().startswith("AS"):
+                    asn = asn[2:]
+                if locations is not None:
+                    # Networks without a location fall back to the registered country, as MaxMind advises
+                    place = locations.get(cell(row, "geoname_id") or cell(row, "registered_geoname_id") or "")
+                    country_code, country_name, city = place or (None, None, None)
+                else:
+                    country_code, country_name, city = (
+                        cell(row, "country_code"), cell(row, "country_name"), cell(row, "city"))
+                info = (
+                    country_code,
+                    country_name,
+                    city,
+                    int(asn) if asn and asn.isdigit() and int(asn) else None,
+                    cell(row, "asn_name"),
+                )
+            except (ValueError, TypeError):
+                skipped += 1
+                continue
+            db.add_range(start, end, version, info)
+    return skipped
+
+
+def load_ip_ranges(paths, locations_path=None) -> IPRangeDB:
+    """
+    Load one or more CSV/TSV range files (header row required) into an
+    IPRangeDB. Rows are either CIDR networks or inclusive start/end addresses
+    (dotted, IPv6 or integer form); IPv4 and IPv6 may be mixed in one file.
+    GeoLite2 Country/City blocks are joined with their locations file
+    (`locations_path`, or the *-Locations-en.csv next to the blocks file).
+    Ranges must not overlap, also across files: overlapping ones are dropped
+    with a warning, keeping the first (widest) range.
+    """
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    db = IPRangeDB()
+    locations_cache = {}
+    for path in paths:
+        skipped = _load_file(db, path, locations_path, locations_cache)
+        if skipped:
+            logger.warning(f"Skipped {skipped} unparseable rows in {path}")
+
+    dropped = db.finalize()
+    if dropped:
+        logger.warning(f"Dropped {dropped} IP ranges overlapping other ranges in {', '.join(map(str, paths))}")
+    logger.info(f"Loaded {len(db)} IP ranges from {', '.join(map(str, paths))}")
+    return db
+
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def get_geoip_db() -> IPRangeDB | None:
+    """Return the range DB configured by GEOIP_DB_PATH (loaded once), or None."""
+    global _db
+    if _db is None and GEOIP_DB_PATH:
+        with _db_lock:
+            if _db is None:
+                try:
+                    paths = [p.strip() for p in GEOIP_DB_PATH.split(",") if p.strip()]
+                    _db = load_ip_ranges(paths, GEOIP_LOCATIONS_PATH or None)
+                except (OSError, ValueError) as e:
+                    logger.error(f"Failed to load GeoIP database {GEOIP_DB_PATH}: {e}")
+                    _db = IPRangeDB()
+                    _db.finalize()
+    return _db
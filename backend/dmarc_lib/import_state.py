@@ -0,0 +1,62 @@
+"""
+Resume checkpoints and progress reporting shared by the batch importers
+(bulk_import for report files, mail_import for Maildir/mbox archives).
+
+Checkpoints live in the `import_checkpoints` table, one row per imported
+item keyed by `path` (a file path, or `<archive>#<message>` for mail) with
+the size and mtime it had when it was imported.
+"""
+import time
+
+from .db import get_db
+
+DEFAULT_BATCH_SIZE = 200  # reports per save_reports() commit
+
+
+def load_checkpoints(retry_failed: bool = False) -> dict[str, tuple[int, int]]:
+    """Return {path: (size, mtime_ns)} of checkpointed items; retry_failed leaves out failed ones."""
+    conn = get_db()
+    query = "SELECT path, size, mtime_ns FROM import_checkpoints"
+    if retry_failed:
+        query += " WHERE status != 'failed'"
+    done = {row['path']: (row['size'], row['mtime_ns']) for row in conn.execute(query)}
+    conn.close()
+    return done
+
+
+def save_checkpoints(rows):
+    """Write (path, size, mtime_ns, status, report_db_id, error) rows in one transaction."""
+    conn = get_db()
+    try:
+        conn.executemany('''
+            INSERT OR REPLACE INTO import_checkpoints (path, size, mtime_ns, status, report_db_id, error, imported_at)
+            VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+class ImportProgress:
+    """Counters for an import run, printed through `out` at most every `every` seconds."""
+
+    def __init__(self, total: int, every: float, out, unit: str = "files"):
+        self.total = total
+        self.every = every
+        self.out = out
+        self.unit = unit
+        self.started = time.monotonic()
+        self._last = 0.0
+        self.files = self.reports = self.records = self.failed = 0
+
+    def report(self, force: bool = False):
+        now = time.monotonic()
+        if not self.out or (not force and now - self._last < self.every):
+            return
+        self._last = now
+        elapsed = max(now - self.started, 1e-9)
+        self.out(f"[{self.files}/{self.total}] {self.files / elapsed:.1f} {self.unit}/s, "
+                 f"{self.records / elapsed:.0f} records/s, {self.reports} saved, {self.failed} failed")
@@ -0,0 +1,506 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from .db import find_raw_file, get_db, record_raw_file, save_report, sha256_bytes, sha256_file
+from .parser import parse_report, parse_report_stream, sniff_format
+
+logger = logging.getLogger(__name__)
+
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", str(os.cpu_count() or 2)))
+INGEST_USE_PROCESSES = os.environ.get("INGEST_USE_PROCESSES", "true").lower() in ("1", "true", "yes")
+INGEST_MAX_ATTEMPTS = int(os.environ.get("INGEST_MAX_ATTEMPTS", "3"))
+INGEST_RETRY_BACKOFF = float(os.environ.get("INGEST_RETRY_BACKOFF", "5"))       # seconds, doubled per attempt
+INGEST_RETRY_BACKOFF_MAX = float(os.environ.get("INGEST_RETRY_BACKOFF_MAX", "300"))
+INGEST_POLL_INTERVAL = float(os.environ.get("INGEST_POLL_INTERVAL", "2"))
+# Queued files at least this large (on disk) are parsed with parse_report_stream
+# and saved as their records are read, instead of being parsed whole in the pool
+INGEST_STREAM_BYTES = int(os.environ.get("INGEST_STREAM_BYTES", str(4 * 1024 * 1024)))
+# Content-addressed copies of reports ingested from memory (email); empty disables
+RAW_ARCHIVE_DIR = os.environ.get("RAW_ARCHIVE_DIR", "")
+# Where in-memory payloads are written when RAW_ARCHIVE_DIR is not set (the API uses its upload dir)
+INGEST_SPILL_DIR = os.environ.get("INGEST_SPILL_DIR", str(Path(__file__).resolve().parent.parent / "uploads"))
+
+
+# --- Queue (ingest_jobs table) ---
+
+def enqueue_jobs(file_paths, source: str = "upload", max_attempts: int = INGEST_MAX_ATTEMPTS) -> list[int]:
+    """Queue report files for parsing/saving. Returns the new job ids."""
+    conn = get_db()
+    c = conn.cursor()
+    now = time.time()
+    job_ids = []
+    try:
+        for path in file_paths:
+            c.execute('''
+                INSERT INTO ingest_jobs (file_path, source, status, attempts, max_attempts, run_after, created_at)
+                VALUES (?, ?, 'queued', 0, ?, ?, ?)
+            ''', (str(path), source, max_attempts, now, now))
+            job_ids.append(c.lastrowid)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return job_ids
+
+
+def start_job(file_path, source: str, max_attempts: int = INGEST_MAX_ATTEMPTS) -> int:
+    """
+    Record a job that is processed right away (in-memory payloads) as
+    'running'. `file_path` must already hold the payload: after a restart
+    the job is re-queued and read from there.
+    """
+    conn = get_db()
+    now = time.time()
+    c = conn.execute('''
+        INSERT INTO ingest_jobs (file_path, source, status, attempts, max_attempts, run_after, created_at, started_at)
+        VALUES (?, ?, 'running', 1, ?, ?, ?, ?)
+    ''', (str(file_path), source, max_attempts, now, now, now))
+    conn.commit()
+    conn.close()
+    return c.lastrowid
+
+
+def record_duplicate_job(label: str, source: str, report_id: int) -> int:
+    """Record a payload whose content was already ingested as a finished 'duplicate' job."""
+    conn = get_db()
+    now = time.time()
+    c = conn.execute('''
+        INSERT INTO ingest_jobs (file_path, source, status, attempts, max_attempts, run_after, created_at,
+                                 started_at, finished_at, report_id)
+        VALUES (?, ?, 'duplicate', 0, 0, ?, ?, ?, ?, ?)
+    ''', (label, source, now, now, now, now, report_id))
+    conn.commit()
+    conn.close()
+    return c.lastrowid
+
+
+def claim_job() -> dict | None:
+    """Atomically move the next due job to 'running' and return it, or None."""
+    conn = get_db()
+    now = time.time()
+    try:
+        row = conn.execute('''
+            UPDATE ingest_jobs
+            SET status = 'running', attempts = attempts + 1, started_at = ?, finished_at = NULL
+            WHERE id = (
+                SELECT id FROM ingest_jobs
+                WHERE status = 'queued' AND run_after <= ?
+                ORDER BY run_after, id LIMIT 1
+            )
+            RETURNING *
+        ''', (now, now)).fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return dict(row) if row else None
+
+
+def complete_job(job_id: int, report_id: int, parse_ms: float | None, save_ms: float | None,
+                 status: str = 'done'):
+    """Mark a job finished: 'done', or 'duplicate' when the file was already ingested."""
+    conn = get_db()
+    conn.execute('''
+        UPDATE ingest_jobs
+        SET status = ?, report_id = ?, parse_ms = ?, save_ms = ?, finished_at = ?, error = NULL
+        WHERE id = ?
+    ''', (status, report_id, parse_ms, save_ms, time.time(), job_id))
+    conn.commit()
+    conn.close()
+
+
+def fail_job(job_id: int, error: str, retry: bool = True) -> str:
+    """
+    Record a failed attempt. The job is re-queued with exponential backoff
+    until it has used max_attempts (or right away with retry=False), then
+    marked 'failed'. Returns the new status.
+    """
+    conn = get_db()
+    now = time.time()
+    try:
+        row = conn.execute("SELECT attempts, max_attempts FROM ingest_jobs WHERE id = ?", (job_id,)).fetchone()
+        if retry and row and row['attempts'] < row['max_attempts']:
+            status = 'queued'
+            run_after = now + min(INGEST_RETRY_BACKOFF_MAX, INGEST_RETRY_BACKOFF * 2 ** (row['attempts'] - 1))
+        else:
+            status = 'failed'
+            run_after = now
+        conn.execute('''
+            UPDATE ingest_jobs SET status = ?, run_after = ?, error = ?, finished_at = ? WHERE id = ?
+        ''', (status, run_after, error[:1000], now, job_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return status
+
+
+def requeue_interrupted() -> int:
+    """Return jobs left 'running' by a previous process (crash/restart) to the queue."""
+    conn = get_db()
+    c = conn.execute("UPDATE ingest_jobs SET status = 'queued', run_after = ? WHERE status = 'running'",
+                     (time.time(),))
+    conn.commit()
+    conn.close()
+    return c.rowcount
+
+
+def get_job_stats(limit: int = 50, status: str | None = None) -> dict:
+    """Queue depth per status plus the most recent jobs with their timings."""
+    conn = get_db()
+    c = conn.cursor()
+    counts = {s: 0 for s in ('queued', 'running', 'done', 'duplicate', 'failed')}
+    for row in c.execute("SELECT status, COUNT(*) AS n FROM ingest_jobs GROUP BY status"):
+        counts[row['status']] = row['n']
+
+    c.execute("SELECT MIN(created_at) FROM ingest_jobs WHERE status = 'queued'")
+    oldest = c.fetchone()[0]
+
+    query = "SELECT * FROM ingest_jobs"
+    params = []
+    if status:
+        query += " WHERE status = ?"
+        params.append(status)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    jobs = [dict(row) for row in c.execute(query, params)]
+    conn.close()
+    return {
+        "counts": counts,
+        "queue_depth": counts['queued'] + counts['running'],
+        "oldest_queued_age": round(time.time() - oldest, 1) if oldest else None,
+        "jobs": jobs,
+    }
+
+
+# --- In-memory payloads ---
+
+def archive_raw_payload(payload: bytes, sha256: str, fmt: str, archive_dir: str | None = None) -> Path | None:
+    """
+    Store a raw report under <archive_dir>/<sha[:2]>/<sha>.<fmt> (written
+    once, atomically). Returns the path, or None when archiving is disabled.
+    """
+    archive_dir = RAW_ARCHIVE_DIR if archive_dir is None else archive_dir
+    if not archive_dir:
+        return None
+    path = Path(archive_dir) / sha256[:2] / f"{sha256}.{fmt}"
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(payload)
+        os.replace(tmp, path)
+    return path
+
+
+def spill_payload(spill_dir, entry: dict) -> Path:
+    """Write an in-memory payload to disk (atomically) under a content-unique name."""
+    name = Path(entry['filename'].replace("\\", "/")).name or f"report.{entry['format']}"
+    path = Path(spill_dir) / f"{entry['sha256'][:12]}-{name}"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(entry['payload'])
+    os.replace(tmp, path)
+    return path
+
+
+def _store_payloads(attachments, source: str, spill_dir) -> list:
+    """
+    Record (filename, payload) pairs already ingested as 'duplicate' jobs
+    and write the rest to disk - to RAW_ARCHIVE_DIR when enabled, else
+    `spill_dir`. Returns, in order, the duplicate job id or the new
+    payload's entry (with its 'path') for each pair.
+    """
+    stored = []
+    for filename, payload in attachments:
+        sha256, size = sha256_bytes(payload)
+        fmt = sniff_format(payload[:8])
+        existing = find_raw_file(sha256)
+        if existing is not None:
+            stored.append(record_duplicate_job(f"{source}:{filename}", source, existing))
+            logger.info(f"Skipped {filename}: same content as report {existing}")
+            continue
+        entry = {'filename': filename, 'payload': payload, 'format': fmt, 'sha256': sha256, 'size': size}
+        entry['path'] = archive_raw_payload(payload, sha256, fmt) or spill_payload(spill_dir, entry)
+        stored.append(entry)
+    return stored
+
+
+def _register_payloads(attachments, source: str, spill_dir) -> tuple[list[int], list[dict]]:
+    """
+    Create a job per (filename, payload). New payloads are written to disk
+    first (see _store_payloads) so their 'running' job survives a restart,
+    and are returned for parsing from memory.
+    Returns (all job ids, pending entries).
+    """
+    job_ids = []
+    pending = []
+    for item in _store_payloads(attachments, source, spill_dir):
+        if isinstance(item, dict):
+            item['id'] = start_job(item['path'], source)
+            pending.append(item)
+            item = item['id']
+        job_ids.append(item)
+    return job_ids, pending
+
+
+def queue_payloads(attachments, source: str = "email", spill_dir=INGEST_SPILL_DIR) -> list[int]:
+    """
+    Write (filename, payload) pairs to disk and queue them as ordinary
+    'queued' jobs for whichever IngestWorkers drains the queue - for
+    processes that run no workers of their own, like bin/mail-poller next
+    to the API. Returns the job ids (duplicates included).
+    """
+    stored = _store_payloads(attachments, source, spill_dir)
+    queued = iter(enqueue_jobs([item['path'] for item in stored if isinstance(item, dict)], source))
+    return [next(queued) if isinstance(item, dict) else item for item in stored]
+
+
+# --- Workers ---
+
+def process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Process pool for parsing. Never forks: callers hold threads with open SQLite connections."""
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
+
+
+def _parse_file(file_path: str) -> tuple[dict, float]:
+    """Parse one report (runs in a worker process). Returns (parsed, parse_ms)."""
+    started = time.perf_counter()
+    parsed = parse_report(file_path)
+    return parsed, (time.perf_counter() - started) * 1000
+
+
+def _parse_payload(payload: bytes, fmt: str) -> tuple[dict, float]:
+    """Parse a report held in memory (runs in a worker process). Returns (parsed, parse_ms)."""
+    started = time.perf_counter()
+    parsed = parse_report(payload, format=fmt)
+    return parsed, (time.perf_counter() - started) * 1000
+
+
+def _check_raw_file(file_path: str) -> tuple[str, int, int | None]:
+    """Hash a queued file and look it up in raw_files: (sha256, size, existing report id)."""
+    sha256, size = sha256_file(file_path)
+    return sha256, size, find_raw_file(sha256)
+
+
+def _stream_and_save(file_path: str) -> tuple[int, float]:
+    """
+    Parse and save a large report in one pass: save_report consumes the
+    records generator, so only one <record> is in memory at a time.
+    Returns (report_id, ms for parse and save together).
+    """
+    started = time.perf_counter()
+    parsed = parse_report_stream(file_path)
+    try:
+        report_id = save_report(parsed)
+    finally:
+        # A duplicate report_id returns before reading the records; release the file
+        parsed['records'].close()
+    return report_id, (time.perf_counter() - started) * 1000
+
+
+def _save_parsed(parsed: dict) -> tuple[int, float]:
+    started = time.perf_counter()
+    report_id = save_report(parsed)
+    return report_id, (time.perf_counter() - started) * 1000
+
+
+class IngestWorkers:
+    """
+    Pool of async workers draining ingest_jobs. Parsing runs in a process
+    pool (INGEST_USE_PROCESSES) so large uploads use every core; saves go
+    through `db_executor`, where SQLite serializes writers anyway.
+    `on_saved(report_id)` is awaited after each successful job.
+    Payloads already in memory (email attachments) skip the queue wait via
+    submit_payloads(): each is written to disk (RAW_ARCHIVE_DIR or
+    `spill_dir`) and recorded as a 'running' job, then parsed from memory.
+    If it fails, or the process stops first, the job is retried from that
+    file like any queued one.
+    Files of `stream_bytes` or more are streamed straight into the database
+    on `db_executor` rather than parsed whole in the pool, so a huge report
+    never has to fit in memory (or be pickled back from a worker process).
+    """
+
+    def __init__(self, db_executor: Executor, workers: int = INGEST_WORKERS,
+                 use_processes: bool = INGEST_USE_PROCESSES, on_saved=None,
+                 poll_interval: float = INGEST_POLL_INTERVAL, spill_dir=INGEST_SPILL_DIR,
+                 stream_bytes: int = INGEST_STREAM_BYTES):
+        self.db_executor = db_executor
+        self.workers = max(1, workers)
+        self.use_processes = use_processes
+        self.on_saved = on_saved
+        self.poll_interval = poll_interval
+        self.spill_dir = spill_dir
+        self.stream_bytes = stream_bytes
+        self._parse_executor = None
+        self._tasks = []
+        self._payload_tasks = set()
+        self._wakeup = None
+
+    async def _run_db(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.db_executor, fn, *args)
+
+    async def start(self):
+        interrupted = await self._run_db(requeue_interrupted)
+        if interrupted:
+            logger.info(f"Re-queued {interrupted} ingest jobs interrupted by a restart")
+        self._parse_executor = self._new_parse_executor()
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in [*self._tasks, *self._payload_tasks]:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._payload_tasks, return_exceptions=True)
+        self._tasks = []
+        self._payload_tasks = set()
+        if self._parse_executor is not None:
+            self._parse_executor.shutdown(wait=True, cancel_futures=True)
+            self._parse_executor = None
+        # Jobs cancelled mid-flight stay 'running' and are re-queued on next start
+
+    def _new_parse_executor(self) -> Executor:
+        if self.use_processes:
+            return process_pool(self.workers)
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="dmarc-parse")
+
+    async def _parse(self, loop, parse_fn, parse_args):
+        """Run a parse in the pool, replacing the pool once if a worker process died."""
+        executor = self._parse_executor
+        try:
+            return await loop.run_in_executor(executor, parse_fn, *parse_args)
+        except BrokenExecutor as e:
+            # A dead worker (OOM kill, crash) breaks the whole pool; every later
+            # job would fail the same way. Concurrent jobs see the same broken
+            # pool, so only the first one replaces it.
+            if self._parse_executor is executor:
+                logger.error(f"Parse pool broke, starting a new one: {e}")
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._parse_executor = self._new_parse_executor()
+        # Retried once: a report that kills its worker again fails the job as usual
+        return await loop.run_in_executor(self._parse_executor, parse_fn, *parse_args)
+
+    def notify(self):
+        """Wake idle workers after enqueueing jobs."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def submit_payloads(self, attachments, source: str = "email") -> list[int]:
+        """
+        Ingest (filename, payload bytes) pairs. Returns the job ids once every
+        payload is on disk and has its job row, so the caller may forget the
+        attachments (e.g. advance an IMAP checkpoint); parsing and saving
+        continue in the background (see wait_payloads()).
+        """
+        job_ids, entries = await self._run_db(_register_payloads, list(attachments), source, self.spill_dir)
+        if entries:
+            task = asyncio.create_task(self._ingest_payloads(entries))
+            self._payload_tasks.add(task)
+            task.add_done_callback(self._payload_tasks.discard)
+        return job_ids
+
+    async def wait_payloads(self):
+        """Wait until every submitted payload has been saved or re-queued."""
+        await asyncio.gather(*self._payload_tasks, return_exceptions=True)
+
+    async def _ingest_payloads(self, entries: list[dict]):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.workers)
+
+        async def one(entry):
+            async with slots:
+                await self._ingest_payload(loop, entry)
+
+        await asyncio.gather(*(one(entry) for entry in entries))
+
+    async def _ingest_payload(self, loop, entry: dict):
+        try:
+            report_id = await self._parse_and_save(
+                loop, entry['id'], _parse_payload, (entry['payload'], entry['format']),
+                entry['sha256'], entry['size'])
+            logger.info(f"Successfully processed {entry['filename']}")
+        except Exception as e:
+            await self._requeue_payload(entry, e)
+            return
+        await self._after_save(report_id)
+
+    async def _requeue_payload(self, entry: dict, error: Exception):
+        """Hand a failed payload to the file queue (it is on disk already) so the normal retry/backoff applies."""
+        try:
+            status = await self._run_db(fail_job, entry['id'], f"{type(error).__name__}: {error}")
+            self.notify()
+        except Exception as e:
+            logger.error(f"Could not re-queue {entry['filename']}: {e}")
+            return
+        logger.error(f"Error processing {entry['filename']} (now {status}): {error}")
+
+    async def _parse_and_save(self, loop, job_id: int, parse_fn, parse_args, sha256: str, size: int) -> int:
+        parsed, parse_ms = await self._parse(loop, parse_fn, parse_args)
+        report_id, save_ms = await self._run_db(_save_parsed, parsed)
+        await self._run_db(record_raw_file, sha256, size, report_id)
+        await self._run_db(complete_job, job_id, report_id, round(parse_ms, 1), round(save_ms, 1))
+        return report_id
+
+    async def _stream_and_save(self, job_id: int, file_path: str, sha256: str, size: int) -> int:
+        report_id, save_ms = await self._run_db(_stream_and_save, file_path)
+        await self._run_db(record_raw_file, sha256, size, report_id)
+        # Parsing is interleaved with the inserts, so the whole pass counts as save time
+        await self._run_db(complete_job, job_id, report_id, None, round(save_ms, 1))
+        return report_id
+
+    async def _after_save(self, report_id: int):
+        if self.on_saved:
+            try:
+                await self.on_saved(report_id)
+            except Exception as e:
+                logger.error(f"Post-ingest hook failed for report {report_id}: {e}")
+
+    async def _worker(self, n: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Clear before claiming: a notify() that lands while the claim is
+            # running must still cut the wait below short
+            self._wakeup.clear()
+            try:
+                job = await self._run_db(claim_job)
+            except Exception as e:
+                logger.error(f"Ingest worker {n} could not claim a job: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except TimeoutError:
+                    pass
+                continue
+            await self._process(loop, job)
+
+    async def _process(self, loop, job: dict):
+        try:
+            # An identical file costs one hash and one lookup instead of a full parse
+            sha256, size, existing = await self._run_db(_check_raw_file, job['file_path'])
+            if existing is not None:
+                await self._run_db(complete_job, job['id'], existing, None, None, 'duplicate')
+                logger.info(f"Skipped {job['file_path']}: same content as report {existing}")
+                return
+            if size >= self.stream_bytes:
+                report_id = await self._stream_and_save(job['id'], job['file_path'], sha256, size)
+            else:
+                report_id = await self._parse_and_save(
+                    loop, job['id'], _parse_file, (job['file_path'],), sha256, size)
+            logger.info(f"Successfully processed {job['file_path']}")
+        except Exception as e:
+            status = await self._run_db(fail_job, job['id'], f"{type(e).__name__}: {e}")
+            logger.error(f"Error processing {job['file_path']} (attempt {job['attempts']}, now {status}): {e}")
+            return
+        await self._after_save(report_id)
@@ -0,0 +1,293 @@
+"""
+Backfill DMARC reports from local mail archives (Maildir directories and
+mbox files) straight into the database.
+
+Messages are read and MIME-decoded in a process pool; report attachments
+are picked with the same filter as the IMAP sync
+(email_fetch.extract_report_attachments), parsed in the worker and saved in
+batches with save_reports(). Every message is checkpointed in
+`import_checkpoints`, so re-running the same command resumes:
+
+- Maildir messages are keyed `<maildir>#<unique name>` (the part before
+  ':2,' so flag changes do not count as a new message) with size and mtime.
+- mbox messages are keyed `<mbox file>#<byte offset>` with their length and
+  mtime 0, so appending to the mbox keeps earlier checkpoints valid.
+
+Attachment hashes go into `raw_files`, as for fetched email, so a report
+attachment that was already ingested is not saved again.
+
+Usage: python -m backend.dmarc_lib.mail_import [options] <maildir-or-mbox> [more paths...]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from .db import find_raw_files, init_db, record_raw_files, save_reports, sha256_bytes
+from .email_fetch import extract_report_attachments
+from .import_state import DEFAULT_BATCH_SIZE, ImportProgress, load_checkpoints, save_checkpoints
+from .jobs import process_pool
+from .parser import parse_report
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_PER_TASK = 32  # messages handed to a worker at once (amortizes process round trips)
+
+
+def _is_maildir(path: Path) -> bool:
+    return (path / "cur").is_dir() and (path / "new").is_dir()
+
+
+def _is_mbox(path: Path) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            return f.read(5) == b'From '
+    except OSError:
+        return False
+
+
+def iter_mail_sources(paths):
+    """
+    Yield ('maildir', dir) and ('mbox', file) for the given paths. Directories
+    that are not a Maildir themselves are searched for Maildirs (including
+    Maildir++ subfolders) and mbox files.
+    """
+    for path in map(Path, paths):
+        path = path.resolve()
+        if path.is_file():
+            if _is_mbox(path):
+                yield "mbox", path
+            else:
+                logger.warning(f"Skipping '{path}': not an mbox file")
+        elif path.is_dir():
+            for root, dirs, files in os.walk(path):
+                root = Path(root)
+                dirs.sort()
+                if _is_maildir(root):
+                    yield "maildir", root
+                    dirs[:] = [d for d in dirs if d not in ("cur", "new", "tmp")]
+                for name in sorted(files):
+                    if _is_mbox(root / name):
+                        yield "mbox", root / name
+        else:
+            logger.warning(f"Skipping '{path}': not a file or directory")
+
+
+def _mbox_spans(path: Path) -> list[tuple[int, int]]:
+    """(offset, length) of every message in an mbox, split at "From " lines like mailbox.mbox."""
+    spans = []
+    start = None
+    pos = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'From '):
+                if start is not None:
+                    spans.append((start, pos - start))
+                start = pos + len(line)  # the message starts after the From_ line
+            pos += len(line)
+    if start is not None:
+        spans.append((start, pos - start))
+    return spans
+
+
+def iter_messages(kind: str, path: Path):
+    """Yield (key, file, offset, length, size, mtime_ns) for each message; length None reads the whole file."""
+    if kind == "maildir":
+        for sub in ("new", "cur"):
+            for entry in sorted(os.scandir(path / sub), key=lambda e: e.name):
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                st = entry.stat()
+                unique = entry.name.split(':', 1)[0]
+                yield f"{path}#{unique}", entry.path, 0, None, st.st_size, st.st_mtime_ns
+    else:
+        for offset, length in _mbox_spans(path):
+            yield f"{path}#{offset}", str(path), offset, length, length, 0
+
+
+def _extract_batch(items):
+    """
+    Worker entry point: read, MIME-decode and parse a batch of messages.
+    `items` are (key, file, offset, length); returns (key, reports, error)
+    per message, where reports are (filename, sha256, size, parsed, error)
+    per attachment.
+    """
+    results = []
+    for key, file, offset, length in items:
+        try:
+            with open(file, 'rb') as f:
+                f.seek(offset)
+                message = f.read() if length is None else f.read(length)
+            attachments = extract_report_attachments(message)
+        except Exception as e:
+            results.append((key, [], f"{type(e).__name__}: {e}"))
+            continue
+        reports = []
+        for filename, payload in attachments:
+            sha256, size = sha256_bytes(payload)
+            try:
+                reports.append((filename, sha256, size, parse_report(payload), None))
+            except Exception as e:
+                reports.append((filename, sha256, size, None, f"{type(e).__name__}: {e}"))
+        results.append((key, reports, None))
+    return results
+
+
+def mail_import(paths, workers: int | None = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                resume: bool = True, retry_failed: bool = False, use_processes: bool = True,
+                progress=print, progress_every: float = 5.0) -> dict:
+    """
+    Import the report attachments of every message under `paths`. Returns a
+    summary dict with the number of messages seen, skipped (already
+    checkpointed), report attachments found, reports saved and failures.
+    """
+    init_db()
+    workers = workers or os.cpu_count() or 2
+    done = load_checkpoints(retry_failed) if resume else {}
+
+    pending = []
+    skipped = 0
+    for kind, path in iter_mail_sources(paths):
+        for key, file, offset, length, size, mtime_ns in iter_messages(kind, path):
+            if done.get(key) == (size, mtime_ns):
+                skipped += 1
+                continue
+            pending.append((key, file, offset, length, size, mtime_ns))
+
+    stats = ImportProgress(len(pending), progress_every, progress, unit="messages")
+    if progress:
+        progress(f"{len(pending)} messages to import ({skipped} already imported), {workers} workers")
+
+    meta = {key: (size, mtime_ns) for key, _, _, _, size, mtime_ns in pending}
+    attachments = 0
+    batch = []  # (key, size, mtime_ns, reports)
+    batch_reports = 0
+
+    def flush():
+        nonlocal batch_reports
+        if not batch:
+            return
+        parsed_reports = [report for entry in batch for report in entry[3] if report[3]]
+        # Attachments already ingested byte for byte resolve to their report without a save
+        known = find_raw_files(report[1] for report in parsed_reports)
+        saved_ids = iter(save_reports(report[3] for report in parsed_reports if report[1] not in known))
+        checkpoints = []
+        raw_files = []
+        for key, size, mtime_ns, reports in batch:
+            saved, errors = [], []
+            for filename, sha256, payload_size, parsed, error in reports:
+                if parsed is None:
+                    errors.append(f"{filename}: {error}")
+                    continue
+                report_db_id = known.get(sha256)
+                if report_db_id is None:
+                    report_db_id = next(saved_ids)
+                    if report_db_id is not None:
+                        raw_files.append((sha256, payload_size, report_db_id))
+                if report_db_id is None:
+                    stats.failed += 1
+                    errors.append(f"{filename}: save failed")
+                else:
+                    stats.reports += 1
+                    stats.records += len(parsed['records'])
+                    saved.append(report_db_id)
+            if errors:
+                checkpoints.append((key, size, mtime_ns, 'failed', saved[0] if saved else None, "; ".join(errors)))
+            elif saved:
+                checkpoints.append((key, size, mtime_ns, 'imported', saved[0], None))
+            else:
+                checkpoints.append((key, size, mtime_ns, 'empty', None, None))
+        # Written after the reports commit, as in bulk_import
+        record_raw_files(raw_files)
+        save_checkpoints(checkpoints)
+        batch.clear()
+        batch_reports = 0
+
+    executor = process_pool(workers) if use_processes else ThreadPoolExecutor(max_workers=workers)
+    tasks = (
+        [item[:4] for item in pending[i:i + MESSAGES_PER_TASK]]
+        for i in range(0, len(pending), MESSAGES_PER_TASK)
+    )
+    in_flight = set()
+    try:
+        # Bounded number of batches in flight so memory stays flat
+        while True:
+            while len(in_flight) < workers * 4:
+                items = next(tasks, None)
+                if items is None:
+                    break
+                in_flight.add(executor.submit(_extract_batch, items))
+            if not in_flight:
+                break
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            failures = []
+            for future in finished:
+                for key, reports, error in future.result():
+                    size, mtime_ns = meta.pop(key)
+                    stats.files += 1
+                    if error:
+                        stats.failed += 1
+                        logger.error(f"Failed to read message {key}: {error}")
+                        failures.append((key, size, mtime_ns, 'failed', None, error))
+                        continue
+                    attachments += len(reports)
+                    for filename, _, _, _, parse_error in reports:
+                        if parse_error:
+                            stats.failed += 1
+                            logger.error(f"Failed to parse {filename} in message {key}: {parse_error}")
+                    batch.append((key, size, mtime_ns, reports))
+                    batch_reports += len(reports)
+            if failures:
+                save_checkpoints(failures)
+            if batch_reports >= batch_size or len(batch) >= batch_size * 4:
+                flush()
+            stats.report()
+        flush()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        stats.report(force=True)
+
+    seconds = time.monotonic() - stats.started
+    return {
+        "messages": len(pending) + skipped,
+        "skipped": skipped,
+        "attachments": attachments,
+        "saved": stats.reports,
+        "failed": stats.failed,
+        "records": stats.records,
+        "seconds": round(seconds, 2),
+        "messages_per_sec": round(stats.files / seconds, 1) if seconds > 0 else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Import DMARC reports from Maildir directories and mbox files (resumable).")
+    parser.add_argument("paths", nargs="+", help="Maildir directories, mbox files, or directories containing them")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Reports per database commit")
+    parser.add_argument("--no-resume", action="store_true", help="Ignore checkpoints and re-import every message")
+    parser.add_argument("--retry-failed", action="store_true", help="Retry messages that failed in an earlier run")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
+    try:
+        summary = mail_import(
+            args.paths, workers=args.workers, batch_size=args.batch_size,
+            resume=not args.no_resume, retry_failed=args.retry_failed,
+        )
+    except KeyboardInterrupt:
+        print("Interrupted - run the same command again to resume.", file=sys.stderr)
+        return 130
+    print(f"Done: {summary['messages'] - summary['skipped']} messages ({summary['messages_per_sec']}/s), "
+          f"{summary['attachments']} report attachments, {summary['saved']} reports saved "
+          f"({summary['records']} records), {summary['failed']} failed, {summary['skipped']} skipped "
+          f"in {summary['seconds']}s")
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,331 @@
+"""
+Scheduled polling of one or more IMAP mailboxes for DMARC reports.
+
+Every configured mailbox gets its own task: it syncs on an interval over a
+connection that is kept open between polls, backs off exponentially while
+the server is failing, and keeps metrics (messages, bytes, latency, last
+success). New attachments are handed to an async `ingest(attachments,
+source)` callable - normally IngestWorkers.submit_payloads - one UID batch
+at a time. The batch's checkpoint is committed as soon as `ingest` returns,
+so it must not return before the payloads are on disk with a job row.
+
+The API starts a MailPoller from its lifespan (MAIL_POLLER_IN_API), or it
+runs as its own process. That process only writes the attachments to disk
+(RAW_ARCHIVE_DIR or INGEST_SPILL_DIR) and queues them; the API's ingest
+workers parse and save them. It starts no workers of its own, since their
+startup would re-queue the jobs the API is running as interrupted.
+
+Usage: python -m backend.dmarc_lib.mail_poller [--interval SECONDS] [--once]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .db import get_setting
+from .email_fetch import commit_checkpoint, connect, sync_mailbox, sync_state_key
+
+logger = logging.getLogger(__name__)
+
+IMAP_POLL_INTERVAL = float(os.environ.get("IMAP_POLL_INTERVAL", "300"))   # seconds between polls
+IMAP_BACKOFF_BASE = float(os.environ.get("IMAP_BACKOFF_BASE", "30"))      # first retry delay, doubled per failure
+IMAP_BACKOFF_MAX = float(os.environ.get("IMAP_BACKOFF_MAX", "1800"))
+
+
+def get_mailbox_configs() -> list[dict]:
+    """
+    Mailboxes to poll: every entry of the `imap_mailboxes` setting (a list of
+    {name, host, port, user, pass, use_ssl, mailbox, interval}) plus the
+    single account from imap_host/imap_user/imap_pass, if set.
+    """
+    configs = []
+    entries = list(get_setting("imap_mailboxes") or [])
+    if get_setting("imap_host") and get_setting("imap_user") and get_setting("imap_pass"):
+        entries.append({
+            "name": "default",
+            "host": get_setting("imap_host"),
+            "port": get_setting("imap_port", 993),
+            "user": get_setting("imap_user"),
+            "pass": get_setting("imap_pass"),
+            "use_ssl": get_setting("imap_use_ssl", True),
+            "mailbox": get_setting("imap_mailbox", "INBOX"),
+        })
+    seen = set()
+    names = set()
+    for entry in entries:
+        if not (entry.get("host") and entry.get("user") and entry.get("pass")):
+            logger.warning(f"Skipping incomplete IMAP mailbox config {entry.get('name') or entry.get('host')!r}")
+            continue
+        config = {
+            "host": entry["host"],
+            "port": int(entry.get("port") or (993 if entry.get("use_ssl", True) else 143)),
+            "user": entry["user"],
+            "pass": entry["pass"],
+            "use_ssl": bool(entry.get("use_ssl", True)),
+            "mailbox": entry.get("mailbox") or "INBOX",
+            "interval": entry.get("interval"),
+        }
+        key = (config["host"], config["user"], config["mailbox"])
+        if key in seen:
+            continue
+        seen.add(key)
+        name = entry.get("name") or f"{config['user']}@{config['host']}/{config['mailbox']}"
+        if name in names:
+            name = f"{name} ({config['user']}@{config['host']}/{config['mailbox']})"
+        names.add(name)
+        config["name"] = name
+        configs.append(config)
+    return configs
+
+
+class MailboxPoller:
+    """One mailbox: a reusable IMAP connection, backoff state and metrics. Blocking; runs in a thread."""
+
+    def __init__(self, config: dict, interval: float = IMAP_POLL_INTERVAL):
+        self.config = config
+        self.name = config["name"]
+        self.interval = float(config.get("interval") or interval)
+        self.state_key = sync_state_key(config["host"], config["user"], config["mailbox"])
+        self._mail = None
+        self._lock = threading.Lock()  # scheduled and on-demand polls share the connection
+        self.failures = 0
+        self.metrics = {
+            "polls": 0, "errors": 0, "messages": 0, "attachments": 0, "bytes": 0,
+            "last_latency_ms": None, "last_success": None, "last_error": None, "last_error_at": None,
+        }
+
+    def next_delay(self) -> float:
+        if not self.failures:
+            return self.interval
+        return min(IMAP_BACKOFF_MAX, IMAP_BACKOFF_BASE * 2 ** (self.failures - 1))
+
+    def _connection(self):
+        if self._mail is not None:
+            try:
+                self._mail.noop()
+                return self._mail
+            except Exception:
+                self._drop()
+        c = self.config
+        self._mail = connect(c["host"], c["port"], c["user"], c["pass"], c["use_ssl"])
+        return self._mail
+
+    def _drop(self):
+        mail, self._mail = self._mail, None
+        if mail is not None:
+            try:
+                mail.shutdown()
+            except Exception:
+                pass
+
+    def record_error(self, e: Exception):
+        self.failures += 1
+        self.metrics["errors"] += 1
+        self.metrics["last_error"] = f"{type(e).__name__}: {e}"
+        self.metrics["last_error_at"] = time.time()
+
+    def sync(self):
+        """
+        Sync once: a generator of (attachments, checkpoint) per UID batch
+        (see sync_mailbox), each checkpoint to be committed after its batch
+        is ingested. Step it with next_batch() and finish with end_sync();
+        a failure is recorded and raised from next_batch().
+        """
+        started = time.perf_counter()
+        stats = {}
+        self.metrics["polls"] += 1
+        try:
+            yield from sync_mailbox(self._connection(), self.state_key, self.config["mailbox"], stats=stats)
+        except Exception as e:
+            # The connection may be half-dead; start clean next time
+            self._drop()
+            self.record_error(e)
+            raise
+        finally:
+            self.metrics["last_latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            for key in ("messages", "attachments", "bytes"):
+                self.metrics[key] += stats.get(key, 0)
+        self.failures = 0
+        self.metrics["last_success"] = time.time()
+
+    def next_batch(self, batches) -> tuple[list[tuple[str, bytes]], dict] | None:
+        """Fetch the next batch of a sync() on the shared connection; None once it is done."""
+        with self._lock:
+            return next(batches, None)
+
+    def end_sync(self, batches):
+        """Finish a sync() early or late, e.g. after an ingest failure."""
+        with self._lock:
+            batches.close()
+
+    def close(self):
+        with self._lock:
+            if self._mail is not None:
+                try:
+                    self._mail.logout()
+                except Exception:
+                    pass
+                self._mail = None
+
+    def status(self) -> dict:
+        c = self.config
+        return {
+            "name": self.name, "host": c["host"], "user": c["user"], "mailbox": c["mailbox"],
+            "interval": self.interval, "connected": self._mail is not None,
+            "consecutive_failures": self.failures, **self.metrics,
+        }
+
+
+class MailPoller:
+    """
+    Runs a MailboxPoller per configured mailbox concurrently. IMAP sessions
+    use a dedicated thread pool so slow servers never hold up SQLite work.
+    """
+
+    def __init__(self, ingest, interval: float = IMAP_POLL_INTERVAL, source: str = "email"):
+        self.ingest = ingest
+        self.interval = interval
+        self.source = source
+        self.mailboxes: dict[str, MailboxPoller] = {}
+        self._executor = None
+        self._tasks = []
+        self._schedule = True
+        self._next_poll: dict[str, float] = {}
+        self._cycles: dict[str, asyncio.Lock] = {}
+
+    async def start(self, schedule: bool = True):
+        """Load the mailbox configs and, with `schedule`, start polling each on its interval."""
+        self._schedule = schedule
+        loop = asyncio.get_running_loop()
+        configs = await loop.run_in_executor(None, get_mailbox_configs)
+        self.mailboxes = {c["name"]: MailboxPoller(c, self.interval) for c in configs}
+        self._cycles = {name: asyncio.Lock() for name in self.mailboxes}
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.mailboxes)),
+                                            thread_name_prefix="dmarc-imap")
+        if schedule and self.mailboxes:
+            self._tasks = [asyncio.create_task(self._run(m)) for m in self.mailboxes.values()]
+            logger.info(f"Polling {len(self.mailboxes)} IMAP mailbox(es)")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(self._executor, m.close)
+                                   for m in self.mailboxes.values()), return_exceptions=True)
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def reload(self):
+        """Pick up changed mailbox settings."""
+        await self.stop()
+        await self.start(self._schedule)
+
+    async def poll_mailbox(self, mailbox: MailboxPoller) -> dict:
+        """
+        Poll one mailbox now and ingest what it returns, batch by batch. A
+        batch's checkpoint is committed once `ingest` has returned for it,
+        so `ingest` must only return after the payloads are durable (on disk
+        and in the job queue). If a batch fails, the batches before it stay
+        committed and the rest is fetched again on the next poll.
+        """
+        loop = asyncio.get_running_loop()
+        files, job_ids = [], []
+        # One sync/ingest/commit cycle per mailbox at a time, or a second poll
+        # would fetch the same messages before the first one commits them
+        async with self._cycles[mailbox.name]:
+            batches = mailbox.sync()
+            try:
+                while True:
+                    try:
+                        batch = await loop.run_in_executor(self._executor, mailbox.next_batch, batches)
+                    except Exception as e:
+                        logger.error(f"IMAP poll of {mailbox.name} failed (attempt {mailbox.failures}): {e}")
+                        return {"mailbox": mailbox.name, "error": mailbox.metrics["last_error"],
+                                "files": files, "jobs": job_ids}
+                    if batch is None:
+                        break
+                    attachments, checkpoint = batch
+                    try:
+                        batch_jobs = await self.ingest(attachments, self.source) if attachments else []
+                        # The messages are only skipped from now on, once their reports are queued
+                        await loop.run_in_executor(self._executor, commit_checkpoint, checkpoint)
+                    except Exception as e:
+                        mailbox.record_error(e)
+                        logger.error(f"Ingest of {len(attachments)} report(s) from {mailbox.name} failed; "
+                                     f"they will be fetched again: {e}")
+                        return {"mailbox": mailbox.name, "error": mailbox.metrics["last_error"],
+                                "files": files, "jobs": job_ids}
+                    files += [name for name, _ in attachments]
+                    job_ids += batch_jobs
+            finally:
+                await loop.run_in_executor(self._executor, mailbox.end_sync, batches)
+        return {"mailbox": mailbox.name, "files": files, "jobs": job_ids}
+
+    async def poll_all(self) -> list[dict]:
+        """Poll every mailbox concurrently (e.g. on demand from the API)."""
+        return list(await asyncio.gather(*(self.poll_mailbox(m) for m in self.mailboxes.values())))
+
+    async def _run(self, mailbox: MailboxPoller):
+        while True:
+            await self.poll_mailbox(mailbox)
+            delay = mailbox.next_delay()
+            self._next_poll[mailbox.name] = time.time() + delay
+            await asyncio.sleep(delay)
+
+    def status(self) -> list[dict]:
+        return [{**m.status(), "next_poll_at": self._next_poll.get(name)} for name, m in self.mailboxes.items()]
+
+
+async def _serve(interval: float, once: bool):
+    from .db import init_db
+    from .jobs import queue_payloads
+
+    init_db()
+    db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dmarc-db")
+
+    async def ingest(attachments, source):
+        # Queued only: the API's workers pick the jobs up from ingest_jobs
+        return await asyncio.get_running_loop().run_in_executor(db_executor, queue_payloads, attachments, source)
+
+    poller = MailPoller(ingest, interval=interval)
+    try:
+        if once:
+            await poller.start(schedule=False)
+            results = await poller.poll_all()
+            for result in results:
+                print(f"{result['mailbox']}: {len(result['files'])} new report(s) queued"
+                      + (f", error: {result['error']}" if result.get("error") else ""))
+            return 1 if any(r.get("error") for r in results) else 0
+        await poller.start()
+        if not poller.mailboxes:
+            print("No IMAP mailboxes configured.", file=sys.stderr)
+            return 1
+        await asyncio.Event().wait()
+    finally:
+        await poller.stop()
+        db_executor.shutdown(wait=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Poll the configured IMAP mailboxes for DMARC reports.")
+    parser.add_argument("--interval", type=float, default=IMAP_POLL_INTERVAL,
+                        help="Seconds between polls of each mailbox (default: IMAP_POLL_INTERVAL)")
+    parser.add_argument("--once", action="store_true", help="Poll every mailbox once and exit")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    try:
+        return asyncio.run(_serve(args.interval, args.once))
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
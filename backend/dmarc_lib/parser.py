@@ -1,42 +1,120 @@
-import xmltodict
 import gzip
+import io
 import zipfile
 import os
 import lzma
+from contextlib import contextmanager
+from xml.etree import ElementTree as ET
 
 MAX_REPORT_BYTES = int(os.environ.get("DMARC_MAX_REPORT_BYTES", str(20 * 1024 * 1024)))
+READ_CHUNK_BYTES = 64 * 1024
 
-def _read_with_limit(stream, max_bytes: int) -> bytes:
-    chunks = []
-    total = 0
-    while True:
-        chunk = stream.read(1024 * 1024)
-        if not chunk:
-            break
-        total += len(chunk)
-        if total > max_bytes:
+
+class _LimitedReader:
+    """File-like wrapper that raises once more than max_bytes have been read."""
+
+    def __init__(self, stream, max_bytes: int):
+        self._stream = stream
+        self._max_bytes = max_bytes
+        self.total = 0
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._stream.read(size)
+        self.total += len(chunk)
+        if self.total > self._max_bytes:
             raise ValueError("Report exceeds maximum allowed size")
-        chunks.append(chunk)
-    return b"".join(chunks)
+        return chunk
+
+
+REPORT_FORMATS = ("xml", "gz", "xz", "zip")
+_MAGIC = ((b"\x1f\x8b", "gz"), (b"\xfd7zXZ\x00", "xz"), (b"PK\x03\x04", "zip"))
+
 
-def parse_report(file_path, max_bytes: int = MAX_REPORT_BYTES):
+def report_format(filename) -> str:
+    """Format hint for a report file name: 'gz', 'xz', 'zip', or 'xml' for anything else."""
+    name = str(filename).lower()
+    for fmt in ("gz", "xz", "zip"):
+        if name.endswith("." + fmt):
+            return fmt
+    return "xml"
+
+
+def sniff_format(head: bytes) -> str:
+    """Format of a report from its first bytes (compression magic), defaulting to 'xml'."""
+    for magic, fmt in _MAGIC:
+        if head.startswith(magic):
+            return fmt
+    return "xml"
+
+
+@contextmanager
+def _open_report(source, max_bytes: int, format: str | None = None):
     """
-    Parses a DMARC report XML file (or .gz/.zip archive).
-    Returns a dictionary with report metadata and records.
+    Open a report as a size-limited binary stream of XML. `source` is a
+    path, the raw bytes of a report, or a binary file object; `format`
+    ('xml', 'gz', 'xz', 'zip') defaults to the file extension for paths and
+    to sniffing the magic bytes otherwise.
     """
-    
-    content = None
-    
-    # Handle different file types
-    file_path_str = str(file_path)
-    if file_path_str.endswith(".gz"):
-        with gzip.open(file_path, "rb") as f:
-            content = _read_with_limit(f, max_bytes)
-    elif file_path_str.endswith(".xz"):
-        with lzma.open(file_path, "rb") as f:
-            content = _read_with_limit(f, max_bytes)
-    elif file_path_str.endswith(".zip"):
-        with zipfile.ZipFile(file_path, "r") as z:
+    if format is not None and format not in REPORT_FORMATS:
+        raise ValueError(f"Unknown report format: {format}")
+    if isinstance(source, (str, os.PathLike)):
+        fmt = format or report_format(source)
+        if fmt == "xml" and os.path.getsize(source) > max_bytes:
+            raise ValueError("Report exceeds maximum allowed size")
+        with open(source, "rb") as raw:
+            with _decompress(raw, fmt, max_bytes) as stream:
+                yield stream
+        return
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        raw = io.BytesIO(source)
+    else:
+        raw = source
+    if format is None:
+        if hasattr(raw, "seekable") and raw.seekable():
+            pos = raw.tell()
+            head = raw.read(8)
+            raw.seek(pos)
+        else:
+            head = raw.read(8)
+            raw = _Prefixed(head, raw)
+        format = sniff_format(head)
+    with _decompress(raw, format, max_bytes) as stream:
+        yield stream
+
+
+class _Prefixed:
+    """Re-attach bytes already read from a non-seekable stream."""
+
+    def __init__(self, prefix: bytes, stream):
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if not self._prefix:
+            return self._stream.read(size)
+        if size is None or size < 0:
+            data, self._prefix = self._prefix + self._stream.read(), b""
+            return data
+        data, self._prefix = self._prefix[:size], self._prefix[size:]
+        if len(data) < size:
+            data += self._stream.read(size - len(data))
+        return data
+
+
+@contextmanager
+def _decompress(raw, fmt: str, max_bytes: int):
+    if fmt == "gz":
+        with gzip.GzipFile(fileobj=raw, mode="rb") as f:
+            yield _LimitedReader(f, max_bytes)
+    elif fmt == "xz":
+        with lzma.LZMAFile(raw, "rb") as f:
+            yield _LimitedReader(f, max_bytes)
+    elif fmt == "zip":
+        if not (hasattr(raw, "seekable") and raw.seekable()):
+            # Zip needs random access to its central directory
+            raw = io.BytesIO(_LimitedReader(raw, max_bytes).read())
+        with zipfile.ZipFile(raw, "r") as z:
             # Assume first XML file in zip is the report
             xml_name = None
             for name in z.namelist():
@@ -49,60 +127,131 @@ def parse_report(file_path, max_bytes: int = MAX_REPORT_BYTES):
             if info.file_size > max_bytes:
                 raise ValueError("Report exceeds maximum allowed size")
             with z.open(xml_name) as f:
-                content = _read_with_limit(f, max_bytes)
+                yield _LimitedReader(f, max_bytes)
     else:
-        if os.path.getsize(file_path_str) > max_bytes:
-            raise ValueError("Report exceeds maximum allowed size")
-        with open(file_path, "rb") as f:
-            content = _read_with_limit(f, max_bytes)
-            
-    if not content:
-        raise ValueError("Could not read content from file")
-
-    data = xmltodict.parse(content)
-    
-    # Navigate the structure (depending on XML variance, this might need robustness)
-    # Generic DMARC XML structure: feedback > report_metadata, policy_published, record[]
-    
-    feedback = data.get('feedback', {})
-    report_metadata = feedback.get('report_metadata', {})
-    policy_published = feedback.get('policy_published', {})
-    records_raw = feedback.get('record', [])
-    
-    # xmltodict returns a dict if single child, list if multiple. Normalize to list.
-    if isinstance(records_raw, dict):
-        records = [records_raw]
-    else:
-        records = records_raw
-        
-    parsed_data = {
+        yield _LimitedReader(raw, max_bytes)
+
+
+def _local(tag: str) -> str:
+    """Strip any XML namespace from a tag (DMARC 2.0 reports are namespaced)."""
+    return tag.rsplit("}", 1)[-1]
+
+
+def _text(elem, *path):
+    """Return the text of a nested child element, or None if it is missing."""
+    for name in path:
+        if elem is None:
+            return None
+        elem = next((child for child in elem if _local(child.tag) == name), None)
+    if elem is None or elem.text is None:
+        return None
+    return elem.text.strip()
+
+
+def _normalize_record(rec) -> dict:
+    return {
+        'source_ip': _text(rec, 'row', 'source_ip'),
+        'count': int(_text(rec, 'row', 'count') or 0),
+        'disposition': _text(rec, 'row', 'policy_evaluated', 'disposition'),
+        'dkim': _text(rec, 'row', 'policy_evaluated', 'dkim'),
+        'spf': _text(rec, 'row', 'policy_evaluated', 'spf'),
+        # You could add other authentication results here if needed
+    }
+
+
+def _iter_report(source, max_bytes: int, format: str | None = None):
+    """
+    Incrementally parse a report.
+    Yields the header dict ({'metadata', 'policy'}) first, then one normalized
+    dict per <record>. Each <record> element is discarded once it is handled,
+    so memory stays flat regardless of how many rows the report contains.
+    Reports that put <report_metadata> or <policy_published> after their
+    records are still parsed correctly: records are held back until both
+    header elements have been seen (or the document ends).
+    """
+    with _open_report(source, max_bytes, format) as stream:
+        report_metadata = None
+        policy_published = None
+        header_sent = False
+        pending = []  # records read before the header was complete
+        root = None
+        try:
+            for event, elem in ET.iterparse(stream, events=("start", "end")):
+                if event == "start":
+                    if root is None:
+                        root = elem
+                    continue
+                tag = _local(elem.tag)
+                if tag == "report_metadata":
+                    report_metadata = elem
+                elif tag == "policy_published":
+                    policy_published = elem
+                elif tag == "record":
+                    pending.append(_normalize_record(elem))
+                    # Drop the handled record (and anything else already seen) from the tree;
+                    # header elements we hold a reference to stay intact
+                    elem.clear()
+                    root.clear()
+                else:
+                    continue
+                if not pending:
+                    continue
+                if not header_sent:
+                    if report_metadata is None or policy_published is None:
+                        continue
+                    header_sent = True
+                    yield _build_header(report_metadata, policy_published)
+                yield from pending
+                pending.clear()
+        except ET.ParseError:
+            if stream.total == 0:
+                raise ValueError("Could not read content from file")
+            raise
+        if not header_sent:
+            yield _build_header(report_metadata, policy_published)
+        yield from pending
+
+
+def _build_header(report_metadata, policy_published) -> dict:
+    return {
         'metadata': {
-            'org_name': report_metadata.get('org_name'),
-            'email': report_metadata.get('email'),
-            'report_id': report_metadata.get('report_id'),
-            'date_range_begin': report_metadata.get('date_range', {}).get('begin'),
-            'date_range_end': report_metadata.get('date_range', {}).get('end'),
+            'org_name': _text(report_metadata, 'org_name'),
+            'email': _text(report_metadata, 'email'),
+            'report_id': _text(report_metadata, 'report_id'),
+            'date_range_begin': _text(report_metadata, 'date_range', 'begin'),
+            'date_range_end': _text(report_metadata, 'date_range', 'end'),
         },
         'policy': {
-            'domain': policy_published.get('domain'),
-            'p': policy_published.get('p'),
-            'sp': policy_published.get('sp'),
-            'pct': policy_published.get('pct'),
+            'domain': _text(policy_published, 'domain'),
+            'p': _text(policy_published, 'p'),
+            'sp': _text(policy_published, 'sp'),
+            'pct': _text(policy_published, 'pct'),
         },
-        'records': []
     }
-    
-    for rec in records:
-        row = rec.get('row', {})
-        policy_eval = row.get('policy_evaluated', {})
-        
-        parsed_data['records'].append({
-            'source_ip': row.get('source_ip'),
-            'count': int(row.get('count', 0)),
-            'disposition': policy_eval.get('disposition'),
-            'dkim': policy_eval.get('dkim'),
-            'spf': policy_eval.get('spf'),
-            # You could add other authentication results here if needed
-        })
-        
+
+
+def parse_report_stream(source, max_bytes: int = MAX_REPORT_BYTES, format: str | None = None):
+    """
+    Streaming variant of parse_report.
+    Returns the same dictionary shape, but 'records' is a generator that reads
+    the (decompressed) report incrementally. The underlying file stays open
+    until the generator is exhausted or closed, and the records can only be
+    iterated once - save_report consumes them directly.
+    """
+    events = _iter_report(source, max_bytes, format)
+    parsed_data = next(events)
+    parsed_data['records'] = events
+    return parsed_data
+
+
+def parse_report(source, max_bytes: int = MAX_REPORT_BYTES, format: str | None = None):
+    """
+    Parses a DMARC report XML file (or .gz/.zip/.xz archive).
+    `source` is a file path, the report's raw bytes, or a binary file object;
+    `format` ('xml', 'gz', 'xz', 'zip') overrides detection from the file
+    extension (paths) or magic bytes (bytes / file objects).
+    Returns a dictionary with report metadata and records.
+    """
+    parsed_data = parse_report_stream(source, max_bytes, format)
+    parsed_data['records'] = list(parsed_data['records'])
     return parsed_data
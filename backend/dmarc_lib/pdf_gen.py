@@ -1,11 +1,24 @@
 from fpdf import FPDF
+import asyncio
 import datetime
+import functools
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, Future
 from typing import Dict, Any, List
 import matplotlib.pyplot as plt
 import io
+import threading
 import matplotlib
 matplotlib.use('Agg') # Headless backend
 
+logger = logging.getLogger(__name__)
+
+# pyplot keeps global state and is not thread-safe; PDFs may be rendered
+# from several worker threads at once.
+_pyplot_lock = threading.Lock()
+
 class DMARCReportPDF(FPDF):
     def header(self):
         # Logo placeholder or icon
@@ -45,6 +58,10 @@ def _create_pie_chart(disposition_stats: Dict[str, int]) -> io.BytesIO:
     if not sizes:
         return None
         
+    with _pyplot_lock:
+        return _render_pie_chart(labels, sizes, colors)
+
+def _render_pie_chart(labels, sizes, colors) -> io.BytesIO:
     fig, ax = plt.subplots(figsize=(4, 3))
     ax.pie(sizes, labels=labels, autopct='%1.1f%%', startangle=90, colors=colors, textprops={'fontsize': 8})
     ax.axis('equal')
@@ -60,6 +77,10 @@ def _create_volume_chart(volume_series: List[Dict[str, Any]]) -> io.BytesIO:
     if not volume_series:
         return None
         
+    with _pyplot_lock:
+        return _render_volume_chart(volume_series)
+
+def _render_volume_chart(volume_series: List[Dict[str, Any]]) -> io.BytesIO:
     dates = [d['name'] for d in volume_series]
     pass_v = [d.get('pass', 0) for d in volume_series]
     fail_v = [d.get('quarantine', 0) + d.get('reject', 0) for d in volume_series]
@@ -182,3 +203,87 @@ def generate_summary_pdf(stats: Dict[str, Any], date_range: str) -> bytes:
             pdf.cell(w[3], h, str(item['pass_count']), border=1, ln=True)
 
     return pdf.output()
+
+
+def render_summary_pdf(stats: Dict[str, Any], date_range: str) -> bytes:
+    """generate_summary_pdf as plain bytes (picklable result for worker processes)."""
+    return bytes(generate_summary_pdf(stats, date_range))
+
+
+def pdf_fingerprint(stats_json: bytes, date_range: str) -> str:
+    """Cache key of a summary PDF: the serialized stats it is built from plus the period label."""
+    return hashlib.sha256(stats_json + b"\0" + date_range.encode("utf-8")).hexdigest()
+
+
+class PDFRenderer:
+    """
+    Renders summary PDFs in an executor (normally a process pool, so
+    matplotlib and FPDF neither block the event loop nor hold the GIL) and
+    keeps the most recent results in an LRU cache keyed by pdf_fingerprint.
+    Concurrent requests for the same key share one render; a render that
+    outlives `timeout` keeps going and is cached when it finishes.
+    """
+
+    def __init__(self, executor_factory, timeout: float = 60, cache_size: int = 32, render=render_summary_pdf):
+        self.executor_factory = executor_factory
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.render_fn = render
+        self._executor = None
+        self._cache: OrderedDict[str, bytes] = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        # Renders finish on executor callback threads
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            pdf = self._cache.get(key)
+            if pdf is not None:
+                self._cache.move_to_end(key)
+            return pdf
+
+    def _finished(self, key: str, future: Future):
+        exc = None if future.cancelled() else future.exception()
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+            if future.cancelled() or exc is not None:
+                broken = isinstance(exc, BrokenExecutor)
+            else:
+                broken = False
+                self._cache[key] = future.result()
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        if broken:
+            # A worker died (e.g. out of memory); start a fresh pool next time
+            logger.error(f"PDF render pool broke: {exc}")
+            self.close()
+
+    def _submit(self, key: str, stats: Dict[str, Any], date_range: str) -> Future:
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                if self._executor is None:
+                    self._executor = self.executor_factory()
+                future = self._inflight[key] = self._executor.submit(self.render_fn, stats, date_range)
+                submitted = True
+            else:
+                submitted = False
+        if submitted:
+            future.add_done_callback(functools.partial(self._finished, key))
+        return future
+
+    async def render(self, key: str, stats: Dict[str, Any], date_range: str) -> bytes:
+        """Cached PDF for `key`, rendering it if needed. Raises asyncio.TimeoutError after `timeout`."""
+        pdf = self.get(key)
+        if pdf is not None:
+            return pdf
+        future = self._submit(key, stats, date_range)
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
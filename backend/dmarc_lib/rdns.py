@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import dns.asyncresolver
+import dns.exception
+import dns.resolver
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated resolver IPs; empty means use the system configuration (/etc/resolv.conf)
+RDNS_NAMESERVERS = [ns.strip() for ns in os.environ.get("RDNS_NAMESERVERS", "").split(",") if ns.strip()]
+RDNS_TIMEOUT = float(os.environ.get("RDNS_TIMEOUT", "2.0"))
+RDNS_CONCURRENCY = int(os.environ.get("RDNS_CONCURRENCY", "20"))
+RDNS_CACHE_TTL = int(os.environ.get("RDNS_CACHE_TTL", "3600"))
+RDNS_NEGATIVE_TTL = int(os.environ.get("RDNS_NEGATIVE_TTL", "300"))
+RDNS_CACHE_SIZE = int(os.environ.get("RDNS_CACHE_SIZE", "10000"))
+
+
+class ReverseResolver:
+    """
+    Async PTR lookups with a per-lookup time limit, bounded concurrency and an
+    in-memory TTL cache. Failures (NXDOMAIN, no answer, timeout) are cached for
+    the shorter negative TTL so unresolvable senders are not retried on every
+    report view.
+    """
+
+    def __init__(self, nameservers: list[str] | None = None, port: int = 53,
+                 timeout: float = RDNS_TIMEOUT, concurrency: int = RDNS_CONCURRENCY,
+                 ttl: int = RDNS_CACHE_TTL, negative_ttl: int = RDNS_NEGATIVE_TTL,
+                 cache_size: int = RDNS_CACHE_SIZE):
+        if nameservers:
+            self.resolver = dns.asyncresolver.Resolver(configure=False)
+            self.resolver.nameservers = nameservers
+        else:
+            try:
+                self.resolver = dns.asyncresolver.Resolver()
+            except dns.resolver.NoResolverConfiguration:
+                logger.warning("No system DNS configuration; reverse DNS lookups disabled")
+                self.resolver = None
+        if self.resolver is not None:
+            self.resolver.port = port
+            self.resolver.timeout = timeout
+            self.resolver.lifetime = timeout
+        self.concurrency = concurrency
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, tuple[float, str | None]] = OrderedDict()
+        # asyncio primitives belong to one event loop; CLI scripts call asyncio.run repeatedly
+        self._semaphores: dict[asyncio.AbstractEventLoop, asyncio.Semaphore] = {}
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        sem = self._semaphores.get(loop)
+        if sem is None:
+            self._semaphores = {l: s for l, s in self._semaphores.items() if not l.is_closed()}
+            sem = self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return sem
+
+    def _cached(self, ip: str) -> tuple[bool, str | None]:
+        entry = self._cache.get(ip)
+        if entry is None:
+            return False, None
+        expires, hostname = entry
+        if expires < time.monotonic():
+            del self._cache[ip]
+            return False, None
+        self._cache.move_to_end(ip)
+        return True, hostname
+
+    def _remember(self, ip: str, hostname: str | None):
+        ttl = self.ttl if hostname else self.negative_ttl
+        self._cache[ip] = (time.monotonic() + ttl, hostname)
+        self._cache.move_to_end(ip)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def resolve(self, ip: str) -> str | None:
+        hit, hostname = self._cached(ip)
+        if hit or self.resolver is None:
+            return hostname
+        hostname = None
+        async with self._semaphore():
+            # Another task may have resolved it while we waited for a slot
+            hit, cached = self._cached(ip)
+            if hit:
+                return cached
+            try:
+                answer = await self.resolver.resolve_address(ip)
+                hostname = answer[0].target.to_text(omit_final_dot=True)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers,
+                    dns.exception.Timeout):
+                pass
+            except (dns.exception.DNSException, ValueError) as e:
+                logger.debug(f"Reverse DNS failed for {ip}: {e}")
+        self._remember(ip, hostname)
+        return hostname
+
+
+_resolver = None
+
+
+def get_reverse_resolver() -> ReverseResolver:
+    """Return the shared resolver configured from the RDNS_* settings."""
+    global _resolver
+    if _resolver is None:
+        _resolver = ReverseResolver(RDNS_NAMESERVERS or None)
+    return _resolver
+
+
+def set_reverse_resolver(resolver: ReverseResolver | None):
+    """Replace the shared resolver (None rebuilds it from settings on next use)."""
+    global _resolver
+    _resolver = resolver
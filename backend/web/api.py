@@ -1,7 +1,7 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException, UploadFile, File, Depends, Request, Response
+from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, Request, Response
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials, APIKeyHeader
 from typing import List, Optional
 from pydantic import BaseModel
@@ -9,6 +9,14 @@ import jwt
 import datetime
 import bcrypt
 import logging
+import asyncio
+import csv
+import functools
+import hashlib
+import io
+import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
@@ -33,26 +41,90 @@ import datetime
 # Ensure project root is in path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
 
-from backend.dmarc_lib.parser import parse_report
+# Loads .env, so it must come before the dmarc_lib modules read their settings from the environment
+import backend.web.config as config
 from backend.dmarc_lib.db import (
-    init_db, save_report, get_stats, get_reports_list, 
+    init_db, close_db, get_stats, get_reports_list, 
     get_report_detail, delete_reports, get_domain_stats, 
     get_user_profile, update_user_profile, get_user_by_username,
     list_users, create_user, delete_user,
     create_api_key, get_api_keys_for_user, delete_api_key,
     get_user_by_api_key, get_api_key_owner,
-    get_setting, set_setting
+    get_setting, set_setting, get_data_generation,
+    get_user_by_username_cached, flush_api_key_usage,
+    iter_export_records, EXPORT_COLUMNS, get_stats_summary, sha256_bytes
 )
+from backend.dmarc_lib import enrichment
 from backend.dmarc_lib.enrichment import batch_enrich_ips
-from backend.dmarc_lib.pdf_gen import generate_summary_pdf
+from backend.dmarc_lib.geoip import get_geoip_db
+from backend.dmarc_lib.jobs import IngestWorkers, enqueue_jobs, get_job_stats, process_pool, spill_payload
+from backend.dmarc_lib.parser import sniff_format
+from backend.dmarc_lib.pdf_gen import PDFRenderer, pdf_fingerprint
 from backend.dmarc_lib.alerts import check_for_spikes
-from backend.dmarc_lib.email_fetch import fetch_dmarc_reports
-import backend.web.config as config
+from backend.dmarc_lib.email_fetch import commit_checkpoint, fetch_dmarc_reports
+from backend.dmarc_lib.mail_poller import MailPoller
+
+# Blocking work never runs on the event loop: SQLite and file/IMAP I/O go to
+# the DB pool, bcrypt to the CPU pool and summary PDFs to pdf_renderer's own
+# pool. All are bounded so a burst of slow requests queues instead of
+# spawning unbounded threads.
+db_executor = ThreadPoolExecutor(max_workers=config.DB_POOL_SIZE, thread_name_prefix="dmarc-db")
+cpu_executor = ThreadPoolExecutor(max_workers=config.CPU_POOL_SIZE, thread_name_prefix="dmarc-cpu")
+
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking DB/I-O call in the DB pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(fn, *args, **kwargs))
+
+async def run_cpu(fn, *args, **kwargs):
+    """Run a CPU-bound call (bcrypt) in the CPU pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cpu_executor, functools.partial(fn, *args, **kwargs))
+
+# The pool is started on the first render and shut down with the app
+pdf_renderer = PDFRenderer(
+    (lambda: process_pool(config.PDF_WORKERS)) if config.PDF_USE_PROCESSES
+    else (lambda: ThreadPoolExecutor(max_workers=config.PDF_WORKERS, thread_name_prefix="dmarc-pdf")),
+    timeout=config.PDF_RENDER_TIMEOUT, cache_size=config.PDF_CACHE_SIZE,
+)
+
+async def _flush_api_key_usage_periodically():
+    """Write buffered API key last_used_at times in one batch every interval."""
+    while True:
+        await asyncio.sleep(config.API_KEY_USAGE_FLUSH_INTERVAL)
+        try:
+            await run_db(flush_api_key_usage)
+        except Exception as e:
+            logger.error(f"Failed to flush API key usage: {e}")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     init_db()
+    # Load the offline GeoIP ranges (if configured) before the first lookup needs them
+    await run_db(get_geoip_db)
+    # One pooled, rate-limited ip-api.com client shared by every request
+    geoip_client = enrichment.GeoIPClient() if enrichment.GEOIP_HTTP_FALLBACK else None
+    enrichment.set_geoip_client(geoip_client)
+    # Drain the ingest queue, including jobs left over from before a restart
+    app.state.ingest_workers = IngestWorkers(db_executor, on_saved=check_for_spikes, spill_dir=UPLOAD_DIR)
+    await app.state.ingest_workers.start()
+    # IMAP mailboxes feed the ingest workers directly; polled on a schedule unless another process does it
+    app.state.mail_poller = MailPoller(app.state.ingest_workers.submit_payloads)
+    await app.state.mail_poller.start(schedule=config.MAIL_POLLER_IN_API)
+    usage_flusher = asyncio.create_task(_flush_api_key_usage_periodically())
     yield
+    usage_flusher.cancel()
+    await asyncio.gather(usage_flusher, return_exceptions=True)
+    await run_db(flush_api_key_usage)
+    await app.state.mail_poller.stop()
+    app.state.mail_poller = None
+    await app.state.ingest_workers.stop()
+    app.state.ingest_workers = None
+    pdf_renderer.close()
+    enrichment.set_geoip_client(None)
+    if geoip_client is not None:
+        await geoip_client.aclose()
+    close_db()
 
 # Rate Limiting
 limiter = Limiter(key_func=get_remote_address)
@@ -131,7 +203,7 @@ async def get_current_user(
     # Check API key first (from X-API-Key header)
     if api_key:
         # Try per-user API keys from database first
-        user = get_user_by_api_key(api_key)
+        user = await run_db(get_user_by_api_key, api_key)
         if user:
             return user
         
@@ -150,7 +222,7 @@ async def get_current_user(
         username: str = payload.get("sub")
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid token")
-        user = get_user_by_username(username)
+        user = await run_db(get_user_by_username_cached, username)
         if user is None:
             raise HTTPException(status_code=401, detail="User not found")
         return user
@@ -167,7 +239,7 @@ async def get_admin_user(current_user: dict = Depends(get_current_user)):
 @app.post("/api/login")
 @limiter.limit("10/minute")
 async def login(req: LoginRequest, request: Request):
-    user = get_user_by_username(req.username)
+    user = await run_db(get_user_by_username, req.username)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
@@ -175,7 +247,7 @@ async def login(req: LoginRequest, request: Request):
     password_bytes = req.password.encode('utf-8')
     password_hash_bytes = user['password_hash'].encode('utf-8')
     
-    if not bcrypt.checkpw(password_bytes, password_hash_bytes):
+    if not await run_cpu(bcrypt.checkpw, password_bytes, password_hash_bytes):
         raise HTTPException(status_code=401, detail="Invalid username or password")
     
     expires = datetime.datetime.now(datetime.UTC) + datetime.timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -206,10 +278,10 @@ async def refresh_token(current_user: dict = Depends(get_current_user)):
 async def change_password(req: PasswordChange, request: Request, current_user: dict = Depends(get_current_user)):
     if not current_user.get('password_hash'):
         raise HTTPException(status_code=400, detail="Password change not supported for API key users")
-    if not bcrypt.checkpw(req.current_password.encode('utf-8'), current_user['password_hash'].encode('utf-8')):
+    if not await run_cpu(bcrypt.checkpw, req.current_password.encode('utf-8'), current_user['password_hash'].encode('utf-8')):
         raise HTTPException(status_code=400, detail="Current password is incorrect")
-    new_hash = bcrypt.hashpw(req.new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-    update_user_profile(current_user['id'], {"password_hash": new_hash})
+    new_hash = (await run_cpu(bcrypt.hashpw, req.new_password.encode('utf-8'), bcrypt.gensalt())).decode('utf-8')
+    await run_db(update_user_profile, current_user['id'], {"password_hash": new_hash})
     return {"message": "Password updated successfully"}
 
 
@@ -223,7 +295,7 @@ async def create_user_api_key(req: ApiKeyCreate, current_user: dict = Depends(ge
     if current_user.get('id') == 0:
         raise HTTPException(status_code=400, detail="Cannot create API keys for legacy API user")
     
-    key_id, raw_key = create_api_key(current_user['id'], req.name)
+    key_id, raw_key = await run_db(create_api_key, current_user['id'], req.name)
     return {"id": key_id, "name": req.name, "key": raw_key}
 
 
@@ -233,7 +305,7 @@ async def list_user_api_keys(current_user: dict = Depends(get_current_user)):
     if current_user.get('id') == 0:
         return []
     
-    return get_api_keys_for_user(current_user['id'])
+    return await run_db(get_api_keys_for_user, current_user['id'])
 
 
 @app.delete("/api/user/api-keys/{key_id}")
@@ -242,7 +314,7 @@ async def revoke_user_api_key(key_id: int, current_user: dict = Depends(get_curr
     if current_user.get('id') == 0:
         raise HTTPException(status_code=400, detail="Cannot manage API keys for legacy API user")
     
-    deleted = delete_api_key(key_id, user_id=current_user['id'])
+    deleted = await run_db(delete_api_key, key_id, user_id=current_user['id'])
     if not deleted:
         raise HTTPException(status_code=404, detail="API key not found or does not belong to you")
     
@@ -256,24 +328,24 @@ async def revoke_user_api_key(key_id: int, current_user: dict = Depends(get_curr
 @app.get("/api/users/{user_id}/api-keys", response_model=List[ApiKeyResponse])
 async def admin_list_user_api_keys(user_id: int, admin: dict = Depends(get_admin_user)):
     """Admin: List all API keys for a specific user."""
-    user = get_user_profile(user_id)
+    user = await run_db(get_user_profile, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    return get_api_keys_for_user(user_id)
+    return await run_db(get_api_keys_for_user, user_id)
 
 
 @app.delete("/api/users/{user_id}/api-keys/{key_id}")
 async def admin_revoke_user_api_key(user_id: int, key_id: int, admin: dict = Depends(get_admin_user)):
     """Admin: Revoke (delete) an API key belonging to a specific user."""
     # Verify the key belongs to the specified user
-    key_owner = get_api_key_owner(key_id)
+    key_owner = await run_db(get_api_key_owner, key_id)
     if key_owner is None:
         raise HTTPException(status_code=404, detail="API key not found")
     if key_owner != user_id:
         raise HTTPException(status_code=400, detail="API key does not belong to this user")
     
-    delete_api_key(key_id)
+    await run_db(delete_api_key, key_id)
     return {"message": "API key revoked successfully"}
 
 @app.get("/")
@@ -290,16 +362,18 @@ async def get_version():
         return {"version": "0.0.0"}
 
 
-async def process_single_file(file_path: Path):
-    try:
-        logger.info(f"Processing uploaded file: {file_path}")
-        data = parse_report(file_path)
-        report_id = save_report(data)
-        logger.info(f"Successfully processed {file_path}")
-        # Check for alerts
-        await check_for_spikes(report_id)
-    except Exception as e:
-        logger.error(f"Error processing {file_path}: {e}")
+def _spill_attachment(filename: str, payload: bytes) -> Path:
+    sha256, _ = sha256_bytes(payload)
+    return spill_payload(UPLOAD_DIR, {"filename": filename, "payload": payload,
+                                      "sha256": sha256, "format": sniff_format(payload[:8])})
+
+async def enqueue_files(file_paths: List[Path], source: str) -> List[int]:
+    """Queue files for the ingest workers and wake them up."""
+    job_ids = await run_db(enqueue_jobs, file_paths, source)
+    workers = getattr(app.state, "ingest_workers", None)
+    if workers is not None:
+        workers.notify()
+    return job_ids
 
 def _sanitize_filename(filename: str) -> str:
     safe_name = Path(filename).name
@@ -307,8 +381,7 @@ def _sanitize_filename(filename: str) -> str:
         raise HTTPException(status_code=400, detail="Invalid filename")
     return safe_name
 
-@app.get("/api/files")
-async def list_files(current_user: dict = Depends(get_current_user)):
+def _list_upload_dir():
     files = []
     for f in UPLOAD_DIR.glob("*"):
         if f.is_file():
@@ -323,18 +396,56 @@ async def list_files(current_user: dict = Depends(get_current_user)):
     files.sort(key=lambda x: x['created'], reverse=True)
     return files
 
+@app.get("/api/files")
+async def list_files(current_user: dict = Depends(get_current_user)):
+    return await run_db(_list_upload_dir)
+
 @app.delete("/api/files/{filename}")
 async def delete_file(filename: str, current_user: dict = Depends(get_current_user)):
     safe_name = _sanitize_filename(filename)
     file_path = UPLOAD_DIR / safe_name
     if not file_path.exists():
-        raise HTTPException(status_code=404, message="File not found")
+        raise HTTPException(status_code=404, detail="File not found")
     try:
-        file_path.unlink()
+        await run_db(file_path.unlink)
         return {"message": f"Deleted {safe_name}"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Serialized /api/stats responses keyed by (start, end, public), each tagged
+# with the data_generation it was computed at. Any ingest or delete (in any
+# worker process) bumps the generation and retires the entries.
+_stats_cache = {}
+_STATS_CACHE_MAX = 128
+
+def _cached_stats(start: Optional[int], end: Optional[int], public: bool) -> tuple[bytes, str]:
+    """Return (JSON body, strong ETag) for /api/stats, recomputing only after data changed."""
+    generation = get_data_generation()
+    key = (start, end, public)
+    cached = _stats_cache.get(key)
+    if cached and cached[0] == generation:
+        return cached[1], cached[2]
+
+    data = get_stats(start_date=start, end_date=end)
+    # If not logged in, strip sensitive data
+    if public:
+        # User requested: Dashboard should only show the domain if you are logged in, otherwise leave the column out.
+        # This applied to recent_activity items.
+        for item in data.get("recent_activity", []):
+            item.pop("domain", None)
+    body = json.dumps(data, separators=(",", ":")).encode()
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    if len(_stats_cache) >= _STATS_CACHE_MAX:
+        _stats_cache.clear()
+    _stats_cache[key] = (generation, body, etag)
+    return body, etag
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
 @app.get("/api/stats")
 async def stats(start: Optional[int] = None, end: Optional[int] = None, request: Request = None):
     # Check if user is logged in to decide visibility
@@ -344,27 +455,33 @@ async def stats(start: Optional[int] = None, end: Optional[int] = None, request:
         try:
             token = auth_header.split(" ")[1]
             payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
-            user = get_user_by_username(payload.get("sub"))
+            user = await run_db(get_user_by_username_cached, payload.get("sub"))
         except:
             pass
 
-    data = get_stats(start_date=start, end_date=end)
-    
-    # If not logged in, strip sensitive data
-    if not user:
-        # User requested: Dashboard should only show the domain if you are logged in, otherwise leave the column out.
-        # This applied to recent_activity items.
-        if "recent_activity" in data:
-            for item in data["recent_activity"]:
-                if "domain" in item:
-                    del item["domain"]
-    
-    return data
+    body, etag = await run_db(_cached_stats, start, end, not user)
+    # Clients may keep the response but must revalidate; unchanged data costs a 304
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+    if _etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/api/stats/summary")
+async def stats_summary(
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    domain: Optional[str] = None,
+    group_by: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+):
+    """Aggregated totals for a domain/date range, optionally grouped, computed in one query."""
+    try:
+        return await run_db(get_stats_summary, start_date=start, end_date=end, domain=domain, group_by=group_by)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/stats/pdf")
 async def stats_pdf(start: Optional[int] = None, end: Optional[int] = None, current_user: dict = Depends(get_current_user)):
-    data = get_stats(start_date=start, end_date=end)
-    
     date_range = "All Time"
     if start and end:
         s = datetime.datetime.fromtimestamp(start).strftime('%Y-%m-%d')
@@ -376,9 +493,17 @@ async def stats_pdf(start: Optional[int] = None, end: Optional[int] = None, curr
     elif end:
         e = datetime.datetime.fromtimestamp(end).strftime('%Y-%m-%d')
         date_range = f"Until {e}"
-        
-    pdf_bytes = bytes(generate_summary_pdf(data, date_range))
-    
+
+    # Same stats (unchanged data generation) and period -> the cached PDF
+    body, _ = await run_db(_cached_stats, start, end, False)
+    key = pdf_fingerprint(body, date_range)
+    pdf_bytes = pdf_renderer.get(key)
+    if pdf_bytes is None:
+        try:
+            pdf_bytes = await pdf_renderer.render(key, json.loads(body), date_range)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="PDF rendering timed out; it will be ready on a later request")
+
     return Response(
         content=pdf_bytes,
         media_type="application/pdf",
@@ -388,12 +513,77 @@ async def stats_pdf(start: Optional[int] = None, end: Optional[int] = None, curr
     )
 
 @app.get("/api/reports")
-async def reports_list(page: int = 1, limit: int = 50, search: Optional[str] = None, domain: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    return get_reports_list(page=page, page_size=limit, search=search, domain=domain)
+async def reports_list(page: int = 1, limit: int = 50, search: Optional[str] = None, domain: Optional[str] = None, cursor: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    try:
+        return await run_db(get_reports_list, page=page, page_size=limit, search=search, domain=domain, cursor=cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _encode_ndjson(rows) -> str:
+    return "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows)
+
+def _encode_csv(rows) -> str:
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
+
+async def _stream_export(batches, encode, header: str = "", gzip: bool = False):
+    """Pull batches through the DB pool and yield encoded (optionally gzipped) chunks."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+
+    def emit(text: str) -> bytes:
+        data = text.encode("utf-8")
+        return compressor.compress(data) if compressor else data
+
+    try:
+        if header:
+            yield emit(header)
+        while True:
+            rows = await run_db(next, batches, None)
+            if rows is None:
+                break
+            chunk = emit(encode(rows))
+            if chunk:
+                yield chunk
+        if compressor:
+            yield compressor.flush()
+    finally:
+        # Releases the export connection, also when the client disconnects
+        await run_db(batches.close)
+
+@app.get("/api/export/records")
+async def export_records(
+    request: Request,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    domain: Optional[str] = None,
+    disposition: Optional[str] = None,
+    format: str = "ndjson",
+    current_user: dict = Depends(get_current_user),
+):
+    """Stream every matching record as NDJSON or CSV without buffering the result."""
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'csv'")
+    batches = iter_export_records(start_date=start, end_date=end, domain=domain, disposition=disposition)
+    if format == "csv":
+        header = _encode_csv([EXPORT_COLUMNS])
+        encode, media_type = _encode_csv, "text/csv"
+    else:
+        header = ""
+        encode, media_type = _encode_ndjson, "application/x-ndjson"
+
+    use_gzip = "gzip" in request.headers.get("Accept-Encoding", "").lower()
+    headers = {
+        "Content-Disposition": f"attachment; filename=dmarc-records-{datetime.datetime.now().strftime('%Y%m%d')}.{format}",
+        "Vary": "Accept-Encoding",
+    }
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(_stream_export(batches, encode, header, use_gzip), media_type=media_type, headers=headers)
 
 @app.get("/api/reports/{id}")
 async def report_detail(id: str, current_user: dict = Depends(get_current_user)):
-    report = get_report_detail(id)
+    report = await run_db(get_report_detail, id)
     if not report:
         raise HTTPException(status_code=404, detail="Report not found")
     
@@ -406,51 +596,77 @@ async def report_detail(id: str, current_user: dict = Depends(get_current_user))
             
     return report
 
+def _store_upload(src, file_path: Path):
+    with file_path.open("wb") as buffer:
+        shutil.copyfileobj(src, buffer)
+
 @app.post("/api/upload")
 @limiter.limit("20/minute")
 async def upload_files(
     request: Request,
     files: List[UploadFile] = File(...),
-    background_tasks: BackgroundTasks = None,
     current_user: dict = Depends(get_current_user),
 ):
     uploaded_files = []
+    uploaded_paths = []
     for file in files:
         safe_name = _sanitize_filename(file.filename)
         file_path = UPLOAD_DIR / safe_name
         try:
-            with file_path.open("wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            await run_db(_store_upload, file.file, file_path)
             uploaded_files.append(safe_name)
-            if background_tasks:
-                background_tasks.add_task(process_single_file, file_path)
-            else:
-                await process_single_file(file_path)
+            uploaded_paths.append(file_path)
         except Exception as e:
             return JSONResponse(status_code=500, content={"message": f"Failed to save {safe_name}"})
-    return {"message": f"Uploaded {len(uploaded_files)} files", "files": uploaded_files}
+    job_ids = await enqueue_files(uploaded_paths, "upload")
+    return {"message": f"Uploaded {len(uploaded_files)} files", "files": uploaded_files, "jobs": job_ids}
 
 @app.post("/api/fetch-email")
-async def fetch_email_reports(background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
-    """Trigger IMAP fetch and process new reports in background."""
-    new_files = fetch_dmarc_reports()
-    if not new_files:
-        return {"message": "No new reports found in email."}
-    
-    for filename in new_files:
-        file_path = UPLOAD_DIR / filename
-        background_tasks.add_task(process_single_file, file_path)
-    
-    return {"message": f"Found {len(new_files)} new reports. Processing in background.", "files": new_files}
+async def fetch_email_reports(current_user: dict = Depends(get_current_user)):
+    """Poll every configured mailbox now and ingest new reports straight from memory."""
+    poller = getattr(app.state, "mail_poller", None)
+    if poller is not None:
+        results = await poller.poll_all()
+        files = [name for result in results for name in result["files"]]
+        job_ids = [job_id for result in results for job_id in result["jobs"]]
+    else:
+        # No background services running (e.g. embedded use): one-off fetch into the file queue
+        files, job_ids, results = [], [], []
+        batches = fetch_dmarc_reports()
+        try:
+            while (batch := await run_db(next, batches, None)) is not None:
+                attachments, checkpoint = batch
+                paths = [await run_db(_spill_attachment, name, payload) for name, payload in attachments]
+                job_ids += await enqueue_files(paths, "email") if paths else []
+                # Only now are this batch's attachments safe in the job queue
+                await run_db(commit_checkpoint, checkpoint)
+                files += [name for name, _ in attachments]
+        finally:
+            await run_db(batches.close)
+    if not files:
+        return {"message": "No new reports found in email.", "mailboxes": results}
+    return {"message": f"Found {len(files)} new reports. Processing in background.",
+            "files": files, "jobs": job_ids, "mailboxes": results}
+
+@app.get("/api/mailboxes")
+async def mailboxes_status(current_user: dict = Depends(get_current_user)):
+    """Per-mailbox IMAP polling metrics: messages, bytes, latency, last success and errors."""
+    poller = getattr(app.state, "mail_poller", None)
+    return poller.status() if poller is not None else []
+
+@app.get("/api/jobs")
+async def jobs_status(limit: int = 50, status: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Ingest queue depth per status and the most recent jobs with timings."""
+    return await run_db(get_job_stats, limit=min(max(limit, 1), 500), status=status)
 
 @app.delete("/api/reports")
 async def delete_reports_endpoint(start: Optional[int] = None, end: Optional[int] = None, domain: Optional[str] = None, org_name: Optional[str] = None, days: Optional[int] = None, current_user: dict = Depends(get_current_user)):
-    deleted = delete_reports(start_date=start, end_date=end, domain=domain, org_name=org_name, days=days)
+    deleted = await run_db(delete_reports, start_date=start, end_date=end, domain=domain, org_name=org_name, days=days)
     return {"deleted": deleted}
 
 @app.get("/api/domains")
 async def domains_list(current_user: dict = Depends(get_current_user)):
-    return get_domain_stats()
+    return await run_db(get_domain_stats)
 
 
 @app.get("/api/user/profile")
@@ -461,7 +677,7 @@ async def user_profile(current_user: dict = Depends(get_current_user)):
 @app.put("/api/user/profile")
 async def update_profile(profile: UserProfile, current_user: dict = Depends(get_current_user)):
     """Update the profile of the current user."""
-    success = update_user_profile(current_user['id'], profile.dict())
+    success = await run_db(update_user_profile, current_user['id'], profile.dict())
     if not success:
         raise HTTPException(status_code=500, detail="Failed to update profile")
     return {"message": "Profile updated successfully"}
@@ -469,11 +685,11 @@ async def update_profile(profile: UserProfile, current_user: dict = Depends(get_
 # User Management (Admin Only)
 @app.get("/api/users")
 async def get_users(admin: dict = Depends(get_admin_user)):
-    return list_users()
+    return await run_db(list_users)
 
 @app.post("/api/users")
 async def add_user(user: UserCreate, admin: dict = Depends(get_admin_user)):
-    new_id = create_user(user.dict())
+    new_id = await run_db(create_user, user.dict())
     if not new_id:
         raise HTTPException(status_code=400, detail="Username or email already exists")
     return {"id": new_id, "message": "User created successfully"}
@@ -493,14 +709,14 @@ async def update_user(id: int, user: UserUpdate, admin: dict = Depends(get_admin
         raise HTTPException(status_code=400, detail="No fields to update")
     if "role" in updates and updates["role"] not in ("admin", "user"):
         raise HTTPException(status_code=400, detail="Role must be 'admin' or 'user'")
-    success = update_user_profile(id, updates)
+    success = await run_db(update_user_profile, id, updates)
     if not success:
         raise HTTPException(status_code=404, detail="User not found")
     return {"message": "User updated successfully"}
 
 @app.delete("/api/users/{id}")
 async def remove_user(id: int, admin: dict = Depends(get_admin_user)):
-    delete_user(id)
+    await run_db(delete_user, id)
     return {"message": "User deleted successfully"}
 
 class SettingsUpdate(BaseModel):
@@ -510,20 +726,20 @@ class SettingsUpdate(BaseModel):
     imap_user: Optional[str] = None
     imap_pass: Optional[str] = None
     imap_use_ssl: Optional[bool] = None
+    imap_mailboxes: Optional[List[dict]] = None
 
-@app.get("/api/settings")
-async def get_all_settings(admin: dict = Depends(get_admin_user)):
+def _read_settings() -> dict:
     return {
         "slack_webhook_url": get_setting("slack_webhook_url", ""),
         "imap_host": get_setting("imap_host", ""),
         "imap_port": get_setting("imap_port", 993),
         "imap_user": get_setting("imap_user", ""),
         "imap_pass": get_setting("imap_pass", ""),
-        "imap_use_ssl": get_setting("imap_use_ssl", True)
+        "imap_use_ssl": get_setting("imap_use_ssl", True),
+        "imap_mailboxes": get_setting("imap_mailboxes", []),
     }
 
-@app.put("/api/settings")
-async def update_settings(settings: SettingsUpdate, admin: dict = Depends(get_admin_user)):
+def _write_settings(settings: SettingsUpdate):
     if settings.slack_webhook_url is not None:
         set_setting("slack_webhook_url", settings.slack_webhook_url)
     if settings.imap_host is not None:
@@ -536,4 +752,17 @@ async def update_settings(settings: SettingsUpdate, admin: dict = Depends(get_ad
         set_setting("imap_pass", settings.imap_pass)
     if settings.imap_use_ssl is not None:
         set_setting("imap_use_ssl", settings.imap_use_ssl)
+    if settings.imap_mailboxes is not None:
+        set_setting("imap_mailboxes", settings.imap_mailboxes)
+
+@app.get("/api/settings")
+async def get_all_settings(admin: dict = Depends(get_admin_user)):
+    return await run_db(_read_settings)
+
+@app.put("/api/settings")
+async def update_settings(settings: SettingsUpdate, admin: dict = Depends(get_admin_user)):
+    await run_db(_write_settings, settings)
+    poller = getattr(app.state, "mail_poller", None)
+    if poller is not None and any(name.startswith("imap_") for name in settings.model_fields_set):
+        await poller.reload()
     return {"message": "Settings updated"}
@@ -50,6 +50,35 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 # 24 hours
 
 DMARC_API_KEY = os.environ.get("DMARC_API_KEY", "")
+# API key last_used_at is buffered in memory and written this often (seconds)
+API_KEY_USAGE_FLUSH_INTERVAL = float(os.environ.get("API_KEY_USAGE_FLUSH_INTERVAL", "60"))
+
+# Poll the configured IMAP mailboxes from the API process (set false when
+# running `python -m backend.dmarc_lib.mail_poller` as its own service)
+MAIL_POLLER_IN_API = os.environ.get("MAIL_POLLER_IN_API", "true").lower() in ("1", "true", "yes")
+
+# Bounded worker pools for blocking work done on behalf of async routes
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))    # SQLite queries, file and IMAP I/O
+CPU_POOL_SIZE = int(os.environ.get("CPU_POOL_SIZE", "2"))  # bcrypt hashing
+
+# SQLite tuning applied to every connection (SQLITE_* in .env). The values are
+# read by backend.dmarc_lib.db, which the CLI tools use without this module;
+# importing it here, after load_dotenv, makes .env apply to the API as well.
+from backend.dmarc_lib.db import (  # noqa: E402
+    SQLITE_BUSY_TIMEOUT_MS,
+    SQLITE_CACHE_SIZE,
+    SQLITE_JOURNAL_MODE,
+    SQLITE_MMAP_SIZE,
+    SQLITE_SYNCHRONOUS,
+    SQLITE_TEMP_STORE,
+)
+
+# Summary PDFs render in a pool of PDF_WORKERS processes (or threads)
+# and the most recent ones are cached by a fingerprint of their stats and period
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", "2"))
+PDF_USE_PROCESSES = os.environ.get("PDF_USE_PROCESSES", "true").lower() in ("1", "true", "yes")
+PDF_RENDER_TIMEOUT = float(os.environ.get("PDF_RENDER_TIMEOUT", "60"))
+PDF_CACHE_SIZE = int(os.environ.get("PDF_CACHE_SIZE", "32"))
 
 ENVIRONMENT = os.environ.get("ENVIRONMENT", "development").lower()
 if ENVIRONMENT == "production" and (not SECRET_KEY or SECRET_KEY == "super-secret-key-change-me-in-production"):
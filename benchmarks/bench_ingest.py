@@ -0,0 +1,101 @@
+"""
+Ingest throughput benchmark: per-row/per-report inserts vs. save_reports().
+
+Usage: python benchmarks/bench_ingest.py [--reports N] [--records N] [--commit-every N]
+
+Runs against a throwaway SQLite file and prints rows per second for the
+legacy path (one connection, one INSERT per record and one commit per
+report) and for the batched save_reports() path.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def _make_reports(n_reports, n_records, prefix):
+    for i in range(n_reports):
+        yield {
+            "metadata": {
+                "org_name": "Bench Org",
+                "email": "bench@example.com",
+                "report_id": f"{prefix}-{i}",
+                "date_range_begin": 1700000000 + i * 86400,
+                "date_range_end": 1700086399 + i * 86400,
+            },
+            "policy": {"domain": f"bench{i % 20}.example", "p": "reject", "sp": "reject", "pct": "100"},
+            "records": [
+                {
+                    "source_ip": f"10.{i % 256}.{j // 256 % 256}.{j % 256}",
+                    "count": j % 7 + 1,
+                    "disposition": "none" if j % 5 else "reject",
+                    "dkim": "pass" if j % 5 else "fail",
+                    "spf": "pass",
+                }
+                for j in range(n_records)
+            ],
+        }
+
+
+def _legacy_save_report(db, parsed_data):
+    """The original save_report: fresh connection, row-by-row inserts, commit per report."""
+    conn = db.get_db()
+    c = conn.cursor()
+    meta = parsed_data['metadata']
+    policy = parsed_data['policy']
+    c.execute("SELECT id FROM reports WHERE report_id = ?", (meta['report_id'],))
+    if c.fetchone():
+        conn.close()
+        return
+    c.execute('''
+        INSERT INTO reports (report_id, org_name, date_begin, date_end, domain, policy_published)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (meta['report_id'], meta['org_name'], meta['date_range_begin'],
+          meta['date_range_end'], policy['domain'], json.dumps(policy)))
+    report_db_id = c.lastrowid
+    for rec in parsed_data['records']:
+        c.execute('''
+            INSERT INTO records (report_id, source_ip, count, disposition, dkim, spf)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (report_db_id, rec['source_ip'], rec['count'], rec['disposition'], rec['dkim'], rec['spf']))
+    conn.commit()
+    conn.close()
+
+
+def _timed(label, fn, rows):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {rows:>9,} rows in {elapsed:7.2f}s  -> {rows / elapsed:>12,.0f} rows/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--reports", type=int, default=2000)
+    parser.add_argument("--records", type=int, default=50)
+    parser.add_argument("--commit-every", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+        from backend.dmarc_lib import db
+        db.DB_PATH = os.environ["DB_PATH"]
+        db.init_db()
+
+        rows = args.reports * args.records
+        legacy = list(_make_reports(args.reports, args.records, "legacy"))
+        batched = list(_make_reports(args.reports, args.records, "batched"))
+
+        before = _timed("save_report (per row)", lambda: [_legacy_save_report(db, r) for r in legacy], rows)
+        after = _timed(f"save_reports (commit {args.commit_every})",
+                       lambda: db.save_reports(batched, commit_every=args.commit_every), rows)
+        print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
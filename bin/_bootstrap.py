@@ -0,0 +1,31 @@
+"""
+Shared setup for the bin/ scripts that use backend.dmarc_lib directly:
+put the project root on sys.path, load its .env and anchor a relative
+DB_PATH at the project root.
+
+Usage (the script's own directory is sys.path[0]):
+
+    import _bootstrap
+    _bootstrap.setup()
+"""
+import os
+import sys
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def setup():
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv(os.path.join(ROOT_DIR, ".env"))
+    except ImportError:
+        pass
+
+    # A relative DB_PATH (the default) is relative to the project root, where
+    # bin/start runs the API - not to the directory this script is run from
+    db_path = os.environ.get("DB_PATH", "dmarc_reports.db")
+    if not os.path.isabs(db_path):
+        os.environ["DB_PATH"] = os.path.join(ROOT_DIR, db_path)
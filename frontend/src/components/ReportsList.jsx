@@ -18,6 +18,10 @@ const ReportsList = () => {
     const [page, setPage] = useState(1);
     const [totalPages, setTotalPages] = useState(1);
     const [totalItems, setTotalItems] = useState(0);
+    // next_cursor returned for each page, keyed by filter + page number, so
+    // stepping forward uses keyset pagination instead of a growing OFFSET
+    const [cursors, setCursors] = useState({});
+    const cursorKey = (p) => `${search}|${domainFilter || ''}|${p}`;
 
     useEffect(() => {
         if (!authLoading && !user) {
@@ -37,6 +41,8 @@ const ReportsList = () => {
             });
             if (search) params.append('search', search);
             if (domainFilter) params.append('domain', domainFilter);
+            const cursor = cursors[cursorKey(page)];
+            if (page > 1 && cursor) params.append('cursor', cursor);
 
             const res = await fetch(`${API_BASE_URL}/api/reports?${params}`, {
                 headers: { 'Authorization': `Bearer ${user.token}` }
@@ -46,6 +52,9 @@ const ReportsList = () => {
             const data = await res.json();
 
             setReports(data.items);
+            if (data.next_cursor) {
+                setCursors(prev => ({ ...prev, [cursorKey(page + 1)]: data.next_cursor }));
+            }
             setTotalPages(data.pages);
             setTotalItems(data.total);
         } catch (err) {
@@ -91,7 +100,7 @@ const ReportsList = () => {
                     <Search size={18} className="text-muted" style={{ position: 'absolute', left: '0.75rem', top: '50%', transform: 'translateY(-50%)' }} />
                     <input
                         type="text"
-                        placeholder="Search Org, ID, or Domain..."
+                        placeholder="Search Org, ID, Domain, or IP..."
                         value={search}
                         onChange={(e) => { setSearch(e.target.value); setPage(1); }}
 
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.dmarc_lib.db import get_db
+
+
+@pytest.fixture
+def report_xml():
+    """Build a minimal aggregate report: report_xml(report_id, records=2, **overrides) -> str."""
+    def make(report_id, records=2, org="Archive Org", domain="archive.example",
+             ip_prefix="198.51.100", dkim="pass", spf="pass"):
+        rows = "".join(f"""
+  <record>
+    <row>
+      <source_ip>{ip_prefix}.{i}</source_ip>
+      <count>1</count>
+      <policy_evaluated><disposition>none</disposition><dkim>{dkim}</dkim><spf>{spf}</spf></policy_evaluated>
+    </row>
+  </record>""" for i in range(records))
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<feedback>
+  <report_metadata>
+    <org_name>{org}</org_name>
+    <report_id>{report_id}</report_id>
+    <date_range><begin>1600000000</begin><end>1600086400</end></date_range>
+  </report_metadata>
+  <policy_published><domain>{domain}</domain><p>none</p></policy_published>{rows}
+</feedback>
+"""
+    return make
+
+
+@pytest.fixture
+def count_reports():
+    """count_reports(prefix): number of stored reports whose report_id starts with `<prefix>-`."""
+    def count(prefix):
+        conn = get_db()
+        n = conn.execute("SELECT COUNT(*) FROM reports WHERE report_id LIKE ?", (f"{prefix}-%",)).fetchone()[0]
+        conn.close()
+        return n
+    return count
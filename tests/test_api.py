@@ -43,9 +43,21 @@ def _sample_report_xml(report_id="upload-test-1"):
 </feedback>
 """
 
+TEST_ADMIN_PASSWORD = "admin123"
+
+def _set_admin_password():
+    """The seeded admin gets a random password; pin a known one for these tests."""
+    import bcrypt
+    conn = get_db()
+    conn.execute("UPDATE users SET password_hash = ? WHERE username = 'admin'",
+                 (bcrypt.hashpw(TEST_ADMIN_PASSWORD.encode(), bcrypt.gensalt(4)).decode(),))
+    conn.commit()
+    conn.close()
+
 def _auth_headers():
     init_db()
-    res = client.post("/api/login", json={"username": "admin", "password": "admin123"})
+    _set_admin_password()
+    res = client.post("/api/login", json={"username": "admin", "password": TEST_ADMIN_PASSWORD})
     assert res.status_code == 200
     token = res.json()["access_token"]
     return {"Authorization": f"Bearer {token}"}
@@ -72,6 +84,45 @@ def test_get_stats():
     assert "total_reports" in data
     assert "total_volume" in data
 
+def test_stats_cached_with_etag(monkeypatch):
+    import backend.web.api as api
+
+    calls = []
+    real_get_stats = api.get_stats
+    monkeypatch.setattr(api, "get_stats", lambda **kw: calls.append(kw) or real_get_stats(**kw))
+    api._stats_cache.clear()
+
+    first = client.get("/api/stats?start=1&end=2000000000")
+    etag = first.headers["ETag"]
+    assert first.status_code == 200 and etag.startswith('"')
+
+    again = client.get("/api/stats?start=1&end=2000000000")
+    assert again.headers["ETag"] == etag
+    assert again.json() == first.json()
+    assert len(calls) == 1
+
+    not_modified = client.get("/api/stats?start=1&end=2000000000", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["ETag"] == etag
+
+    # Logged-in visitors get their own entry (domains are not stripped)
+    private = client.get("/api/stats?start=1&end=2000000000", headers=_auth_headers())
+    assert private.status_code == 200
+    assert len(calls) == 2
+
+    # Ingest invalidates the cached response
+    save_report({
+        "metadata": {"org_name": "Etag Org", "email": "e@example.com", "report_id": f"etag-{etag}",
+                     "date_range_begin": "1700000000", "date_range_end": "1700086400"},
+        "policy": {"domain": "etag.example", "p": "none", "sp": "none", "pct": "100"},
+        "records": [{"source_ip": "192.0.2.5", "count": 2, "disposition": "none", "dkim": "pass", "spf": "pass"}],
+    })
+    changed = client.get("/api/stats?start=1&end=2000000000", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json()["total_volume"] == first.json()["total_volume"] + 2
+    assert len(calls) == 3
+
 def test_get_reports():
     response = client.get("/api/reports", headers=_auth_headers())
     assert response.status_code == 200
@@ -108,6 +159,12 @@ def test_upload_success():
     assert res.status_code == 200
     assert "files" in res.json()
     assert filename in res.json()["files"]
+    assert len(res.json()["jobs"]) == 1
+
+    jobs = client.get("/api/jobs", headers=headers)
+    assert jobs.status_code == 200
+    assert res.json()["jobs"][0] in [j["id"] for j in jobs.json()["jobs"]]
+    assert jobs.json()["queue_depth"] >= 0
 
     uploaded_path = Path("backend/uploads") / filename
     if uploaded_path.exists():
@@ -177,3 +234,199 @@ def test_delete_reports_cascades_records():
     c.execute("SELECT COUNT(*) FROM reports WHERE id = ?", (other_report_id,))
     assert c.fetchone()[0] == 1
     conn.close()
+
+def _api_key_headers(name="test-key"):
+    from backend.dmarc_lib.db import create_api_key
+    init_db()
+    _, raw_key = create_api_key(1, name)
+    return {"X-API-Key": raw_key}
+
+def test_reports_not_blocked_by_pdf_render(monkeypatch):
+    import asyncio
+    import time
+    import httpx
+    import backend.web.api as api
+
+    from concurrent.futures import ThreadPoolExecutor
+    from backend.dmarc_lib.pdf_gen import PDFRenderer
+
+    def slow_pdf(stats, date_range):
+        time.sleep(1.0)
+        return b"%PDF-1.4"
+
+    monkeypatch.setattr(api, "pdf_renderer", PDFRenderer(lambda: ThreadPoolExecutor(1), render=slow_pdf))
+    headers = _api_key_headers("latency-test")
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            pdf_task = asyncio.create_task(ac.get("/api/stats/pdf", headers=headers))
+            await asyncio.sleep(0.2)  # let the render start
+            started = time.perf_counter()
+            res = await ac.get("/api/reports", headers=headers)
+            elapsed = time.perf_counter() - started
+            assert not pdf_task.done()
+            pdf_res = await pdf_task
+            return res, elapsed, pdf_res
+
+    res, elapsed, pdf_res = asyncio.run(scenario())
+    assert res.status_code == 200
+    assert pdf_res.status_code == 200
+    assert elapsed < 0.5
+
+def test_stats_pdf_cached_by_fingerprint(monkeypatch):
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    import backend.web.api as api
+    from backend.dmarc_lib.pdf_gen import PDFRenderer
+
+    renders = []
+    release = threading.Event()
+
+    def fake_pdf(stats, date_range):
+        renders.append(date_range)
+        if date_range.startswith("Since"):
+            release.wait(5)  # a render slower than the timeout
+        return f"%PDF-1.4 {date_range}".encode()
+
+    renderer = PDFRenderer(lambda: ThreadPoolExecutor(2), timeout=0.3, cache_size=2, render=fake_pdf)
+    monkeypatch.setattr(api, "pdf_renderer", renderer)
+    headers = _api_key_headers("pdf-cache-test")
+
+    first = client.get("/api/stats/pdf?start=1600000000&end=1700000000", headers=headers)
+    again = client.get("/api/stats/pdf?start=1600000000&end=1700000000", headers=headers)
+    assert first.status_code == again.status_code == 200
+    assert first.content == again.content and first.content.startswith(b"%PDF-1.4 ")
+    assert len(renders) == 1
+
+    # Too slow: 504, but the render completes in the background and is cached
+    slow = client.get("/api/stats/pdf?start=1600000000", headers=headers)
+    assert slow.status_code == 504
+    release.set()
+    for _ in range(50):
+        if len(renderer._cache) == 2:
+            break
+        time.sleep(0.05)
+    ready = client.get("/api/stats/pdf?start=1600000000", headers=headers)
+    assert ready.status_code == 200 and ready.content.startswith(b"%PDF-1.4 Since")
+    assert len(renders) == 2
+
+    # LRU: a third period evicts the least recently used one
+    client.get("/api/stats/pdf", headers=headers)
+    client.get("/api/stats/pdf?start=1600000000&end=1700000000", headers=headers)
+    assert len(renders) == 4
+    renderer.close()
+
+def test_stats_pdf_renders_in_process_pool():
+    import backend.web.api as api
+    headers = _api_key_headers("pdf-process-test")
+    try:
+        res = client.get("/api/stats/pdf?start=1600000000&end=1600100000", headers=headers)
+    finally:
+        api.pdf_renderer.close()
+    assert res.status_code == 200
+    assert res.content.startswith(b"%PDF")
+    assert res.headers["content-type"] == "application/pdf"
+
+def test_export_records_streams_ndjson_and_csv():
+    import csv
+    import io
+    import json
+
+    init_db()
+    save_report({
+        "metadata": {"org_name": "Export Org", "email": "x@example.com", "report_id": "export-test-1",
+                     "date_range_begin": "1700000000", "date_range_end": "1700086400"},
+        "policy": {"domain": "export.example", "p": "reject", "sp": "reject", "pct": "100"},
+        "records": [
+            {"source_ip": "192.0.2.10", "count": 4, "disposition": "none", "dkim": "pass", "spf": "pass"},
+            {"source_ip": "192.0.2.11", "count": 2, "disposition": "reject", "dkim": "fail", "spf": "fail"},
+        ],
+    })
+
+    assert client.get("/api/export/records?domain=export.example").status_code == 401
+    headers = {**_auth_headers(), "Accept-Encoding": "identity"}
+
+    res = client.get("/api/export/records?domain=export.example", headers=headers)
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("application/x-ndjson")
+    assert "content-encoding" not in res.headers
+    rows = [json.loads(line) for line in res.text.splitlines()]
+    assert {(r["source_ip"], r["count"], r["disposition"]) for r in rows} == {
+        ("192.0.2.10", 4, "none"), ("192.0.2.11", 2, "reject")}
+    assert all(r["report_id"] == "export-test-1" for r in rows)
+
+    res = client.get("/api/export/records?domain=export.example&disposition=reject&format=csv", headers=headers)
+    assert res.status_code == 200
+    table = list(csv.reader(io.StringIO(res.text)))
+    assert table[0][:2] == ["report_id", "org_name"]
+    assert [row[5] for row in table[1:]] == ["192.0.2.11"]
+
+    # gzip is applied on the fly when the client accepts it
+    res = client.get("/api/export/records?domain=export.example",
+                     headers={**headers, "Accept-Encoding": "gzip"})
+    assert res.headers["content-encoding"] == "gzip"
+    assert len(res.text.splitlines()) == 2
+
+    assert client.get("/api/export/records?format=xml", headers=headers).status_code == 400
+
+
+def test_export_records_reads_in_batches(monkeypatch):
+    from backend.dmarc_lib import db
+
+    init_db()
+    save_report({
+        "metadata": {"org_name": "Batch Org", "email": "x@example.com", "report_id": "export-batch-1",
+                     "date_range_begin": "1700000000", "date_range_end": "1700086400"},
+        "policy": {"domain": "export-batch.example", "p": "none", "sp": "none", "pct": "100"},
+        "records": [{"source_ip": f"198.18.0.{i}", "count": 1, "disposition": "none",
+                     "dkim": "pass", "spf": "pass"} for i in range(25)],
+    })
+    batches = list(db.iter_export_records(domain="export-batch.example", batch_size=10))
+    assert [len(b) for b in batches] == [10, 10, 5]
+    assert len(batches[0][0]) == len(db.EXPORT_COLUMNS)
+
+def test_stats_summary_groups_in_sql():
+    init_db()
+    day = 86400
+    base = 1700006400  # 2023-11-15 00:00 UTC (a Wednesday)
+    for i, (org, end, records) in enumerate([
+        ("Org A", base + 3600, [("none", "pass", "pass", 10), ("reject", "fail", "fail", 2)]),
+        ("Org B", base + day + 3600, [("quarantine", "pass", "fail", 3)]),
+        ("Org A", base + 7 * day, [("none", "fail", "pass", 5)]),
+    ]):
+        save_report({
+            "metadata": {"org_name": org, "email": "x@example.com", "report_id": f"summary-test-{i}",
+                         "date_range_begin": str(end - day), "date_range_end": str(end)},
+            "policy": {"domain": "summary.example", "p": "reject", "sp": "reject", "pct": "100"},
+            "records": [{"source_ip": f"192.0.2.{n}", "count": count, "disposition": disp, "dkim": dkim, "spf": spf}
+                        for n, (disp, dkim, spf, count) in enumerate(records)],
+        })
+
+    assert client.get("/api/stats/summary").status_code == 401
+    headers = _auth_headers()
+    query = f"/api/stats/summary?domain=summary.example&start={base}&end={base + 8 * day}"
+
+    data = client.get(query, headers=headers).json()
+    assert data["totals"] == {"reports": 3, "volume": 20, "pass": 15, "quarantine": 3, "reject": 2,
+                              "fail": 5, "dkim_pass": 13, "spf_pass": 15}
+    assert data["groups"] == []
+
+    weeks = client.get(query + "&group_by=week", headers=headers).json()["groups"]
+    assert [(g["key"], g["reports"], g["volume"]) for g in weeks] == [("2023-11-13", 2, 15), ("2023-11-20", 1, 5)]
+
+    orgs = client.get(query + "&group_by=org", headers=headers).json()
+    assert [(g["key"], g["reports"], g["volume"], g["fail"]) for g in orgs["groups"]] == [
+        ("Org A", 2, 17, 2), ("Org B", 1, 3, 3)]
+    assert orgs["totals"] == data["totals"]
+
+    alignment = client.get(query + "&group_by=alignment", headers=headers).json()["groups"]
+    assert {g["key"]: g["volume"] for g in alignment} == {"pass/pass": 10, "fail/fail": 2, "pass/fail": 3, "fail/pass": 5}
+    assert all(g["reports"] is None for g in alignment)
+
+    # The start day is inclusive, so a later start drops the first day only
+    later = client.get(f"/api/stats/summary?domain=summary.example&start={base + day}", headers=headers).json()
+    assert later["totals"]["volume"] == 8
+
+    assert client.get(query + "&group_by=nope", headers=headers).status_code == 400
@@ -0,0 +1,83 @@
+import gzip
+import os
+import sys
+import uuid
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.dmarc_lib.bulk_import import bulk_import, iter_report_files
+
+
+def _archive(tmp_path, report_xml):
+    prefix = f"bulk-{uuid.uuid4()}"
+    (tmp_path / "2023" / "01").mkdir(parents=True)
+    (tmp_path / "2024").mkdir()
+    (tmp_path / "2023" / "01" / "a.xml").write_text(report_xml(f"{prefix}-a"))
+    with gzip.open(tmp_path / "2023" / "01" / "b.xml.gz", "wt") as f:
+        f.write(report_xml(f"{prefix}-b", records=3))
+    (tmp_path / "2024" / "c.xml").write_text(report_xml(f"{prefix}-c"))
+    (tmp_path / "2024" / "broken.xml").write_text("<feedback><report_metadata>")
+    (tmp_path / "2024" / "notes.txt").write_text("not a report")
+    return prefix
+
+
+def test_iter_report_files_recursive(tmp_path, report_xml):
+    _archive(tmp_path, report_xml)
+    names = [p.name for p in iter_report_files([tmp_path])]
+    assert names == ["a.xml", "b.xml.gz", "broken.xml", "c.xml"]
+    assert [p.name for p in iter_report_files([tmp_path / "2024"], recursive=False)] == ["broken.xml", "c.xml"]
+
+
+def test_bulk_import_saves_and_resumes(tmp_path, report_xml, count_reports):
+    prefix = _archive(tmp_path, report_xml)
+    lines = []
+
+    summary = bulk_import([tmp_path], workers=2, batch_size=2, use_processes=False, progress=lines.append)
+    assert summary["files"] == 4
+    assert summary["saved"] == 3
+    assert summary["records"] == 7
+    assert summary["failed"] == 1
+    assert count_reports(prefix) == 3
+    assert lines[0].startswith("4 files to import")
+
+    # A second run skips everything that was checkpointed, including the broken file
+    summary = bulk_import([tmp_path], use_processes=False, progress=None)
+    assert summary["skipped"] == 4 and summary["saved"] == 0 and summary["failed"] == 0
+
+    # Fixing the broken file (new size/mtime) makes it eligible again
+    (tmp_path / "2024" / "broken.xml").write_text(report_xml(f"{prefix}-fixed"))
+    summary = bulk_import([tmp_path], use_processes=False, progress=None)
+    assert summary["skipped"] == 3 and summary["saved"] == 1
+    assert count_reports(prefix) == 4
+
+
+def test_bulk_import_in_processes(tmp_path, report_xml, count_reports):
+    prefix = _archive(tmp_path, report_xml)
+    summary = bulk_import([tmp_path], workers=2, progress=None)
+    assert summary["saved"] == 3
+    assert count_reports(prefix) == 3
+
+
+def test_deleted_reports_can_be_imported_again(tmp_path, monkeypatch, report_xml, count_reports):
+    from backend.dmarc_lib import db
+
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "reimport.db"))
+    archive = tmp_path / "archive"
+    archive.mkdir()
+    prefix = _archive(archive, report_xml)
+    assert bulk_import([archive], use_processes=False, progress=None)["saved"] == 3
+
+    # Imported files are known by content, like uploads
+    report_id = db.find_raw_file(db.sha256_file(archive / "2024" / "c.xml")[0])
+    assert report_id is not None
+    copy = tmp_path / "copy.xml"
+    copy.write_bytes((archive / "2024" / "c.xml").read_bytes())
+    summary = bulk_import([copy], use_processes=False, progress=None)
+    assert summary["saved"] == 1 and count_reports(prefix) == 3
+
+    db.delete_reports(domain="archive.example")
+    assert count_reports(prefix) == 0
+    summary = bulk_import([archive], use_processes=False, progress=None)
+    assert summary["skipped"] == 1 and summary["saved"] == 3  # only the broken file stays checkpointed
+    assert count_reports(prefix) == 3
+    db.close_db()
@@ -0,0 +1,426 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.dmarc_lib.db import init_db, save_report, save_reports, get_db
+
+
+def _parsed_report(report_id, domain="db-test.example", records=None, date_end=1700003600):
+    return {
+        "metadata": {
+            "org_name": "DB Test Org",
+            "email": "ops@example.com",
+            "report_id": report_id,
+            "date_range_begin": date_end - 3600,
+            "date_range_end": date_end,
+        },
+        "policy": {"domain": domain, "p": "none", "sp": "none", "pct": "100"},
+        "records": records if records is not None else [
+            {"source_ip": "1.2.3.4", "count": 5, "disposition": "none", "dkim": "pass", "spf": "pass"},
+            {"source_ip": "5.6.7.8", "count": 2, "disposition": "reject", "dkim": "fail", "spf": "fail"},
+        ],
+    }
+
+
+def _record_count(report_db_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM records WHERE report_id = ?", (report_db_id,))
+    count = c.fetchone()[0]
+    conn.close()
+    return count
+
+
+def test_save_reports_batches_and_dedupes():
+    init_db()
+    existing_id = save_report(_parsed_report("batch-existing"))
+
+    ids = save_reports([
+        _parsed_report("batch-1"),
+        _parsed_report("batch-existing"),
+        _parsed_report("batch-2"),
+        _parsed_report("batch-1"),
+    ], commit_every=2)
+
+    assert ids[1] == existing_id
+    assert ids[3] == ids[0]
+    assert len(set(ids)) == 3
+    assert _record_count(ids[0]) == 2
+    assert _record_count(ids[2]) == 2
+    assert _record_count(existing_id) == 2
+
+
+def test_save_reports_accepts_generators_and_isolates_failures():
+    init_db()
+
+    def broken_records():
+        yield {"source_ip": "9.9.9.9", "count": 1, "disposition": "none", "dkim": "pass", "spf": "pass"}
+        raise ValueError("truncated report")
+
+    good = _parsed_report("batch-gen-good", records=(
+        {"source_ip": f"10.0.0.{i}", "count": 1, "disposition": "none", "dkim": "pass", "spf": "pass"}
+        for i in range(3)
+    ))
+    ids = save_reports([good, _parsed_report("batch-gen-bad", records=broken_records())])
+
+    assert ids[1] is None
+    assert _record_count(ids[0]) == 3
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM reports WHERE report_id = 'batch-gen-bad'")
+    assert c.fetchone()[0] == 0
+    conn.close()
+
+
+def test_get_db_reuses_connection_per_thread():
+    import threading
+
+    first = get_db()
+    first.close()
+    assert get_db() is first
+
+    other = []
+    t = threading.Thread(target=lambda: other.append(get_db()))
+    t.start()
+    t.join()
+    assert other[0] is not first
+
+
+def test_get_db_applies_pragmas():
+    conn = get_db()
+    c = conn.cursor()
+    assert c.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert c.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    assert c.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+    assert c.execute("PRAGMA temp_store").fetchone()[0] == 2  # MEMORY
+    conn.close()
+
+
+def test_close_discards_uncommitted_work():
+    init_db()
+    conn = get_db()
+    conn.execute("INSERT INTO settings (key, value) VALUES ('pool-test', '1')")
+    conn.close()
+
+    conn = get_db()
+    assert conn.execute("SELECT COUNT(*) FROM settings WHERE key = 'pool-test'").fetchone()[0] == 0
+    conn.close()
+
+
+def test_migrations_set_user_version():
+    from backend.dmarc_lib.db import MIGRATIONS
+
+    init_db()
+    conn = get_db()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    conn.close()
+
+
+def _query_plans(fn, *args, **kwargs):
+    """Run fn and return (sql, plan_details) for every SELECT/DELETE it executed."""
+    conn = get_db()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        fn(*args, **kwargs)
+    finally:
+        conn.set_trace_callback(None)
+
+    plans = []
+    for sql in statements:
+        if not sql.lstrip().upper().startswith(("SELECT", "DELETE")):
+            continue
+        details = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+        plans.append((sql, details))
+    return plans
+
+
+def test_hot_paths_do_not_full_scan():
+    from backend.dmarc_lib.db import (
+        get_stats, get_reports_list, get_report_detail, get_domain_stats, delete_reports,
+    )
+
+    init_db()
+    report_db_id = save_report(_parsed_report("plan-report", domain="plan.example"))
+    save_reports([_parsed_report(f"plan-filler-{i}", domain=f"filler{i % 3}.example") for i in range(30)])
+    conn = get_db()
+    conn.execute("ANALYZE")
+    conn.commit()
+
+    calls = [
+        (get_stats, (), {}),
+        (get_stats, (), {"start_date": 1700000000, "end_date": 1700086400}),
+        (get_reports_list, (), {}),
+        (get_reports_list, (), {"domain": "plan.example"}),
+        (get_reports_list, (), {"cursor": "1700003600:5"}),
+        (get_reports_list, (), {"domain": "plan.example", "cursor": "1700003600:5"}),
+        (get_reports_list, (), {"cursor": ":5"}),
+        (get_reports_list, (), {"search": "plan"}),
+        (get_report_detail, (report_db_id,), {}),
+        (get_report_detail, ("plan-report",), {}),
+        (get_domain_stats, (), {}),
+        (delete_reports, (), {"org_name": "nobody"}),
+        (delete_reports, (), {"domain": "nowhere.example"}),
+        (delete_reports, (), {"start_date": 1, "end_date": 2}),
+    ]
+    for fn, args, kwargs in calls:
+        for sql, details in _query_plans(fn, *args, **kwargs):
+            # Scanning a small subquery result ("CO-ROUTINE r" / "MATERIALIZE r") is fine,
+            # and so is scanning daily_rollup, which is sized by days x domains by design
+            subqueries = {d.split()[-1] for d in details if d.startswith(("CO-ROUTINE", "MATERIALIZE"))}
+            subqueries.add("daily_rollup")
+            for detail in details:
+                full_scan = (
+                    detail.startswith("SCAN") and "USING" not in detail
+                    and "VIRTUAL TABLE INDEX" not in detail  # FTS5 MATCH lookup
+                    and detail.split()[1] not in subqueries
+                )
+                assert not full_scan and "AUTOMATIC" not in detail, (
+                    f"{fn.__name__}{args}{kwargs} full-scans: {detail}\n{sql}"
+                )
+
+
+def _raw_domain_totals(domain):
+    conn = get_db()
+    row = conn.execute("""
+        SELECT COUNT(DISTINCT r.id), SUM(rec.count),
+               SUM(CASE WHEN rec.disposition = 'reject' THEN rec.count ELSE 0 END)
+        FROM reports r JOIN records rec ON rec.report_id = r.id
+        WHERE r.domain = ?
+    """, (domain,)).fetchone()
+    conn.close()
+    return tuple(row)
+
+
+def test_daily_rollup_tracks_ingest_and_delete():
+    from backend.dmarc_lib.db import get_domain_stats, get_stats, delete_reports
+
+    init_db()
+    domain = "rollup.example"
+    save_reports([
+        _parsed_report("rollup-1", domain=domain, date_end=1700003600),
+        _parsed_report("rollup-2", domain=domain, date_end=1700003600),
+        _parsed_report("rollup-3", domain=domain, date_end=1700090000),
+    ])
+
+    stats = {d["domain"]: d for d in get_domain_stats()}[domain]
+    assert (stats["report_count"], stats["total_volume"], stats["reject_count"]) == _raw_domain_totals(domain)
+    assert stats["last_seen"] == 1700090000
+
+    day_stats = get_stats(start_date=1700090000, end_date=1700090000)
+    assert day_stats["volume_series"][0]["name"] == "2023-11-15"
+
+    delete_reports(start_date=1700003000, end_date=1700004000, domain=domain)
+    stats = {d["domain"]: d for d in get_domain_stats()}[domain]
+    assert (stats["report_count"], stats["total_volume"], stats["reject_count"]) == (1, 7, 2)
+
+    delete_reports(domain=domain)
+    assert domain not in {d["domain"] for d in get_domain_stats()}
+    conn = get_db()
+    assert conn.execute("SELECT COUNT(*) FROM daily_rollup WHERE domain = ?", (domain,)).fetchone()[0] == 0
+    conn.close()
+
+
+def test_stats_date_filter_is_exact_on_partial_days(tmp_path, monkeypatch):
+    from backend.dmarc_lib import db
+
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "edges.db"))
+    init_db()
+    midnight = 1700006400  # 2023-11-15 00:00 UTC
+    hour = 3600
+    ends = [midnight + hour, midnight + 20 * hour, midnight + 34 * hour, midnight + 53 * hour, midnight + 60 * hour]
+    save_reports([_parsed_report(f"edge-{i}", domain="edges.example", date_end=end) for i, end in enumerate(ends)])
+
+    def expected(start, end):
+        return [e for e in ends if (start is None or e >= start) and (end is None or e <= end)]
+
+    for start, end in [
+        (midnight + 12 * hour, midnight + 52 * hour),   # partial first and last day around a whole one
+        (midnight + 12 * hour, midnight + 22 * hour),   # inside a single day
+        (midnight, midnight + 48 * hour - 1),           # whole days only
+        (midnight + 2 * hour, None),
+        (None, midnight + 54 * hour),
+    ]:
+        reports = expected(start, end)
+        stats = db.get_stats(start_date=start, end_date=end)
+        assert stats["total_reports"] == len(reports), (start, end)
+        assert stats["total_volume"] == 7 * len(reports)
+        assert stats["disposition_stats"].get("reject", 0) == 2 * len(reports)
+        summary = db.get_stats_summary(start_date=start, end_date=end, group_by="day")
+        assert summary["totals"]["reports"] == len(reports)
+        assert sum(g["volume"] for g in summary["groups"]) == 7 * len(reports)
+
+    assert db.get_domain_stats()[0]["last_seen"] == ends[-1]
+    db.close_db()
+
+
+def test_rollup_migration_backfills_existing_reports(tmp_path, monkeypatch):
+    from backend.dmarc_lib import db
+
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "legacy.db"))
+    init_db()
+    save_report(_parsed_report("legacy-1", domain="legacy.example"))
+    save_report(_parsed_report("legacy-2", domain="legacy.example"))
+    # Roll the database back to how it looked before the rollup migration
+    conn = db.get_db()
+    conn.execute("DROP TABLE daily_rollup")
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+
+    db.migrate(conn)
+    stats = {d["domain"]: d for d in db.get_domain_stats()}["legacy.example"]
+    assert (stats["report_count"], stats["total_volume"]) == (2, 14)
+    db.close_db()
+
+
+def test_reports_list_keyset_pages_and_cached_count(tmp_path, monkeypatch):
+    from backend.dmarc_lib import db
+
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "pages.db"))
+    init_db()
+    save_reports([
+        _parsed_report(f"page-{i}", domain="pages.example", date_end=1700000000 + (i // 3) * 86400,
+                       records=[{"source_ip": "192.0.2.1", "count": i + 1, "disposition": "none",
+                                 "dkim": "pass", "spf": "pass"},
+                                {"source_ip": "192.0.2.2", "count": 1, "disposition": "reject",
+                                 "dkim": "fail", "spf": "fail"}])
+        for i in range(25)
+    ])
+    undated = _parsed_report("page-undated", domain="pages.example")
+    undated["metadata"]["date_range_end"] = None
+    save_report(undated)
+
+    first = db.get_reports_list(page_size=10, domain="pages.example")
+    assert first["total"] == 26
+    assert first["items"][0]["report_id"] == "page-24"
+    assert (first["items"][0]["total_count"], first["items"][0]["pass_count"],
+            first["items"][0]["fail_count"]) == (26, 25, 1)
+
+    seen = [r["id"] for r in first["items"]]
+    cursor = first["next_cursor"]
+    while cursor:
+        page = db.get_reports_list(page_size=10, domain="pages.example", cursor=cursor)
+        seen += [r["id"] for r in page["items"]]
+        cursor = page["next_cursor"]
+    offset_order = [r["id"] for p in (1, 2, 3)
+                    for r in db.get_reports_list(page=p, page_size=10, domain="pages.example")["items"]]
+    assert seen == offset_order
+    assert len(set(seen)) == 26
+
+    # The filtered count is served from cache until reports are ingested or deleted
+    executed = []
+    conn = db.get_db()
+    conn.set_trace_callback(executed.append)
+    db.get_reports_list(page_size=10, domain="pages.example")
+    assert not any("COUNT(*)" in sql for sql in executed)
+    save_report(_parsed_report("page-new", domain="pages.example"))
+    assert db.get_reports_list(page_size=10, domain="pages.example")["total"] == 27
+    db.delete_reports(domain="pages.example")
+    assert db.get_reports_list(page_size=10, domain="pages.example")["total"] == 0
+    conn.set_trace_callback(None)
+    db.close_db()
+
+
+def test_reports_search_uses_fts_prefixes(tmp_path, monkeypatch):
+    from backend.dmarc_lib import db
+
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "search.db"))
+    init_db()
+    google = _parsed_report("goog-4711", domain="example.com",
+                            records=[{"source_ip": "209.85.220.41", "count": 1, "disposition": "none",
+                                      "dkim": "pass", "spf": "pass"}])
+    google["metadata"]["org_name"] = "google.com"
+    other = _parsed_report("ms-0815", domain="contoso.net")
+    other["metadata"]["org_name"] = "Enterprise Outlook"
+    google_id = save_report(google)
+    other_id = save_report(other)
+
+    def ids(search):
+        return [r["id"] for r in db.get_reports_list(search=search)["items"]]
+
+    assert ids("goog") == [google_id]
+    assert ids("EXAMP") == [google_id]
+    assert ids("contoso") == [other_id]
+    assert ids("enterprise outl") == [other_id]
+    assert ids("209.85.220") == [google_id]
+    assert ids("goog-47") == [google_id]
+    assert ids("google contoso") == []
+    # FTS5 syntax in user input is matched as text, not interpreted
+    assert ids('goog OR "contoso') == []
+    assert ids("NEAR(") == []
+
+    db.delete_reports(domain="example.com")
+    assert ids("goog") == []
+    conn = db.get_db()
+    assert conn.execute("SELECT COUNT(*) FROM reports_fts").fetchone()[0] == 1
+    db.close_db()
+
+
+def test_report_totals_stored_at_ingest_and_backfilled(tmp_path, monkeypatch):
+    from backend.dmarc_lib import db
+
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "totals.db"))
+    init_db()
+    records = [
+        {"source_ip": "192.0.2.1", "count": 5, "disposition": "none", "dkim": "pass", "spf": "pass"},
+        {"source_ip": "192.0.2.2", "count": 3, "disposition": "quarantine", "dkim": "fail", "spf": "pass"},
+        {"source_ip": "192.0.2.3", "count": 2, "disposition": "reject", "dkim": "fail", "spf": "fail"},
+        {"source_ip": "192.0.2.4", "count": 1, "disposition": None, "dkim": "pass", "spf": "pass"},
+    ]
+    report_db_id = save_report(_parsed_report("totals-1", records=records))
+    expected = {"total_count": 11, "pass_count": 6, "fail_count": 5,
+                "quarantine_count": 3, "reject_count": 2, "record_count": 4}
+
+    summary = db.get_report_summary(report_db_id)
+    assert {k: summary[k] for k in expected} == expected
+    recent = db.get_stats()["recent_activity"][0]
+    assert (recent["total_count"], recent["pass_count"], recent["fail_count"]) == (11, 6, 5)
+
+    # Wipe the stored totals and re-run the migrations that fill them
+    conn = db.get_db()
+    conn.execute("UPDATE reports SET " + ", ".join(f"{k} = 0" for k in expected))
+    conn.execute("PRAGMA user_version = 5")
+    conn.commit()
+    db.migrate(conn)
+    summary = db.get_report_summary(report_db_id)
+    assert {k: summary[k] for k in expected} == expected
+    db.close_db()
+
+
+def test_api_key_auth_is_cached_and_usage_written_behind(tmp_path, monkeypatch):
+    from backend.dmarc_lib import db
+
+    db.flush_api_key_usage()  # usage buffered by earlier tests belongs to the default DB
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "auth.db"))
+    db.invalidate_auth_cache()
+    init_db()
+    user_id = db.create_user({"username": "cache-user", "password": "pw", "first_name": "C",
+                              "last_name": "U", "email": "c@example.com"})
+    key_id, raw_key = db.create_api_key(user_id, "cached")
+
+    executed = []
+    conn = db.get_db()
+    conn.set_trace_callback(executed.append)
+    assert db.get_user_by_api_key(raw_key)["username"] == "cache-user"
+    assert db.get_user_by_api_key(raw_key)["id"] == user_id
+    assert db.get_user_by_username_cached("cache-user")["id"] == user_id
+    assert db.get_user_by_username_cached("cache-user")["id"] == user_id
+    # One SELECT per principal, and no writes on the request path
+    assert len([sql for sql in executed if sql.lstrip().startswith("SELECT")]) == 2
+    assert not [sql for sql in executed if "UPDATE" in sql or "COMMIT" in sql.upper()]
+
+    # Pending usage shows up in the key list and is written in one batch
+    assert db.get_api_keys_for_user(user_id)[0]["last_used_at"] is not None
+    assert db.flush_api_key_usage() == 1
+    conn.set_trace_callback(None)
+    row = conn.execute("SELECT last_used_at FROM api_keys WHERE id = ?", (key_id,)).fetchone()
+    assert row[0] is not None
+    assert db.flush_api_key_usage() == 0
+
+    # Revoking the key or deleting the user takes effect immediately in this process
+    assert db.delete_api_key(key_id, user_id)
+    assert db.get_user_by_api_key(raw_key) is None
+    db.delete_user(user_id)
+    assert db.get_user_by_username_cached("cache-user") is None
+    db.close_db()
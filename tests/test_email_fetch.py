@@ -0,0 +1,479 @@
+import gzip
+import os
+import re
+import socketserver
+import sys
+import threading
+from email.message import EmailMessage
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.dmarc_lib import db, email_fetch
+
+REPORT_XML = b'<?xml version="1.0"?><feedback><report_metadata><report_id>imap-1</report_id></report_metadata></feedback>'
+
+
+def _quoted(value) -> str:
+    return "NIL" if value is None else '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _bodystructure(part) -> str:
+    """Just enough of RFC 3501 BODYSTRUCTURE for the messages built below."""
+    if part.is_multipart() and part.get_content_type() != "message/rfc822":
+        return "(" + "".join(_bodystructure(p) for p in part.get_payload()) + f" {_quoted(part.get_content_subtype().upper())})"
+    maintype, subtype = part.get_content_maintype().upper(), part.get_content_subtype().upper()
+    params = " ".join(f"{_quoted(k.upper())} {_quoted(v)}" for k, v in part.get_params()[1:]) or None
+    fields = [_quoted(maintype), _quoted(subtype), f"({params})" if params else "NIL", "NIL", "NIL"]
+    if maintype == "MESSAGE" and subtype == "RFC822":
+        inner = part.get_payload()[0]
+        fields += ['"7BIT"', str(len(inner.as_bytes())), "NIL", _bodystructure(inner), "1"]
+    else:
+        body = part.get_payload()
+        fields += [_quoted((part.get("Content-Transfer-Encoding") or "7bit").upper()), str(len(body))]
+        if maintype == "TEXT":
+            fields.append(str(body.count("\n") + 1))
+    disposition = part.get_content_disposition()
+    if disposition:
+        fields += ["NIL", f"({_quoted(disposition.upper())} ({_quoted('FILENAME')} {_quoted(part.get_filename())}))"]
+    return "(" + " ".join(fields) + ")"
+
+
+def _section(msg, section: str):
+    part = msg
+    for n in map(int, section.split(".")):
+        if part.get_content_type() == "message/rfc822":
+            part = part.get_payload()[0]
+        if part.is_multipart():
+            part = part.get_payload()[n - 1]
+        elif n != 1:
+            raise KeyError(section)
+    return part.get_payload().encode()
+
+
+class _IMAPStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _IMAPHandler)
+        self.messages = {}  # uid -> EmailMessage
+        self.uidvalidity = 42
+        self.commands = []
+        self.fail_on = None  # command answered with NO
+
+    def add(self, uid, msg):
+        self.messages[uid] = msg
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode() + b"\r\n")
+
+    def uids_in(self, spec):
+        known = sorted(self.server.messages)
+        selected = set()
+        for chunk in spec.split(","):
+            lo, _, hi = chunk.partition(":")
+            lo = max(known) if lo == "*" else int(lo)
+            hi = lo if not hi else (max(known) if hi == "*" else int(hi))
+            # "n:*" includes the newest message even when its UID is below n
+            lo, hi = min(lo, hi), max(lo, hi)
+            selected.update(uid for uid in known if lo <= uid <= hi)
+        return sorted(selected)
+
+    def handle(self):
+        self.send("* OK IMAP4rev1 stub ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, command = line.decode().rstrip("\r\n").split(" ", 1)
+            self.server.commands.append(command)
+            name = command.split(" ", 1)[0].upper()
+            if command == self.server.fail_on:
+                self.send(f"{tag} NO simulated failure")
+                continue
+            if name == "CAPABILITY":
+                self.send("* CAPABILITY IMAP4rev1")
+            elif name == "LOGOUT":
+                self.send("* BYE")
+                self.send(f"{tag} OK bye")
+                return
+            elif name in ("SELECT", "EXAMINE"):
+                self.send(f"* {len(self.server.messages)} EXISTS")
+                self.send(f"* OK [UIDVALIDITY {self.server.uidvalidity}] UIDs valid")
+            elif command.upper().startswith("UID SEARCH UID "):
+                spec = command.split()[-1]
+                self.send("* SEARCH " + " ".join(map(str, self.uids_in(spec) if self.server.messages else [])))
+            elif command.upper().startswith("UID FETCH "):
+                _, _, spec, items = command.split(" ", 3)
+                sections = re.findall(r"BODY\.PEEK\[([\d.]+)\]", items)
+                for seq, uid in enumerate(self.uids_in(spec), 1):
+                    msg = self.server.messages[uid]
+                    if "BODYSTRUCTURE" in items:
+                        self.send(f"* {seq} FETCH (UID {uid} BODYSTRUCTURE {_bodystructure(msg)})")
+                        continue
+                    out = f"* {seq} FETCH (UID {uid}".encode()
+                    for section in sections:
+                        data = _section(msg, section)
+                        out += f" BODY[{section}] {{{len(data)}}}\r\n".encode() + data
+                    self.send(out + b")\r\n")
+            elif name not in ("LOGIN", "NOOP"):
+                self.send(f"{tag} BAD unsupported")
+                continue
+            self.send(f"{tag} OK done")
+
+
+def _start_stub():
+    server = _IMAPStub()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def imap_stub(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "imap.db"))
+    db.init_db()
+    server = _start_stub()
+    db.set_setting("imap_host", "127.0.0.1")
+    db.set_setting("imap_port", server.server_address[1])
+    db.set_setting("imap_user", "reports@example.com")
+    db.set_setting("imap_pass", "secret")
+    db.set_setting("imap_use_ssl", False)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _report_message(filename, content, subtype="gzip", with_text=True):
+    msg = EmailMessage()
+    msg["Subject"] = f"Report {filename}"
+    if with_text:
+        msg.set_content("DMARC aggregate report attached.\n")
+        msg.add_attachment(content, maintype="application", subtype=subtype, filename=filename)
+    else:
+        msg.set_content(content, maintype="application", subtype=subtype, filename=filename)
+    return msg
+
+
+def test_uid_sync_fetches_only_report_parts(imap_stub):
+    imap_stub.add(3, _report_message("google.xml.gz", gzip.compress(REPORT_XML)))
+    imap_stub.add(5, _report_message("yahoo.zip", b"PK\x05\x06" + b"\x00" * 18, subtype="zip", with_text=False))
+    plain = EmailMessage()
+    plain["Subject"] = "hello"
+    plain.set_content("no attachments here\n")
+    plain.add_attachment(b"ignore me", maintype="application", subtype="pdf", filename="invoice.pdf")
+    imap_stub.add(7, plain)
+    forwarded = EmailMessage()
+    forwarded["Subject"] = "Fwd: report"
+    forwarded.set_content("see attached\n")
+    forwarded.add_attachment(_report_message("fwd.xml", REPORT_XML, subtype="xml"))
+    imap_stub.add(8, forwarded)
+
+    batches = list(email_fetch.fetch_dmarc_reports())
+    attachments = dict(item for batch_attachments, _ in batches for item in batch_attachments)
+    # Nothing is recorded until the caller commits the checkpoint
+    assert db.get_setting("imap_sync:reports@example.com@127.0.0.1/INBOX") is None
+    for _, checkpoint in batches:
+        email_fetch.commit_checkpoint(checkpoint)
+
+    assert sorted(attachments) == ["fwd.xml", "google.xml.gz", "yahoo.zip"]
+    assert gzip.decompress(attachments["google.xml.gz"]) == REPORT_XML
+    assert attachments["fwd.xml"] == REPORT_XML
+
+    fetches = [c for c in imap_stub.commands if c.upper().startswith("UID FETCH")]
+    # One BODYSTRUCTURE round trip for the batch, then only the attachment sections
+    assert fetches[0] == "UID FETCH 3,5,7:8 (UID BODYSTRUCTURE)"
+    assert sorted(fetches[1:]) == sorted([
+        "UID FETCH 3 (UID BODY.PEEK[2])", "UID FETCH 5 (UID BODY.PEEK[1])", "UID FETCH 8 (UID BODY.PEEK[2.2])"])
+    assert not any("RFC822" in c or "BODY[]" in c for c in imap_stub.commands)
+    assert any(c.startswith("EXAMINE") for c in imap_stub.commands)  # read-only: flags untouched
+
+    state = db.get_setting("imap_sync:reports@example.com@127.0.0.1/INBOX")
+    assert state == {"uidvalidity": 42, "last_uid": 8}
+
+    # Next run only asks for newer UIDs, whatever their \Seen flag
+    imap_stub.commands.clear()
+    assert list(email_fetch.fetch_dmarc_reports()) == []
+    assert "UID SEARCH UID 9:*" in imap_stub.commands
+    assert not any(c.upper().startswith("UID FETCH") for c in imap_stub.commands)
+
+    imap_stub.add(12, _report_message("late.xml", REPORT_XML.replace(b"imap-1", b"imap-2"), subtype="xml"))
+    [(attachments, checkpoint)] = email_fetch.fetch_dmarc_reports()
+    assert [name for name, _ in attachments] == ["late.xml"]
+    email_fetch.commit_checkpoint(checkpoint)
+    assert db.get_setting("imap_sync:reports@example.com@127.0.0.1/INBOX")["last_uid"] == 12
+
+
+def test_uidvalidity_change_resyncs(imap_stub):
+    for uid in range(1, 6):
+        imap_stub.add(uid, _report_message(f"r{uid}.xml", REPORT_XML.replace(b"imap-1", f"v-{uid}".encode()),
+                                           subtype="xml"))
+    mail = email_fetch.imaplib.IMAP4("127.0.0.1", imap_stub.server_address[1])
+    mail.login("u", "p")
+    batches = list(email_fetch.sync_mailbox(mail, "imap_sync:test", batch_size=2))
+    # One checkpoint per UID batch
+    assert [len(attachments) for attachments, _ in batches] == [2, 2, 1]
+    assert [checkpoint["last_uid"] for _, checkpoint in batches] == [2, 4, 5]
+    email_fetch.commit_checkpoint(batches[-1][1])
+    structure_fetches = [c for c in imap_stub.commands if "BODYSTRUCTURE" in c]
+    assert structure_fetches == ["UID FETCH 1:2 (UID BODYSTRUCTURE)", "UID FETCH 3:4 (UID BODYSTRUCTURE)",
+                                 "UID FETCH 5 (UID BODYSTRUCTURE)"]
+
+    imap_stub.uidvalidity = 43
+    imap_stub.commands.clear()
+    [(attachments, checkpoint)] = email_fetch.sync_mailbox(mail, "imap_sync:test")
+    assert len(attachments) == 5
+    email_fetch.commit_checkpoint(checkpoint)
+    assert "UID SEARCH UID 1:*" in imap_stub.commands
+    assert db.get_setting("imap_sync:test") == {"uidvalidity": 43, "last_uid": 5}
+    mail.logout()
+
+
+def test_failed_batch_keeps_earlier_batches(imap_stub):
+    for uid in range(1, 6):
+        imap_stub.add(uid, _report_message(f"r{uid}.xml", REPORT_XML.replace(b"imap-1", f"f-{uid}".encode()),
+                                           subtype="xml"))
+    imap_stub.fail_on = "UID FETCH 3:4 (UID BODYSTRUCTURE)"
+    mail = email_fetch.imaplib.IMAP4("127.0.0.1", imap_stub.server_address[1])
+    mail.login("u", "p")
+    batches = email_fetch.sync_mailbox(mail, "imap_sync:test", batch_size=2)
+    attachments, checkpoint = next(batches)
+    assert [name for name, _ in attachments] == ["r1.xml", "r2.xml"]
+    email_fetch.commit_checkpoint(checkpoint)
+    with pytest.raises(email_fetch.imaplib.IMAP4.error):
+        next(batches)
+    assert db.get_setting("imap_sync:test") == {"uidvalidity": 42, "last_uid": 2}
+
+    # The retry resumes after the committed batch and refetches the one that failed
+    imap_stub.fail_on = None
+    imap_stub.commands.clear()
+    batches = list(email_fetch.sync_mailbox(mail, "imap_sync:test", batch_size=2))
+    assert [name for attachments, _ in batches for name, _ in attachments] == ["r3.xml", "r4.xml", "r5.xml"]
+    assert "UID SEARCH UID 3:*" in imap_stub.commands
+    email_fetch.commit_checkpoint(batches[-1][1])
+    assert db.get_setting("imap_sync:test") == {"uidvalidity": 42, "last_uid": 5}
+    mail.logout()
+
+
+def test_bodystructure_parsing_handles_literals_and_encoded_names():
+    data = [
+        (b'1 (UID 9 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)'
+         b'("APPLICATION" "OCTET-STREAM" ("NAME" {31}', b'=?utf-8?q?r=C3=A9port=2Exml?=.gz'),
+        b') NIL NIL "BASE64" 100 NIL ("ATTACHMENT" ("FILENAME*" "utf-8\'\'r%C3%A9sum%C3%A9.xml.gz")) NIL NIL) "MIXED"))',
+    ]
+    items = email_fetch._fetch_items(data)
+    assert items[0]["UID"] == "9"
+    assert email_fetch._report_sections(items[0]["BODYSTRUCTURE"]) == [("2", "résumé.xml.gz", "base64")]
+    assert email_fetch._uid_set([1, 2, 3, 7, 9, 10]) == "1:3,7,9:10"
+
+
+def test_mail_poller_polls_mailboxes_concurrently(imap_stub, monkeypatch):
+    import asyncio
+    import socket
+    from backend.dmarc_lib import mail_poller
+
+    second = _start_stub()
+    imap_stub.add(1, _report_message("a.xml", REPORT_XML, subtype="xml"))
+    second.add(1, _report_message("b.xml.gz", gzip.compress(REPORT_XML.replace(b"imap-1", b"imap-b"))))
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    dead_port = closed.getsockname()[1]
+    closed.close()
+    db.set_setting("imap_mailboxes", [
+        {"name": "second", "host": "127.0.0.1", "port": second.server_address[1], "user": "u2", "pass": "p",
+         "use_ssl": False},
+        {"name": "down", "host": "127.0.0.1", "port": dead_port, "user": "u3", "pass": "p", "use_ssl": False},
+    ])
+    monkeypatch.setattr(mail_poller, "IMAP_BACKOFF_BASE", 10)
+    ingested = []
+
+    async def ingest(attachments, source):
+        ingested.extend((source, name) for name, _ in attachments)
+        return list(range(len(attachments)))
+
+    async def run():
+        poller = mail_poller.MailPoller(ingest, interval=60)
+        await poller.start(schedule=False)
+        try:
+            first = await poller.poll_all()
+            second.add(2, _report_message("c.xml", REPORT_XML.replace(b"imap-1", b"imap-c"), subtype="xml"))
+            again = await poller.poll_all()
+            return first, again, {s["name"]: s for s in poller.status()}, poller.mailboxes
+        finally:
+            await poller.stop()
+
+    first, again, status, mailboxes = asyncio.run(run())
+    by_name = {r["mailbox"]: r for r in first}
+    assert set(by_name) == {"default", "second", "down"}
+    assert by_name["default"]["files"] == ["a.xml"] and by_name["second"]["files"] == ["b.xml.gz"]
+    assert "error" in by_name["down"]
+    assert sorted(ingested) == [("email", "a.xml"), ("email", "b.xml.gz"), ("email", "c.xml")]
+
+    # The connection is reused between polls (NOOP instead of a new LOGIN)
+    assert sum(c.startswith("LOGIN") for c in second.commands) == 1
+    assert "NOOP" in second.commands
+
+    assert status["second"]["messages"] == 2 and status["second"]["attachments"] == 2
+    assert status["second"]["bytes"] > 0 and status["second"]["last_success"] is not None
+    assert status["second"]["last_latency_ms"] is not None and status["second"]["errors"] == 0
+    assert status["down"]["errors"] == 2 and status["down"]["consecutive_failures"] == 2
+    assert status["down"]["last_error"] and status["down"]["last_success"] is None
+    # Failing mailboxes back off exponentially instead of retrying every interval
+    assert mailboxes["down"].next_delay() == 20
+    assert mailboxes["second"].next_delay() == 60
+    second.shutdown()
+    second.server_close()
+
+
+def test_mail_poller_schedule_feeds_ingest(imap_stub):
+    import asyncio
+    from backend.dmarc_lib import mail_poller
+
+    imap_stub.add(1, _report_message("sched.xml", REPORT_XML, subtype="xml"))
+    received = asyncio.Queue
+
+    async def run():
+        queue = received()
+
+        async def ingest(attachments, source):
+            for item in attachments:
+                queue.put_nowait(item)
+            return []
+
+        poller = mail_poller.MailPoller(ingest, interval=0.05)
+        await poller.start()
+        try:
+            first = await asyncio.wait_for(queue.get(), 5)
+            imap_stub.add(2, _report_message("later.xml", REPORT_XML.replace(b"imap-1", b"imap-l"), subtype="xml"))
+            later = await asyncio.wait_for(queue.get(), 5)
+            return first[0], later[0], poller.status()[0]
+        finally:
+            await poller.stop()
+
+    first, later, status = asyncio.run(run())
+    assert (first, later) == ("sched.xml", "later.xml")
+    assert status["polls"] >= 2 and status["next_poll_at"] is not None
+
+
+def test_mail_poller_commits_checkpoint_after_ingest(imap_stub):
+    import asyncio
+    from backend.dmarc_lib import mail_poller
+
+    imap_stub.add(1, _report_message("first.xml", REPORT_XML, subtype="xml"))
+    state_key = "imap_sync:reports@example.com@127.0.0.1/INBOX"
+    calls = []
+
+    async def flaky_ingest(attachments, source):
+        calls.append([name for name, _ in attachments])
+        if len(calls) == 1:
+            raise RuntimeError("queue unavailable")
+        return [1]
+
+    async def run():
+        poller = mail_poller.MailPoller(flaky_ingest, interval=60)
+        await poller.start(schedule=False)
+        try:
+            failed = await poller.poll_all()
+            state_after_failure = db.get_setting(state_key)
+            retried = await poller.poll_all()
+            return failed, state_after_failure, retried, poller.status()[0]
+        finally:
+            await poller.stop()
+
+    failed, state_after_failure, retried, status = asyncio.run(run())
+    assert "queue unavailable" in failed[0]["error"] and state_after_failure is None
+    # The failed ingest did not advance the checkpoint, so the report is fetched again
+    assert calls == [["first.xml"], ["first.xml"]]
+    assert retried[0]["files"] == ["first.xml"] and retried[0]["jobs"] == [1]
+    assert db.get_setting(state_key) == {"uidvalidity": 42, "last_uid": 1}
+    assert status["errors"] == 1 and status["consecutive_failures"] == 0
+
+
+def test_mail_poller_commits_each_batch(imap_stub, monkeypatch):
+    import asyncio
+    import functools
+    from backend.dmarc_lib import mail_poller
+
+    for uid in (1, 2, 3):
+        imap_stub.add(uid, _report_message(f"b{uid}.xml", REPORT_XML.replace(b"imap-1", f"b-{uid}".encode()),
+                                           subtype="xml"))
+    monkeypatch.setattr(mail_poller, "sync_mailbox", functools.partial(email_fetch.sync_mailbox, batch_size=1))
+    state_key = "imap_sync:reports@example.com@127.0.0.1/INBOX"
+    calls = []
+
+    async def ingest(attachments, source):
+        calls.append([name for name, _ in attachments])
+        if calls[-1] == ["b2.xml"] and calls.count(["b2.xml"]) == 1:
+            raise RuntimeError("queue unavailable")
+        return [len(calls)]
+
+    async def run():
+        poller = mail_poller.MailPoller(ingest, interval=60)
+        await poller.start(schedule=False)
+        try:
+            failed = await poller.poll_all()
+            state_after_failure = db.get_setting(state_key)
+            retried = await poller.poll_all()
+            return failed, state_after_failure, retried
+        finally:
+            await poller.stop()
+
+    failed, state_after_failure, retried = asyncio.run(run())
+    # The batch ingested before the failure stays committed; only the rest is fetched again
+    assert failed[0]["files"] == ["b1.xml"] and "queue unavailable" in failed[0]["error"]
+    assert state_after_failure == {"uidvalidity": 42, "last_uid": 1}
+    assert calls == [["b1.xml"], ["b2.xml"], ["b2.xml"], ["b3.xml"]]
+    assert retried[0]["files"] == ["b2.xml", "b3.xml"] and retried[0]["jobs"] == [3, 4]
+    assert db.get_setting(state_key) == {"uidvalidity": 42, "last_uid": 3}
+
+
+def test_mail_poller_commits_only_durable_payloads(imap_stub, tmp_path, monkeypatch):
+    import asyncio
+    import uuid
+    from concurrent.futures import ThreadPoolExecutor
+    from backend.dmarc_lib import jobs, mail_poller
+
+    imap_stub.add(1, _report_message("durable.xml", REPORT_XML.replace(b"imap-1", str(uuid.uuid4()).encode()),
+                                     subtype="xml"))
+    monkeypatch.setattr(jobs, "RAW_ARCHIVE_DIR", "")
+    files_at_commit = []
+
+    def checking_commit(checkpoint):
+        conn = db.get_db()
+        paths = [row[0] for row in conn.execute("SELECT file_path FROM ingest_jobs WHERE id IN (%s)"
+                                                % ",".join("?" * len(submitted)), submitted)]
+        conn.close()
+        files_at_commit.extend((path, os.path.exists(path)) for path in paths)
+        email_fetch.commit_checkpoint(checkpoint)
+
+    monkeypatch.setattr(mail_poller, "commit_checkpoint", checking_commit)
+    submitted = []
+
+    async def run():
+        workers = jobs.IngestWorkers(ThreadPoolExecutor(max_workers=2), workers=1, use_processes=False,
+                                     poll_interval=0.05, spill_dir=tmp_path / "spill")
+
+        async def ingest(attachments, source):
+            submitted.extend(await workers.submit_payloads(attachments, source))
+            return list(submitted)
+
+        poller = mail_poller.MailPoller(ingest, interval=60)
+        await workers.start()
+        await poller.start(schedule=False)
+        try:
+            result = await poller.poll_all()
+            await workers.wait_payloads()
+            return result
+        finally:
+            await poller.stop()
+            await workers.stop()
+
+    result = asyncio.run(run())
+    assert result[0]["files"] == ["durable.xml"] and len(submitted) == 1
+    # By the time the checkpoint moves past the message, its payload is on disk behind a job row
+    assert len(files_at_commit) == 1
+    path, existed = files_at_commit[0]
+    assert existed and path.startswith(str(tmp_path / "spill"))
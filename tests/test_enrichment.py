@@ -0,0 +1,333 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import socket
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.dmarc_lib import enrichment, geoip
+from backend.dmarc_lib.db import get_db, init_db
+from backend.dmarc_lib.geoip import load_ip_ranges
+from backend.dmarc_lib.rdns import ReverseResolver
+
+
+@pytest.fixture
+def ranges_csv(tmp_path):
+    p = tmp_path / "ranges.csv"
+    p.write_text(
+        "start_ip,end_ip,country_code,country_name,city,asn,asn_name\n"
+        "8.8.8.0,8.8.8.255,US,United States,Mountain View,15169,GOOGLE\n"
+        "1.1.1.0,1.1.1.255,AU,Australia,,13335,CLOUDFLARENET\n"
+        "2001:4860::,2001:4860:ffff:ffff:ffff:ffff:ffff:ffff,US,United States,,AS15169,GOOGLE\n"
+        "not-an-ip,also-not,XX,Nowhere,,,\n"
+    )
+    return p
+
+
+def test_load_ip_ranges_lookup(ranges_csv):
+    db = load_ip_ranges(ranges_csv)
+    assert len(db) == 3
+    assert db.lookup("8.8.8.8") == {
+        "country_code": "US", "country_name": "United States",
+        "city": "Mountain View", "asn": 15169, "asn_name": "GOOGLE",
+    }
+    assert db.lookup("1.1.1.1")["asn"] == 13335
+    assert "city" not in db.lookup("1.1.1.1")
+    assert db.lookup("2001:4860:4860::8888")["asn"] == 15169
+    assert db.lookup("::ffff:8.8.8.8")["asn"] == 15169
+    assert db.lookup("9.9.9.9") is None
+    assert db.lookup("garbage") is None
+
+
+def test_load_ip_ranges_network_tsv(tmp_path):
+    p = tmp_path / "networks.tsv"
+    p.write_text("network\tcountry_iso_code\tautonomous_system_number\n"
+                 "192.0.2.0/24\tZZ\t64500\n"
+                 "2001:db8::/32\tZZ\t64501\n")
+    db = load_ip_ranges(p)
+    assert db.lookup("192.0.2.77")["asn"] == 64500
+    assert db.lookup("2001:db8::1")["asn"] == 64501
+    assert db.lookup("192.0.3.1") is None
+
+
+def test_load_geolite2_city_blocks_with_locations(tmp_path):
+    (tmp_path / "GeoLite2-City-Locations-en.csv").write_text(
+        "geoname_id,locale_code,continent_code,continent_name,country_iso_code,country_name,"
+        "subdivision_1_iso_code,subdivision_1_name,subdivision_2_iso_code,subdivision_2_name,"
+        "city_name,metro_code,time_zone,is_in_european_union\n"
+        '5375480,en,NA,"North America",US,"United States",CA,California,,,"Mountain View",807,America/Los_Angeles,0\n'
+        '2077456,en,OC,Oceania,AU,Australia,,,,,,,Australia/Sydney,0\n')
+    header = ("network,geoname_id,registered_country_geoname_id,represented_country_geoname_id,"
+              "is_anonymous_proxy,is_satellite_provider,postal_code,latitude,longitude,accuracy_radius\n")
+    v4 = tmp_path / "GeoLite2-City-Blocks-IPv4.csv"
+    v4.write_text(header + "8.8.8.0/24,5375480,6252001,,0,0,94035,37.4,-122.1,1000\n"
+                           "1.1.1.0/24,,2077456,,0,0,,,,\n")
+    v6 = tmp_path / "GeoLite2-City-Blocks-IPv6.csv"
+    v6.write_text(header + "2001:4860::/32,5375480,6252001,,0,0,,,,\n")
+
+    db = load_ip_ranges([v4, v6])
+    assert db.lookup("8.8.8.8") == {"country_code": "US", "country_name": "United States", "city": "Mountain View"}
+    # No city location: falls back to the registered country
+    assert db.lookup("1.1.1.1") == {"country_code": "AU", "country_name": "Australia"}
+    assert db.lookup("2001:4860::1")["city"] == "Mountain View"
+
+    (tmp_path / "GeoLite2-City-Locations-en.csv").unlink()
+    with pytest.raises(ValueError, match="GEOIP_LOCATIONS_PATH"):
+        load_ip_ranges(v4)
+
+
+def test_load_ip_ranges_drops_overlaps(tmp_path, caplog):
+    p = tmp_path / "overlap.csv"
+    p.write_text("network,country_code\n"
+                 "10.0.0.0/8,AA\n"
+                 "10.1.0.0/16,BB\n"
+                 "11.0.0.0/24,CC\n")
+    db = load_ip_ranges(p)
+    assert len(db) == 2
+    assert db.lookup("10.1.2.3")["country_code"] == "AA"
+    assert db.lookup("10.200.0.1")["country_code"] == "AA"
+    assert db.lookup("11.0.0.9")["country_code"] == "CC"
+    assert "Dropped 1 IP ranges" in caplog.text
+
+
+def test_enrich_ip_prefers_local_db(ranges_csv, monkeypatch):
+    init_db()
+    monkeypatch.setattr(geoip, "_db", load_ip_ranges(ranges_csv))
+
+    async def no_http(ip):
+        raise AssertionError("HTTP GeoIP should not be called for a local hit")
+
+    async def no_rdns(ip):
+        return None
+
+    monkeypatch.setattr(enrichment, "fetch_geoip", no_http)
+    monkeypatch.setattr(enrichment, "get_rdns", no_rdns)
+
+    data = asyncio.run(enrichment.enrich_ip("8.8.8.4", force_refresh=True))
+    assert data["country_code"] == "US"
+    assert data["asn_name"] == "GOOGLE"
+
+    monkeypatch.setattr(enrichment, "GEOIP_HTTP_FALLBACK", False)
+    data = asyncio.run(enrichment.enrich_ip("203.0.113.9", force_refresh=True))
+    assert data["country_code"] is None
+
+
+def test_batch_enrich_ips_single_cache_round_trip(monkeypatch):
+    init_db()
+    conn = get_db()
+    conn.execute("DELETE FROM ip_enrichment WHERE ip LIKE '198.51.100.%'")
+    conn.commit()
+    looked_up = []
+    cache_reads = []
+    cache_writes = []
+
+    async def fake_rdns(ip):
+        return f"host-{ip}"
+
+    async def fake_geoip_many(ips):
+        looked_up.extend(ips)
+        return {ip: {"country_code": "ZZ", "asn": 64500, "asn_name": "TEST"} for ip in ips}
+
+    load_cached = enrichment._load_cached
+    save = enrichment._save_enrichment
+    monkeypatch.setattr(enrichment, "get_rdns", fake_rdns)
+    monkeypatch.setattr(enrichment, "lookup_geoip_many", fake_geoip_many)
+    monkeypatch.setattr(enrichment, "_load_cached", lambda ips: cache_reads.append(len(ips)) or load_cached(ips))
+    monkeypatch.setattr(enrichment, "_save_enrichment", lambda rows: cache_writes.append(len(rows)) or save(rows))
+    monkeypatch.setattr(enrichment, "CACHE_LOOKUP_CHUNK", 7)
+
+    first = [f"198.51.100.{i}" for i in range(20)]
+    result = asyncio.run(enrichment.batch_enrich_ips(first + first[:5]))
+    assert set(result) == set(first)
+    assert sorted(looked_up) == sorted(first)
+    assert cache_reads == [20]
+    assert cache_writes == [20]
+
+    looked_up.clear()
+    second = first[:10] + [f"198.51.100.{i}" for i in range(100, 103)]
+    result = asyncio.run(enrichment.batch_enrich_ips(second))
+    assert result["198.51.100.3"]["rdns"] == "host-198.51.100.3"
+    assert sorted(looked_up) == ["198.51.100.100", "198.51.100.101", "198.51.100.102"]
+    assert cache_writes == [20, 3]
+
+
+@pytest.fixture
+def ip_api_stub():
+    """Local stand-in for ip-api.com recording every request it serves."""
+    calls = []
+
+    def geo(ip):
+        return {"status": "success", "country": "Testland", "countryCode": "ZZ",
+                "city": "Stub", "as": "AS64500 Stub Networks", "query": ip}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("X-Rl", "40")
+            self.send_header("X-Ttl", "60")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            ip = self.path.split("?")[0].rsplit("/", 1)[-1]
+            calls.append(("GET", ip))
+            time.sleep(0.05)
+            self._reply(geo(ip))
+
+        def do_POST(self):
+            ips = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            calls.append(("POST", len(ips)))
+            self._reply([geo(ip) for ip in ips])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", calls
+    server.shutdown()
+    server.server_close()
+
+
+def test_geoip_client_coalesces_and_batches(ip_api_stub):
+    base_url, calls = ip_api_stub
+
+    async def run():
+        client = enrichment.GeoIPClient(base_url, rate_per_minute=6000, batch_rate_per_minute=6000)
+        try:
+            same = await asyncio.gather(*(client.lookup("192.0.2.1") for _ in range(5)))
+            many = await client.lookup_many([f"10.0.{i // 250}.{i % 250}" for i in range(150)])
+        finally:
+            await client.aclose()
+        return same, many
+
+    same, many = asyncio.run(run())
+    assert calls[0] == ("GET", "192.0.2.1")
+    assert calls[1:] == [("POST", 100), ("POST", 50)]
+    assert all(r == same[0] for r in same)
+    assert same[0] == {"country_name": "Testland", "country_code": "ZZ", "city": "Stub",
+                       "asn": 64500, "asn_name": "Stub Networks"}
+    assert len(many) == 150 and many["10.0.0.7"]["asn"] == 64500
+
+
+def test_token_bucket_paces_requests():
+    async def run():
+        bucket = enrichment.TokenBucket(rate_per_minute=600, capacity=2)  # 10/s after a burst of 2
+        start = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    elapsed = asyncio.run(run())
+    assert 0.15 <= elapsed < 1.0
+
+
+@pytest.fixture
+def dns_stub():
+    """UDP DNS server: answers PTR for 192.0.2.1, NXDOMAIN otherwise, never answers 192.0.2.99."""
+    queries = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.1)
+    stop = threading.Event()
+
+    def serve():
+        while not stop.is_set():
+            try:
+                wire, addr = sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            query = dns.message.from_wire(wire)
+            name = query.question[0].name.to_text()
+            queries.append(name)
+            if name.startswith("99.2.0.192."):
+                continue
+            response = dns.message.make_response(query)
+            if name == "1.2.0.192.in-addr.arpa.":
+                response.answer.append(dns.rrset.from_text(name, 300, "IN", "PTR", "mail.example.net."))
+            else:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            sock.sendto(response.to_wire(), addr)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield sock.getsockname()[1], queries
+    stop.set()
+    thread.join()
+    sock.close()
+
+
+def test_reverse_resolver_caches_hits_and_misses(dns_stub):
+    port, queries = dns_stub
+    resolver = ReverseResolver(["127.0.0.1"], port=port, timeout=0.3, concurrency=2)
+
+    async def run():
+        first = await asyncio.gather(resolver.resolve("192.0.2.1"), resolver.resolve("192.0.2.2"),
+                                     resolver.resolve("192.0.2.99"))
+        second = await asyncio.gather(resolver.resolve("192.0.2.1"), resolver.resolve("192.0.2.2"),
+                                      resolver.resolve("192.0.2.99"))
+        return first, second
+
+    start = time.monotonic()
+    first, second = asyncio.run(run())
+    assert first == second == ["mail.example.net", None, None]
+    # The unanswered lookup is bounded by the timeout, and nothing is asked twice
+    assert time.monotonic() - start < 2.0
+    assert queries.count("1.2.0.192.in-addr.arpa.") == 1
+    assert queries.count("2.2.0.192.in-addr.arpa.") == 1
+
+
+def test_reverse_resolver_negative_ttl_expires(dns_stub):
+    port, queries = dns_stub
+    resolver = ReverseResolver(["127.0.0.1"], port=port, timeout=0.3, negative_ttl=0)
+    assert asyncio.run(resolver.resolve("192.0.2.3")) is None
+    assert asyncio.run(resolver.resolve("192.0.2.3")) is None
+    assert queries.count("3.2.0.192.in-addr.arpa.") == 2
+
+
+def test_geoip_client_cancelled_batch_releases_claims(ip_api_stub):
+    base_url, calls = ip_api_stub
+
+    async def run():
+        client = enrichment.GeoIPClient(base_url, rate_per_minute=6000, batch_rate_per_minute=6000)
+        started = asyncio.Event()
+        real_post = client._client.post
+
+        async def hanging_post(*args, **kwargs):
+            started.set()
+            await asyncio.sleep(3600)
+            return await real_post(*args, **kwargs)
+
+        client._client.post = hanging_post
+        try:
+            task = asyncio.create_task(client.lookup_many([f"10.0.0.{i}" for i in range(250)]))
+            await started.wait()  # first chunk in flight, later chunks claimed
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            leftover = len(client._inflight)
+            # A later lookup of an IP from an unsent chunk makes its own request
+            geo = await asyncio.wait_for(client.lookup("10.0.0.150"), 5)
+        finally:
+            await client.aclose()
+        return leftover, geo
+
+    leftover, geo = asyncio.run(run())
+    assert leftover == 0
+    assert geo["asn"] == 64500
+    assert calls == [("GET", "10.0.0.150")]
@@ -0,0 +1,342 @@
+import asyncio
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.dmarc_lib import jobs
+from backend.dmarc_lib.db import get_db, init_db
+
+
+def _report_file(tmp_path, report_id):
+    path = tmp_path / f"{report_id}.xml"
+    path.write_text(f"""<?xml version="1.0" encoding="UTF-8"?>
+<feedback>
+  <report_metadata>
+    <org_name>Queue Org</org_name>
+    <report_id>{report_id}</report_id>
+    <date_range><begin>1700000000</begin><end>1700086400</end></date_range>
+  </report_metadata>
+  <policy_published><domain>queue.example</domain><p>none</p></policy_published>
+  <record>
+    <row>
+      <source_ip>192.0.2.10</source_ip>
+      <count>3</count>
+      <policy_evaluated><disposition>none</disposition><dkim>pass</dkim><spf>pass</spf></policy_evaluated>
+    </row>
+  </record>
+</feedback>
+""")
+    return path
+
+
+def _job_rows(job_ids):
+    conn = get_db()
+    placeholders = ",".join("?" * len(job_ids))
+    rows = {r['id']: dict(r) for r in conn.execute(
+        f"SELECT * FROM ingest_jobs WHERE id IN ({placeholders})", job_ids)}
+    conn.close()
+    return rows
+
+
+def _workers(use_processes, workers, on_saved, **kwargs):
+    return jobs.IngestWorkers(ThreadPoolExecutor(max_workers=4), workers=workers,
+                              use_processes=use_processes, on_saved=on_saved, poll_interval=0.05, **kwargs)
+
+
+def _drain(job_ids, use_processes=False, workers=2, timeout=20, **kwargs):
+    """Run an IngestWorkers pool until the given jobs are finished."""
+    saved = []
+
+    async def on_saved(report_id):
+        saved.append(report_id)
+
+    async def run():
+        pool = _workers(use_processes, workers, on_saved, **kwargs)
+        await pool.start()
+        pool.notify()
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                rows = _job_rows(job_ids)
+                if all(r['status'] in ('done', 'duplicate', 'failed') for r in rows.values()):
+                    return rows
+                await asyncio.sleep(0.05)
+            raise AssertionError(f"jobs did not finish: {_job_rows(job_ids)}")
+        finally:
+            await pool.stop()
+
+    return asyncio.run(run()), saved
+
+
+def test_workers_ingest_queued_files(tmp_path):
+    init_db()
+    paths = [_report_file(tmp_path, f"queue-{uuid.uuid4()}") for _ in range(4)]
+    job_ids = jobs.enqueue_jobs(paths, "test")
+
+    rows, saved = _drain(job_ids)
+    assert all(r['status'] == 'done' for r in rows.values())
+    assert all(r['report_id'] and r['parse_ms'] is not None and r['save_ms'] is not None for r in rows.values())
+    assert sorted(saved) == sorted(r['report_id'] for r in rows.values())
+
+    stats = jobs.get_job_stats(limit=10)
+    assert set(stats["counts"]) == {"queued", "running", "done", "duplicate", "failed"}
+    assert stats["counts"]["done"] >= 4
+
+
+def test_notify_during_claim_is_not_lost(monkeypatch):
+    import threading
+    init_db()
+    claims = []
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        pool = jobs.IngestWorkers(ThreadPoolExecutor(max_workers=2), workers=1, use_processes=False,
+                                  poll_interval=30)
+
+        def racing_claim():
+            claims.append(time.monotonic())
+            if len(claims) == 1:
+                # A job is enqueued (and notify() called) while this claim runs
+                notified = threading.Event()
+                loop.call_soon_threadsafe(lambda: (pool.notify(), notified.set()))
+                notified.wait(5)
+            return None
+
+        monkeypatch.setattr(jobs, "claim_job", racing_claim)
+        await pool.start()
+        try:
+            deadline = time.monotonic() + 5
+            while len(claims) < 2 and time.monotonic() < deadline:
+                await asyncio.sleep(0.02)
+        finally:
+            await pool.stop()
+
+    asyncio.run(run())
+    # The worker claimed again right away instead of sleeping a full poll interval
+    assert len(claims) >= 2 and claims[1] - claims[0] < 5
+
+
+def test_failed_job_retries_with_backoff_then_fails(tmp_path, monkeypatch):
+    init_db()
+    monkeypatch.setattr(jobs, "INGEST_RETRY_BACKOFF", 0.05)
+    job_id, = jobs.enqueue_jobs([tmp_path / "missing.xml"], "test", max_attempts=3)
+
+    conn = get_db()
+    conn.execute("UPDATE ingest_jobs SET status = 'running', attempts = 1 WHERE id = ?", (job_id,))
+    conn.commit()
+    conn.close()
+    assert jobs.fail_job(job_id, "boom") == 'queued'
+    row = _job_rows([job_id])[job_id]
+    assert row['attempts'] == 1 and row['run_after'] > time.time()
+
+    rows, saved = _drain([job_id])
+    assert rows[job_id]['status'] == 'failed'
+    assert rows[job_id]['attempts'] == 3
+    assert "FileNotFoundError" in rows[job_id]['error']
+    assert saved == []
+
+
+def test_interrupted_jobs_are_requeued(tmp_path):
+    init_db()
+    job_id, = jobs.enqueue_jobs([_report_file(tmp_path, f"queue-{uuid.uuid4()}")], "test")
+    conn = get_db()
+    conn.execute("UPDATE ingest_jobs SET status = 'running', attempts = 1 WHERE id = ?", (job_id,))
+    conn.commit()
+    conn.close()
+
+    rows, _ = _drain([job_id])
+    assert rows[job_id]['status'] == 'done'
+    assert rows[job_id]['attempts'] == 2
+
+
+def test_workers_parse_in_processes(tmp_path):
+    init_db()
+    paths = [_report_file(tmp_path, f"queue-{uuid.uuid4()}") for _ in range(3)]
+    job_ids = jobs.enqueue_jobs(paths, "test")
+    rows, _ = _drain(job_ids, use_processes=True, timeout=60)
+    assert all(r['status'] == 'done' for r in rows.values())
+
+
+def test_large_files_are_streamed_into_the_db(tmp_path, monkeypatch):
+    init_db()
+    path = _report_file(tmp_path, f"queue-{uuid.uuid4()}")
+    monkeypatch.setattr(jobs, "_parse_file", lambda path: pytest.fail("parsed in the pool"))
+    job_id, = jobs.enqueue_jobs([path], "test")
+
+    rows, saved = _drain([job_id], stream_bytes=0)
+    assert rows[job_id]['status'] == 'done'
+    assert rows[job_id]['parse_ms'] is None and rows[job_id]['save_ms'] is not None
+    assert saved == [rows[job_id]['report_id']]
+    conn = get_db()
+    count = conn.execute("SELECT SUM(count) FROM records WHERE report_id = ?", (saved[0],)).fetchone()[0]
+    conn.close()
+    assert count == 3
+
+
+def test_broken_parse_pool_is_replaced(tmp_path):
+    import signal
+    init_db()
+
+    async def wait_done(job_id):
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            row = _job_rows([job_id])[job_id]
+            if row['status'] in ('done', 'failed'):
+                return row
+            await asyncio.sleep(0.05)
+        raise AssertionError(f"job did not finish: {row}")
+
+    async def run():
+        pool = _workers(True, 1, None)
+        await pool.start()
+        try:
+            first, = jobs.enqueue_jobs([_report_file(tmp_path, f"queue-{uuid.uuid4()}")], "test")
+            pool.notify()
+            assert (await wait_done(first))['status'] == 'done'
+
+            # Kill the worker process; the pool notices and marks itself broken
+            broken = pool._parse_executor
+            for process in list(broken._processes.values()):
+                os.kill(process.pid, signal.SIGKILL)
+            deadline = time.monotonic() + 10
+            while not broken._broken and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+
+            second, = jobs.enqueue_jobs([_report_file(tmp_path, f"queue-{uuid.uuid4()}")], "test")
+            pool.notify()
+            row = await wait_done(second)
+            assert row['status'] == 'done' and row['attempts'] == 1
+            assert pool._parse_executor is not broken
+        finally:
+            await pool.stop()
+
+    asyncio.run(run())
+
+
+def test_identical_file_is_not_parsed_again(tmp_path, monkeypatch):
+    init_db()
+    original = _report_file(tmp_path, f"queue-{uuid.uuid4()}")
+    copy = tmp_path / "forwarded-copy.xml"
+    copy.write_bytes(original.read_bytes())
+
+    first, = jobs.enqueue_jobs([original], "test")
+    rows, _ = _drain([first])
+    assert rows[first]['status'] == 'done'
+
+    parsed = []
+    parse_file = jobs._parse_file
+    monkeypatch.setattr(jobs, "_parse_file", lambda path: parsed.append(path) or parse_file(path))
+    second, = jobs.enqueue_jobs([copy], "test")
+    rows, saved = _drain([second])
+    assert rows[second]['status'] == 'duplicate'
+    assert rows[second]['report_id'] == _job_rows([first])[first]['report_id']
+    assert parsed == [] and saved == []
+
+
+def test_payloads_ingest_from_memory(tmp_path, monkeypatch):
+    import gzip
+
+    init_db()
+    monkeypatch.setattr(jobs, "INGEST_RETRY_BACKOFF", 0.05)
+    good = gzip.compress(_report_file(tmp_path, f"mem-{uuid.uuid4()}").read_bytes())
+    archived = _report_file(tmp_path, f"mem-{uuid.uuid4()}").read_bytes()
+    broken = b"<feedback><report_metadata>"
+    spill_dir = tmp_path / "spill"
+    saved = []
+
+    async def on_saved(report_id):
+        saved.append(report_id)
+
+    async def run():
+        pool = jobs.IngestWorkers(ThreadPoolExecutor(max_workers=4), workers=2, use_processes=False,
+                                  on_saved=on_saved, poll_interval=0.05, spill_dir=spill_dir)
+        await pool.start()
+        try:
+            # Same-named attachments do not collide on disk
+            ids = await pool.submit_payloads([("report.xml", good), ("report.xml", broken)], "email")
+            await pool.wait_payloads()
+            monkeypatch.setattr(jobs, "RAW_ARCHIVE_DIR", str(tmp_path / "archive"))
+            ids += await pool.submit_payloads([("other.xml", archived), ("again.gz", good)], "email")
+            await pool.wait_payloads()
+            deadline = time.monotonic() + 10
+            while _job_rows([ids[1]])[ids[1]]['status'] != 'failed' and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            return ids
+        finally:
+            await pool.stop()
+
+    ids = asyncio.run(run())
+    assert len(ids) == 4
+    rows = _job_rows(ids)
+    good_job, broken_job, archived_job, again_job = (rows[i] for i in ids)
+
+    assert good_job['status'] == 'done' and good_job['source'] == 'email'
+    assert again_job['status'] == 'duplicate' and again_job['report_id'] == good_job['report_id']
+    assert again_job['file_path'] == 'email:again.gz'
+    assert sorted(saved) == sorted([good_job['report_id'], archived_job['report_id']])
+
+    # Without an archive, payloads are written to the spill dir before their job exists
+    spilled = {p.name: p for p in spill_dir.iterdir()}
+    assert len(spilled) == 2 and all(name.endswith("-report.xml") for name in spilled)
+    assert open(good_job['file_path'], 'rb').read() == good
+    # A payload that fails is retried from that file through the queue
+    assert broken_job['status'] == 'failed' and broken_job['attempts'] == jobs.INGEST_MAX_ATTEMPTS
+    assert open(broken_job['file_path'], 'rb').read() == broken
+
+    # With RAW_ARCHIVE_DIR set, the raw bytes are kept by content hash
+    from backend.dmarc_lib.db import sha256_bytes
+    sha256, _ = sha256_bytes(archived)
+    archive_path = tmp_path / "archive" / sha256[:2] / f"{sha256}.xml"
+    assert archive_path.read_bytes() == archived
+    assert archived_job['file_path'] == str(archive_path) and archived_job['status'] == 'done'
+
+
+def test_payload_jobs_survive_a_restart(tmp_path, monkeypatch):
+    init_db()
+    payload = _report_file(tmp_path, f"mem-{uuid.uuid4()}").read_bytes()
+
+    async def crash_before_parsing(entries):
+        pass
+
+    async def run():
+        pool = jobs.IngestWorkers(ThreadPoolExecutor(max_workers=2), workers=1, use_processes=False,
+                                  poll_interval=0.05, spill_dir=tmp_path / "spill")
+        monkeypatch.setattr(pool, "_ingest_payloads", crash_before_parsing)
+        await pool.start()
+        try:
+            return await pool.submit_payloads([("report.xml", payload)], "email")
+        finally:
+            await pool.stop()
+
+    job_id, = asyncio.run(run())
+    assert _job_rows([job_id])[job_id]['status'] == 'running'
+
+    # The next start re-queues the job, and its payload is read back from disk
+    rows, saved = _drain([job_id])
+    assert rows[job_id]['status'] == 'done' and saved == [rows[job_id]['report_id']]
+
+
+def test_queue_payloads_leaves_ingest_to_the_workers(tmp_path, monkeypatch):
+    init_db()
+    monkeypatch.setattr(jobs, "RAW_ARCHIVE_DIR", "")
+    payload = _report_file(tmp_path, f"mem-{uuid.uuid4()}").read_bytes()
+
+    job_id, = jobs.queue_payloads([("report.xml", payload)], "email", tmp_path / "spill")
+    row = _job_rows([job_id])[job_id]
+    assert row['status'] == 'queued' and row['attempts'] == 0
+    with open(row['file_path'], "rb") as f:
+        assert f.read() == payload
+
+    rows, saved = _drain([job_id])
+    assert rows[job_id]['status'] == 'done' and saved == [rows[job_id]['report_id']]
+
+    # Content that was already ingested is only recorded
+    duplicate, = jobs.queue_payloads([("copy.xml", payload)], "email", tmp_path / "spill")
+    row = _job_rows([duplicate])[duplicate]
+    assert row['status'] == 'duplicate' and row['report_id'] == rows[job_id]['report_id']
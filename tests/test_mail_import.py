@@ -0,0 +1,110 @@
+import gzip
+import io
+import mailbox
+import os
+import sys
+import uuid
+import zipfile
+from email.message import EmailMessage
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.dmarc_lib.db import get_db
+from backend.dmarc_lib.mail_import import iter_mail_sources, mail_import
+
+
+@pytest.fixture
+def mail_report(report_xml):
+    """Report attachments for these tests (bytes, their own org and domain)."""
+    def make(report_id, records=2):
+        return report_xml(report_id, records, org="Mail Archive Org", domain="mail-archive.example",
+                          ip_prefix="203.0.113", spf="fail").encode()
+    return make
+
+
+def _message(filename=None, content=b"", subtype="gzip"):
+    msg = EmailMessage()
+    msg["Subject"] = f"Report {filename}"
+    msg.set_content("DMARC aggregate report attached.\n")
+    if filename:
+        msg.add_attachment(content, maintype="application", subtype=subtype, filename=filename)
+    return msg
+
+
+def _zip(name, content):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr(name, content)
+    return buf.getvalue()
+
+
+def _archive(tmp_path, mail_report):
+    """A Maildir with a Maildir++ subfolder and an mbox next to it."""
+    prefix = f"mail-{uuid.uuid4()}"
+    inbox = mailbox.Maildir(tmp_path / "Maildir")
+    inbox.add(_message("google.xml.gz", gzip.compress(mail_report(f"{prefix}-a"))))
+    inbox.add(_message())  # no attachment
+    archive = inbox.add_folder("Archive")
+    forwarded = _message()
+    forwarded.add_attachment(_message("yahoo.zip", _zip("yahoo.xml", mail_report(f"{prefix}-b", 3)), subtype="zip"))
+    forwarded.add_attachment(b"%PDF-1.4", maintype="application", subtype="pdf", filename="invoice.pdf")
+    archive.add(forwarded)
+
+    (tmp_path / "exports").mkdir()
+    box = mailbox.mbox(tmp_path / "exports" / "dmarc.mbox")
+    box.add(_message("c.xml", mail_report(f"{prefix}-c"), subtype="xml"))
+    box.add(_message("broken.xml", b"<feedback><report_metadata>", subtype="xml"))
+    box.add(_message("d.xml", mail_report(f"{prefix}-c"), subtype="xml"))  # same report again
+    box.close()
+    return prefix
+
+
+def test_iter_mail_sources(tmp_path, mail_report):
+    _archive(tmp_path, mail_report)
+    (tmp_path / "notes.txt").write_text("not mail")
+    sources = [(kind, path.relative_to(tmp_path).as_posix()) for kind, path in iter_mail_sources([tmp_path])]
+    assert sources == [("maildir", "Maildir"), ("maildir", "Maildir/.Archive"), ("mbox", "exports/dmarc.mbox")]
+
+
+def test_mail_import_saves_and_resumes(tmp_path, mail_report, count_reports):
+    prefix = _archive(tmp_path, mail_report)
+    lines = []
+
+    summary = mail_import([tmp_path], workers=2, batch_size=2, use_processes=False, progress=lines.append)
+    assert summary["messages"] == 6
+    assert summary["attachments"] == 5
+    # The repeated report resolves to the one already saved
+    assert summary["saved"] == 4 and summary["records"] == 9
+    assert summary["failed"] == 1
+    assert count_reports(prefix) == 3
+    assert lines[0].startswith("6 messages to import")
+
+    conn = get_db()
+    statuses = dict(conn.execute(
+        "SELECT status, COUNT(*) FROM import_checkpoints WHERE path LIKE ? GROUP BY status", (f"{tmp_path}%",)))
+    conn.close()
+    assert statuses == {"imported": 4, "empty": 1, "failed": 1}
+
+    # Marking a message as read renames it into cur/ with flags; it is still the same message
+    new = tmp_path / "Maildir" / "new"
+    for name in os.listdir(new):
+        os.rename(new / name, tmp_path / "Maildir" / "cur" / f"{name}:2,S")
+    summary = mail_import([tmp_path], use_processes=False, progress=None)
+    assert summary["skipped"] == 6 and summary["saved"] == 0
+
+    # New mail appended to the mbox is picked up without redoing the rest
+    box = mailbox.mbox(tmp_path / "exports" / "dmarc.mbox")
+    box.add(_message("e.xml", mail_report(f"{prefix}-e"), subtype="xml"))
+    box.close()
+    summary = mail_import([tmp_path], use_processes=False, progress=None)
+    assert summary["skipped"] == 6 and summary["saved"] == 1
+    assert count_reports(prefix) == 4
+
+
+def test_mail_import_in_processes(tmp_path, mail_report, count_reports):
+    prefix = _archive(tmp_path, mail_report)
+    summary = mail_import([tmp_path / "Maildir", tmp_path / "exports" / "dmarc.mbox"], workers=2, progress=None)
+    assert summary["saved"] == 4 and summary["failed"] == 1
+    assert count_reports(prefix) == 3
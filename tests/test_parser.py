@@ -1,6 +1,6 @@
 import pytest
 from pathlib import Path
-from backend.dmarc_lib.parser import parse_report
+from backend.dmarc_lib.parser import parse_report, parse_report_stream
 import gzip
 import zipfile
 import io
@@ -83,6 +83,34 @@ def test_parse_zip_xml(tmp_path, sample_xml):
     data = parse_report(p)
     assert data['metadata']['org_name'] == "Google Inc."
 
+def test_parse_from_bytes_and_file_objects(sample_xml):
+    import lzma
+    raw = sample_xml.encode("utf-8")
+    zipped = io.BytesIO()
+    with zipfile.ZipFile(zipped, "w") as z:
+        z.writestr("inner.xml", sample_xml)
+
+    # Format sniffed from the magic bytes, or given as a hint
+    for payload in (raw, gzip.compress(raw), lzma.compress(raw), zipped.getvalue()):
+        assert parse_report(payload)['metadata']['report_id'] == "123456789"
+    assert parse_report(gzip.compress(raw), format="gz")['records'][0]['count'] == 10
+    assert parse_report(io.BytesIO(zipped.getvalue()))['policy']['domain'] == "example.com"
+
+    class Unseekable(io.RawIOBase):
+        def __init__(self, data):
+            self._inner = io.BytesIO(data)
+        def readable(self):
+            return True
+        def readinto(self, b):
+            return self._inner.readinto(b)
+
+    assert parse_report(Unseekable(zipped.getvalue()))['metadata']['org_name'] == "Google Inc."
+    assert parse_report(Unseekable(gzip.compress(raw)))['metadata']['org_name'] == "Google Inc."
+    with pytest.raises(ValueError, match="Report exceeds maximum allowed size"):
+        parse_report(gzip.compress(raw), max_bytes=100)
+    with pytest.raises(ValueError, match="Unknown report format"):
+        parse_report(raw, format="rar")
+
 def test_parse_malformed_xml(tmp_path):
     p = tmp_path / "bad.xml"
     p.write_text("<feedback><bad")
@@ -95,3 +123,94 @@ def test_parse_oversized_report(tmp_path):
     # Content is 26 bytes, max is 10
     with pytest.raises(ValueError, match="Report exceeds maximum allowed size"):
         parse_report(p, max_bytes=10)
+
+def _many_records_xml(n):
+    record = """  <record>
+    <row>
+      <source_ip>10.0.{hi}.{lo}</source_ip>
+      <count>2</count>
+      <policy_evaluated>
+        <disposition>reject</disposition>
+        <dkim>fail</dkim>
+        <spf>fail</spf>
+      </policy_evaluated>
+    </row>
+  </record>
+"""
+    body = "".join(record.format(hi=i // 256, lo=i % 256) for i in range(n))
+    return f"""<?xml version="1.0" encoding="UTF-8" ?>
+<feedback xmlns="urn:ietf:params:xml:ns:dmarc-2.0">
+  <report_metadata>
+    <org_name>Big Receiver</org_name>
+    <report_id>big-1</report_id>
+    <date_range><begin>1704067200</begin><end>1704153599</end></date_range>
+  </report_metadata>
+  <policy_published><domain>example.com</domain><p>reject</p></policy_published>
+{body}</feedback>
+"""
+
+def test_parse_report_stream_yields_records(tmp_path):
+    p = tmp_path / "big.xml.gz"
+    with gzip.open(p, "wb") as f:
+        f.write(_many_records_xml(500).encode("utf-8"))
+
+    data = parse_report_stream(p)
+    assert data['metadata']['report_id'] == "big-1"
+    assert data['policy']['domain'] == "example.com"
+    assert not isinstance(data['records'], list)
+
+    records = list(data['records'])
+    assert len(records) == 500
+    assert records[-1] == {
+        'source_ip': "10.0.1.243",
+        'count': 2,
+        'disposition': "reject",
+        'dkim': "fail",
+        'spf': "fail",
+    }
+
+def test_parse_report_stream_memory_is_flat(tmp_path):
+    import tracemalloc
+
+    def peak_for(n):
+        p = tmp_path / f"report-{n}.xml"
+        p.write_text(_many_records_xml(n))
+        tracemalloc.start()
+        for _ in parse_report_stream(p)['records']:
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak
+
+    small = peak_for(1_000)
+    large = peak_for(20_000)
+    # 20x the rows must not mean anything close to 20x the memory
+    assert large < small * 3
+
+def test_parse_report_stream_empty_file(tmp_path):
+    p = tmp_path / "empty.xml"
+    p.write_bytes(b"")
+    with pytest.raises(ValueError, match="Could not read content"):
+        parse_report_stream(p)
+
+def test_parse_report_stream_header_after_records(tmp_path):
+    p = tmp_path / "late-header.xml"
+    p.write_text("""<?xml version="1.0" encoding="UTF-8" ?>
+<feedback>
+  <record><row><source_ip>192.0.2.1</source_ip><count>2</count>
+    <policy_evaluated><disposition>none</disposition><dkim>pass</dkim><spf>pass</spf></policy_evaluated></row></record>
+  <report_metadata>
+    <org_name>Late Org</org_name>
+    <report_id>late-1</report_id>
+    <date_range><begin>1704067200</begin><end>1704153599</end></date_range>
+  </report_metadata>
+  <record><row><source_ip>192.0.2.2</source_ip><count>1</count>
+    <policy_evaluated><disposition>reject</disposition><dkim>fail</dkim><spf>fail</spf></policy_evaluated></row></record>
+  <policy_published><domain>late.example</domain><p>reject</p></policy_published>
+</feedback>
+""")
+    data = parse_report_stream(p)
+    assert data['metadata']['report_id'] == "late-1"
+    assert data['metadata']['org_name'] == "Late Org"
+    assert data['policy']['domain'] == "late.example"
+    assert [r['source_ip'] for r in data['records']] == ["192.0.2.1", "192.0.2.2"]